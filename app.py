@@ -1,11 +1,14 @@
 import streamlit as st
 import os
+import asyncio
 from dotenv import load_dotenv
-from litellm import completion
-import litellm
-from threat_research import perform_threat_research
 from ui import render_ui
 from config import prompts
+from pipeline import ANALYSIS_STEP_NAME, run_all_detections, analyze_intel
+from llm import count_tokens, llm_cache
+from routing import Router
+from metrics import start_metrics_server
+from jobs import submit_detections_job, wait_for_detections
 
 # Load environment variables
 load_dotenv()
@@ -13,72 +16,112 @@ load_dotenv()
 # Initialize session state for cost tracking
 if 'total_cost' not in st.session_state:
     st.session_state.total_cost = 0
+if 'cache_savings' not in st.session_state:
+    st.session_state.cache_savings = 0
+# Per-call telemetry records for the current run, summarized in the UI
+if 'run_calls' not in st.session_state:
+    st.session_state.run_calls = []
 
-# Shared variable for cost tracking
-shared_cost = 0
+def record_usage(usage):
+    # Fold the spend of one or more calls into this session's totals
+    st.session_state.total_cost += usage.get("cost", 0.0)
+    st.session_state.cache_savings += usage.get("saved", 0.0)
+    st.session_state.run_calls.extend(usage.get("calls", []))
+    stats = llm_cache.stats()
+    cached_tokens = ""
+    if usage.get("prompt_tokens"):
+        cached_tokens = f" | {usage.get('cached_tokens', 0)} of {usage['prompt_tokens']} prompt tokens served from the provider's prompt cache"
+    st.info(f"Total cost so far: ${st.session_state.total_cost:.6f} "
+            f"(saved ${st.session_state.cache_savings:.6f} from {stats['hits']} cache hits, {stats['misses']} misses){cached_tokens}")
 
-# Define the callback function
-def track_cost_callback(kwargs, completion_response, start_time, end_time):
-    global shared_cost
+def _tee(tokens, on_text):
+    for token in tokens:
+        on_text(token)
+        yield token
+
+def reuse_run_outputs(llm, run, router, model, max_tokens, temperature):
+    # Wrap an async llm(prompt, step) so steps this run already finished with
+    # identical inputs are returned from the run state instead of re-requested
+    async def run_llm(prompt, step):
+        key = run.key(prompt, router.route(step, model), max_tokens, temperature)
+        output = run.get(key)
+        if output is None:
+            output = await llm(prompt, step)
+            run.put(key, output)
+        return output
+    return run_llm
+
+def process_with_llm(prompt, model, max_tokens, temperature, stream=False, use_cache=True, step=None, on_text=None, run=None, router=None):
+    # on_text(text) is called with each streamed piece (or the whole answer when
+    # not streaming); `router` picks the model for the step and its fallbacks
+    router = router or Router()
+    key = run.key(prompt, router.route(step, model), max_tokens, temperature) if run else None
+    if key and run.get(key) is not None:
+        if on_text:
+            on_text(run.get(key))
+        return run.get(key)
+    usage = {}
     try:
-        response_cost = kwargs.get("response_cost", 0)
-        shared_cost += response_cost
-        print(f"Streaming response cost: ${response_cost:.6f}")
+        if stream:
+            tokens = router.stream_tokens(prompt, model, max_tokens, temperature, use_cache, usage, step)
+            result = st.write_stream(_tee(tokens, on_text) if on_text else tokens).strip()
+        else:
+            result = router.complete(prompt, model, max_tokens, temperature, use_cache, usage, step)
+            if on_text:
+                on_text(result)
+        record_usage(usage)
+        if run:
+            run.put(key, result)
+        return result
     except Exception as e:
-        print(f"Error tracking cost: {str(e)}")
+        st.error(f"Error with LLM API for {router.route(step, model)}: {str(e)}")
+        return None
 
-# Set the callback
-litellm.success_callback = [track_cost_callback]
+def process_all_detections(detections, context, model, max_tokens, temperature, max_concurrency, on_progress=None, use_cache=True, run=None, select_examples=None, router=None, owner=None, on_queued=None):
+    # With an `owner`, the work is queued for the background workers and this
+    # session only waits for it; the job id is kept in the run so a reopened
+    # tab can pick the results up with resume_detections
+    if owner is not None:
+        job_id = submit_detections_job(prompts, detections, context, model, max_tokens, temperature, max_concurrency, use_cache, select_examples, router, owner)
+        st.session_state.detections_job = job_id
+        if run:
+            run.remember(detections_job=job_id)
+        return resume_detections(job_id, on_progress, on_queued)
+    usage = {}
+    router = router or Router()
+    llm = lambda prompt, step: router.acomplete(prompt, model, max_tokens, temperature, use_cache, usage, step)
+    if run:
+        llm = reuse_run_outputs(llm, run, router, model, max_tokens, temperature)
+    outcomes = asyncio.run(run_all_detections(prompts, detections, context, llm, max_concurrency, on_progress, select_examples=select_examples))
+    record_usage(usage)
+    return outcomes
 
-def process_with_llm(prompt, model, max_tokens, temperature):
-    global shared_cost
+def resume_detections(job_id, on_progress=None, on_queued=None):
     try:
-        response = litellm.completion(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
-        # Update the Streamlit session state in the main thread
-        st.session_state.total_cost += shared_cost
-        st.info(f"Total cost so far: ${st.session_state.total_cost:.6f}")
-        shared_cost = 0  # Reset shared cost after updating session state
-        return response.choices[0].message.content.strip()
+        outcomes, usage = wait_for_detections(job_id, on_progress, on_queued=on_queued)
+    except RuntimeError as e:
+        st.error(f"Background processing failed: {str(e)}")
+        return []
+    record_usage(usage)
+    return outcomes
+
+def process_chunked_analysis(context, model, max_tokens, temperature, chunk_tokens, max_concurrency, on_progress=None, use_cache=True, run=None, router=None):
+    usage = {}
+    router = router or Router()
+    llm = lambda prompt, step: router.acomplete(prompt, model, max_tokens, temperature, use_cache, usage, step)
+    if run:
+        llm = reuse_run_outputs(llm, run, router, model, max_tokens, temperature)
+    try:
+        result = asyncio.run(analyze_intel(
+            prompts, context, llm, chunk_tokens, lambda text: count_tokens(text, router.route(ANALYSIS_STEP_NAME, model)), max_concurrency, on_progress
+        ))
     except Exception as e:
         st.error(f"Error with LLM API for {model}: {str(e)}")
         return None
-
-def process_threat_intel(description, file_content, model, data_types, detection_language, current_detections, example_logs, detection_steps, sop, max_tokens, temperature):
-    results = {}
-    for i, prompt in enumerate(prompts, 1):
-        context = {
-            "description": description,
-            "file_content": file_content,
-            "data_types": ", ".join(data_types),
-            "detection_language": detection_language,
-            "current_detections": "\n".join(current_detections),
-            "example_logs": "\n".join(example_logs),
-            "detection_steps": detection_steps,
-            "sop": sop,
-            "previous_analysis": results.get(1, "") if "Entire Analysis" in st.session_state.selected_detection else next((d for d in st.session_state.detections if st.session_state.selected_detection in d['name']), ""),
-            "previous_detection_rule": results.get(2, ""),
-            "previous_investigation_steps": results.get(3, ""),
-            "previous_qa_findings": results.get(4, "")
-        }
-        
-        formatted_prompt = prompt.format(**context)
-        
-        result = process_with_llm(formatted_prompt, model, max_tokens, temperature)
-        
-        if result is None:
-            return None
-
-        results[i] = result
-    
-    return results
+    record_usage(usage)
+    return result
 
 if __name__ == "__main__":
-    render_ui(prompts, process_with_llm)
+    if os.getenv("DIANA_METRICS_PORT"):
+        start_metrics_server(int(os.getenv("DIANA_METRICS_PORT")))
+    render_ui(prompts, process_with_llm, process_all_detections, process_chunked_analysis, resume_detections)
@@ -0,0 +1,253 @@
+import os
+import re
+import sys
+import json
+import asyncio
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from config import prompts
+from pipeline import STEP_NAMES, ANALYSIS_STEP_NAME, REPAIR_STEP_NAME, process_threat_intel
+from llm import count_tokens
+from pdf_extraction import extract_pdf
+from log_samples import summarize_log_file
+from metrics import summarize, start_metrics_server
+from run_state import load_json, save_json
+from library import load_index, example_selector
+from dedup import DetectionIndex, DEDUP_THRESHOLD
+from routing import Router
+
+# Load environment variables
+load_dotenv()
+
+INTEL_EXTENSIONS = (".txt", ".md", ".pdf")
+
+def slugify(text, max_length=60):
+    slug = re.sub(r"[^a-z0-9]+", "-", text.lower()).strip("-")
+    return slug[:max_length].rstrip("-") or "item"
+
+def read_text(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+def load_items(source):
+    # A directory yields one item per report file; a JSONL file yields one item
+    # per line with any of "description", "file" (plus optional "pages") and "url"/"urls" set
+    items = []
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            path = os.path.join(source, name)
+            if os.path.isfile(path) and name.lower().endswith(INTEL_EXTENSIONS):
+                items.append({"id": slugify(os.path.splitext(name)[0]), "file": path})
+        return items
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            item["id"] = slugify(str(item.get("id", f"item-{line_number}")))
+            if item.get("file") and not os.path.isabs(item["file"]):
+                item["file"] = os.path.join(base_dir, item["file"])
+            items.append(item)
+    return items
+
+def read_file_content(path, page_range=""):
+    if path.lower().endswith(".pdf"):
+        with open(path, "rb") as f:
+            return extract_pdf(f, page_range)[0]
+    return read_text(path)
+
+def build_intel_context(item, data_types):
+    scraped_content = ""
+    urls = item.get("urls") or ([item["url"]] if item.get("url") else [])
+    if urls:
+        from firecrawl_integration import scrape_urls
+        scraped = scrape_urls(urls)
+        errors = [f"{url}: {error}" for url, _, error in scraped if error]
+        if errors:
+            raise Exception(f"Error scraping URL(s): {'; '.join(errors)}")
+        scraped_content = "\n\n".join(markdown for _, markdown, _ in scraped)
+    return {
+        "description": item.get("description", ""),
+        "file_content": read_file_content(item["file"], item.get("pages", "")) if item.get("file") else "",
+        "scraped_content": scraped_content,
+        "data_types": ", ".join(data_types),
+    }
+
+def load_checkpoint(path):
+    state = load_json(path)
+    if not state:
+        return {}
+    # JSON object keys are strings; step numbers are ints everywhere else
+    state["results"] = [{int(step): text for step, text in results.items()} for results in state.get("results", [])]
+    return state
+
+def write_package(item_dir, index, outcome):
+    detection = outcome["detection"]
+    results = outcome["results"]
+    path = os.path.join(item_dir, f"{index + 1:02d}-{slugify(detection['name'])}.md")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(results[5] + "\n")
+        f.write("\n---\n\n# Pipeline Outputs\n")
+        for step, step_name in STEP_NAMES.items():
+            if step < 5:
+                f.write(f"\n## Step {step}: {step_name}\n\n{results[step]}\n")
+    return path
+
+def dedup_source(item, args):
+    # Item ids like "item-3" repeat between batches, so the id is qualified by
+    # the batch. The batch is identified by its input and output paths, so a
+    # resumed batch (whose checkpoints live under the same output directory)
+    # still recognises its own index entries.
+    batch = hashlib.sha1(f"{os.path.abspath(args.source)}\n{os.path.abspath(args.output)}".encode("utf-8")).hexdigest()[:8]
+    return f"{item['id']}@{batch}"
+
+def run_item(item, args, step_context, select_examples=None, dedup=None, router=None):
+    item_dir = os.path.join(args.output, item["id"])
+    os.makedirs(item_dir, exist_ok=True)
+    checkpoint_path = os.path.join(item_dir, "checkpoint.json")
+    state = load_checkpoint(checkpoint_path)
+    usage = {}
+
+    # Intel is only fetched and read if step 1 still has to run
+    intel_context = None if "analysis" in state else build_intel_context(item, args.data_types)
+    router = router or Router()
+    llm = lambda prompt, step: router.acomplete(prompt, args.model, args.max_tokens, args.temperature, not args.no_cache, usage, step)
+    outcomes = asyncio.run(process_threat_intel(
+        prompts, intel_context, step_context, llm, args.max_concurrency, state,
+        lambda state: save_json(checkpoint_path, state),
+        args.chunk_tokens, lambda text: count_tokens(text, args.model), select_examples,
+        dedup, dedup_source(item, args), not args.keep_duplicates
+    ))
+
+    packages, errors = [], []
+    for index, outcome in enumerate(outcomes):
+        if outcome["error"]:
+            errors.append(f"{outcome['detection']['name']}: {outcome['error']}")
+        else:
+            packages.append(write_package(item_dir, index, outcome))
+    return packages, errors, usage, state.get("duplicates", [])
+
+def print_summary(calls):
+    print(f"\n{'Step':<30} {'Model':<40} {'Calls':>6} {'Hits':>5} {'Prompt':>9} {'Output':>8} {'Cost $':>10} {'p50 s':>7} {'p95 s':>7}")
+    for row in summarize(calls):
+        p50 = f"{row['p50_latency']:.2f}" if row["p50_latency"] is not None else "-"
+        p95 = f"{row['p95_latency']:.2f}" if row["p95_latency"] is not None else "-"
+        print(f"{row['step']:<30} {row['model']:<40} {row['calls']:>6} {row['cache_hits']:>5} {row['prompt_tokens']:>9} "
+              f"{row['completion_tokens']:>8} {row['cost']:>10.4f} {p50:>7} {p95:>7}")
+    print()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the DIANA detection pipeline over many threat intel reports.")
+    parser.add_argument("source", help="Directory of .txt/.md/.pdf reports, or a JSONL file of {id, description, file, url} items")
+    parser.add_argument("-o", "--output", default="diana_output", help="Directory for detection packages and checkpoints")
+    parser.add_argument("--model", default=os.getenv("DIANA_MODEL", "claude-3-haiku-20240307"), help="litellm model name")
+    parser.add_argument("--data-types", nargs="+", default=["AWS CloudTrail Logs"], help="Security data/log types to focus on")
+    parser.add_argument("--detection-language", default="AWS Athena", help="Language to write detections in")
+    parser.add_argument("--example-detections", nargs="*", default=[], help="Files with one example detection each")
+    parser.add_argument("--example-logs", nargs="*", default=[], help="Files with one example log each")
+    parser.add_argument("--log-samples", nargs="*", default=[], help="Log files (JSONL, JSON, CloudTrail Records, optionally gzipped) to summarize into a field schema for the prompts")
+    parser.add_argument("--library", help="Detection/log library directory to pick the most relevant examples from for each detection")
+    parser.add_argument("--library-examples", type=int, default=3, help="Library rules and log samples added per detection")
+    parser.add_argument("--replay-logs", default=os.getenv("DIANA_REPLAY_LOGS"), help="Log file or directory to run each generated rule against before the QA review")
+    parser.add_argument("--detection-steps", help="File describing your detection writing steps")
+    parser.add_argument("--sop", help="File with your alert triage/investigation SOP")
+    parser.add_argument("--workers", type=int, default=4, help="Number of reports processed at the same time")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="Max in-flight LLM calls per report")
+    parser.add_argument("--chunk-tokens", type=int, default=12000, help="Split reports longer than this many tokens and analyze the chunks in parallel (0 disables)")
+    parser.add_argument("--route", action="append", default=[], metavar="STEP=MODEL",
+                        help='Use a different model for one step, e.g. --route "Final Summary=gpt-4o-mini" (repeatable)')
+    parser.add_argument("--fallback-models", nargs="*", default=[], help="Models to try in order when a call fails or times out")
+    parser.add_argument("--prefer-fast", action="store_true", help="Try each step's models in order of their recent latency")
+    parser.add_argument("--timeout", type=float, help="Seconds before an LLM call is abandoned and the next fallback is tried")
+    parser.add_argument("--max-tokens", type=int, default=4000)
+    parser.add_argument("--temperature", type=float, default=0.1)
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the LLM response cache")
+    parser.add_argument("--no-dedup", action="store_true", help="Do not check detections against those processed in earlier runs")
+    parser.add_argument("--keep-duplicates", action="store_true", help="Only flag near-duplicate detections instead of skipping them")
+    parser.add_argument("--dedup-threshold", type=float, default=DEDUP_THRESHOLD, help="Estimated Jaccard similarity above which a detection counts as a near-duplicate")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    items = load_items(args.source)
+    if not items:
+        print(f"No intel items found in {args.source}")
+        return 1
+
+    step_context = {
+        "detection_language": args.detection_language,
+        "current_detections": "\n".join(read_text(path) for path in args.example_detections),
+        "example_logs": "\n".join([read_text(path) for path in args.example_logs] + [summarize_log_file(path) for path in args.log_samples]),
+        "detection_steps": read_text(args.detection_steps) if args.detection_steps else "",
+        "sop": read_text(args.sop) if args.sop else "",
+        "replay_logs": args.replay_logs,
+    }
+    if args.replay_logs and not os.path.exists(args.replay_logs):
+        print(f"Replay logs not found: {args.replay_logs}")
+        return 1
+
+    select_examples = None
+    if args.library:
+        library_index = load_index(args.library)
+        if library_index is None:
+            print(f"Library directory not found: {args.library}")
+            return 1
+        select_examples = example_selector(library_index, args.data_types, args.detection_language, args.library_examples)
+
+    dedup = None if args.no_dedup else DetectionIndex(threshold=args.dedup_threshold)
+
+    routes = {}
+    for route in args.route:
+        step, _, model = route.partition("=")
+        if not model or step.strip() not in [ANALYSIS_STEP_NAME, REPAIR_STEP_NAME] + list(STEP_NAMES.values()):
+            print(f"Invalid --route {route!r}, expected STEP=MODEL with STEP one of: {ANALYSIS_STEP_NAME}, {', '.join(STEP_NAMES.values())}, {REPAIR_STEP_NAME}")
+            return 1
+        routes[step.strip()] = model.strip()
+    router = Router(routes, args.fallback_models, args.prefer_fast, args.timeout)
+
+    if os.getenv("DIANA_METRICS_PORT"):
+        start_metrics_server(int(os.getenv("DIANA_METRICS_PORT")))
+
+    total_cost = total_saved = 0.0
+    failed = 0
+    calls = []
+    print(f"Processing {len(items)} intel items with {args.workers} workers using {args.model}")
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_item, item, args, step_context, select_examples, dedup, router): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                packages, errors, usage, duplicates = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[FAILED] {item['id']}: {str(e)}")
+                continue
+            total_cost += usage.get("cost", 0.0)
+            total_saved += usage.get("saved", 0.0)
+            calls.extend(usage.get("calls", []))
+            if errors:
+                failed += 1
+            if not packages and not errors and not duplicates:
+                print(f"[DONE] {item['id']}: no detections in this intel, cost ${usage.get('cost', 0.0):.6f}")
+                continue
+            print(f"[{'PARTIAL' if errors else 'DONE'}] {item['id']}: {len(packages)} detection packages, cost ${usage.get('cost', 0.0):.6f}")
+            for error in errors:
+                print(f"    {error}")
+            for duplicate in duplicates:
+                match = duplicate["duplicate_of"]
+                print(f"    {'Flagged' if args.keep_duplicates else 'Skipped'} near-duplicate: {duplicate['detection']['name']} "
+                      f"(~{match['similarity']:.0%} similar to {match['name']} from {match['source']})")
+
+    print_summary(calls)
+    print(f"Finished: {len(items) - failed}/{len(items)} items complete, total cost ${total_cost:.6f} (saved ${total_saved:.6f} from cache)")
+    if failed:
+        print("Re-run the same command to resume unfinished items from their checkpoints.")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenAI-compatible stand-in for the LLM providers. litellm talks to it through
+# the "openai/" provider prefix with OPENAI_API_BASE pointed at this server, so
+# benchmarks exercise the real request path without network access or spend.
+
+class MockLLMConfig:
+    def __init__(self, latency=0.2, tokens_per_second=200, error_rate=0.0, completion_tokens=300, detections=6, seed=None):
+        self.latency = latency                      # seconds before the first token
+        self.tokens_per_second = tokens_per_second  # generation speed after the first token
+        self.error_rate = error_rate                # share of requests answered with a 429
+        self.completion_tokens = completion_tokens  # length of non-analysis answers
+        self.detections = detections                # detections returned by the step 1 prompt
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+def _prompt_text(messages):
+    parts = []
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            parts.extend(block.get("text", "") for block in content)
+        else:
+            parts.append(content)
+    return "\n".join(parts)
+
+def synthetic_analysis(detections):
+    return json.dumps([
+        {
+            "name": f"Synthetic behavior {i}",
+            "behavior": f"The actor performs suspicious action number {i} against cloud resources.",
+            "log_evidence": f"eventName = 'SyntheticEvent{i}' with requestParameters.target set",
+            "context": "Requires CloudTrail management events to be enabled.",
+        }
+        for i in range(1, detections + 1)
+    ], indent=2)
+
+def _answer(config, prompt):
+    if "threat intelligence analyst" in prompt:
+        return synthetic_analysis(config.detections)
+    words = ["detection", "logic", "eventName", "filter", "analyst", "triage", "query", "alert"]
+    return " ".join(words[i % len(words)] for i in range(config.completion_tokens))
+
+def make_handler(config):
+    class MockLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with config.lock:
+                config.requests += 1
+                fail = config.random.random() < config.error_rate
+                if fail:
+                    config.errors += 1
+            if fail:
+                self._send_json(429, {"error": {"message": "Rate limit exceeded (mock)", "type": "rate_limit_error"}}, {"Retry-After": "1"})
+                return
+
+            prompt = _prompt_text(request.get("messages", []))
+            tokens = _answer(config, prompt).split(" ")
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(tokens), "total_tokens": len(prompt) // 4 + len(tokens)}
+            time.sleep(config.latency)
+
+            if not request.get("stream"):
+                time.sleep(len(tokens) / config.tokens_per_second)
+                self._send_json(200, {
+                    "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(tokens)}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            batch = 10
+            for start in range(0, len(tokens), batch):
+                piece = " ".join(tokens[start:start + batch]) + (" " if start + batch < len(tokens) else "")
+                chunk = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(len(tokens[start:start + batch]) / config.tokens_per_second)
+            final = {"id": "mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model"),
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+            self.wfile.flush()
+            self.close_connection = True
+
+    return MockLLMHandler
+
+def start_mock_server(config, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="mock-llm").start()
+    return server
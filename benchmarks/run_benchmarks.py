@@ -0,0 +1,241 @@
+"""End-to-end benchmarks for DIANA against a local mock LLM server.
+
+Run from the project root:
+
+    python -m benchmarks.run_benchmarks --latency 0.3 --tokens-per-second 150 --json bench.json
+
+Nothing leaves the machine: litellm is pointed at benchmarks/mock_llm_server.py
+and every cache is redirected to a temporary directory.
+"""
+import io
+import os
+import sys
+import json
+import time
+import subprocess
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+
+from benchmarks.mock_llm_server import MockLLMConfig, start_mock_server, synthetic_analysis
+
+MODEL = "openai/diana-mock"
+
+def measure(name, func, *args, **kwargs):
+    # Wall time and peak Python heap for one benchmark body
+    tracemalloc.start()
+    started = time.perf_counter()
+    stats = func(*args, **kwargs) or {}
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(stats, benchmark=name, seconds=round(elapsed, 4), peak_mb=round(peak / 1024 / 1024, 2))
+
+def synthetic_report(chars):
+    paragraph = ("The threat actor used stolen access keys to call CreateAccessKey for another IAM user, "
+                 "then disabled CloudTrail logging with StopLogging and exfiltrated snapshots with ModifySnapshotAttribute. ")
+    paragraphs, size = [], 0
+    while size < chars:
+        paragraphs.append(paragraph * 3)
+        size += len(paragraph) * 3
+    return "\n\n".join(paragraphs)[:chars]
+
+def step_latencies(calls):
+    from metrics import summarize
+    return {
+        row["step"]: {"calls": row["calls"], "p50": row["p50_latency"], "p95": row["p95_latency"], "p50_ttft": row["p50_ttft"]}
+        for row in summarize(calls)
+    }
+
+def bench_chain(args, step_context):
+    # The five-prompt chain from config.py for one report, repeated
+    from config import prompts
+    from pipeline import process_threat_intel
+    from llm import acomplete, count_tokens
+
+    calls, failures = [], 0
+    started = time.perf_counter()
+    for _ in range(args.chain_runs):
+        usage = {}
+        llm = lambda prompt, step: acomplete(prompt, MODEL, 4000, 0.1, False, usage, step)
+        intel_context = {"description": "Synthetic intel", "file_content": synthetic_report(4000), "scraped_content": "", "data_types": "AWS CloudTrail Logs"}
+        try:
+            outcomes = asyncio.run(process_threat_intel(prompts, intel_context, step_context, llm, args.max_concurrency,
+                                                        chunk_tokens=args.chunk_tokens, count_tokens=lambda text: count_tokens(text, MODEL)))
+            failures += sum(1 for outcome in outcomes if outcome["error"])
+        except Exception:
+            failures += 1
+        calls.extend(usage.get("calls", []))
+    elapsed = time.perf_counter() - started
+    return {"runs": args.chain_runs, "failures": failures, "llm_calls": len(calls),
+            "llm_calls_per_second": round(len(calls) / elapsed, 2), "steps": step_latencies(calls)}
+
+def bench_parser(args):
+    # The step 1 detection parser over analyses of growing size
+    from pipeline import parse_detections
+    results = {}
+    for detections in (10, 100, 1000):
+        analysis = synthetic_analysis(detections)
+        started = time.perf_counter()
+        for _ in range(args.parser_iterations):
+            parsed = parse_detections(analysis)
+        results[f"{detections}_detections_ms"] = round((time.perf_counter() - started) / args.parser_iterations * 1000, 3)
+        results[f"{detections}_detections_parsed"] = len(parsed)
+    return results
+
+def bench_pdf(args, workdir):
+    # PDF ingestion, cold (no cache) and warm (cached by file hash)
+    try:
+        import fitz
+    except ImportError:
+        return {"skipped": "PyMuPDF is not installed"}
+    from pdf_extraction import extract_pdf, pdf_cache
+
+    path = os.path.join(workdir, "synthetic.pdf")
+    document = fitz.open()
+    text = synthetic_report(3000)
+    for _ in range(args.pdf_pages):
+        document.new_page().insert_textbox(fitz.Rect(36, 36, 576, 756), text, fontsize=8)
+    document.save(path)
+    document.close()
+
+    pdf_cache.clear()
+    with open(path, "rb") as f:
+        started = time.perf_counter()
+        extracted, pages = extract_pdf(f)
+        cold = time.perf_counter() - started
+        started = time.perf_counter()
+        extract_pdf(f)
+        warm = time.perf_counter() - started
+    return {"pages": pages, "chars": len(extracted), "cold_seconds": round(cold, 4), "warm_seconds": round(warm, 4)}
+
+def bench_batch(args, workdir):
+    # The batch CLI over synthetic reports of varying size
+    import batch
+    source = os.path.join(workdir, "reports")
+    os.makedirs(source, exist_ok=True)
+    sizes = [int(size) for size in args.report_sizes.split(",")]
+    for i in range(args.reports):
+        with open(os.path.join(source, f"report-{i:03d}.txt"), "w", encoding="utf-8") as f:
+            f.write(synthetic_report(sizes[i % len(sizes)]))
+
+    output = io.StringIO()
+    started = time.perf_counter()
+    with redirect_stdout(output):
+        exit_code = batch.main([source, "-o", os.path.join(workdir, "batch_output"), "--model", MODEL, "--no-cache", "--no-dedup",
+                                "--workers", str(args.workers), "--max-concurrency", str(args.max_concurrency),
+                                "--chunk-tokens", str(args.chunk_tokens)])
+    elapsed = time.perf_counter() - started
+    return {"reports": args.reports, "exit_code": exit_code, "reports_per_minute": round(args.reports / elapsed * 60, 2)}
+
+# Entry points whose cold import time is tracked; app.py itself only runs under Streamlit
+STARTUP_MODULES = ("ui", "batch", "research_runner", "threat_research", "llm")
+
+def _depth(name):
+    # -X importtime indents nested imports by two spaces per level
+    return (len(name) - len(name.lstrip()) - 1) // 2
+
+def import_profile(module):
+    # Cold import of one module in a fresh interpreter with -X importtime
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    wall = time.perf_counter() - started
+    if process.returncode != 0:
+        return {"error": process.stderr.strip().splitlines()[-1]}
+    imports = []
+    for line in process.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package", nested by indentation
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((name.rstrip(), int(cumulative)))
+    end = next(i for i, (name, _) in enumerate(imports) if _depth(name) == 0 and name.strip() == module)
+    start = next((i + 1 for i in range(end - 1, -1, -1) if _depth(imports[i][0]) == 0), 0)
+    total = imports[end][1]
+    # Heaviest modules pulled in directly by the entry point (children are listed before their parent)
+    direct = [(name.strip(), us) for name, us in imports[start:end] if _depth(name) == 1]
+    return {"import_seconds": round(total / 1e6, 3), "process_seconds": round(wall, 3),
+            "heaviest": {name: round(us / 1e6, 3) for name, us in sorted(direct, key=lambda item: -item[1])[:5]}}
+
+def bench_startup(args):
+    return {module: import_profile(module) for module in STARTUP_MODULES}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DIANA against a local mock LLM server.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mock time to first token in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="Mock generation speed")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock requests that return HTTP 429")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="Mock answer length for steps 2-5")
+    parser.add_argument("--detections", type=int, default=6, help="Detections the mock step 1 answer contains")
+    parser.add_argument("--chain-runs", type=int, default=5)
+    parser.add_argument("--parser-iterations", type=int, default=20)
+    parser.add_argument("--pdf-pages", type=int, default=100)
+    parser.add_argument("--reports", type=int, default=20)
+    parser.add_argument("--report-sizes", default="2000,20000,100000", help="Comma-separated report sizes in characters")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--chunk-tokens", type=int, default=12000)
+    parser.add_argument("--only", nargs="*", choices=["startup", "chain", "parser", "pdf", "batch"], help="Run a subset of the benchmarks")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    parser.add_argument("--history", help="Append the results as one JSON line to this file to track them across commits")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="diana-bench-")
+
+    # Redirect caches and telemetry before any DIANA module reads its settings
+    os.environ["DIANA_CACHE_DIR"] = os.path.join(workdir, "cache")
+    os.environ["DIANA_METRICS_FILE"] = os.path.join(workdir, "llm_calls.jsonl")
+    os.environ["LLM_CACHE_DISABLED"] = "1"
+
+    config = MockLLMConfig(args.latency, args.tokens_per_second, args.error_rate, args.completion_tokens, args.detections, seed=0)
+    server = start_mock_server(config)
+    os.environ["OPENAI_API_BASE"] = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    os.environ["OPENAI_API_KEY"] = "mock"
+
+    step_context = {"detection_language": "AWS Athena", "current_detections": "SELECT 1", "example_logs": "{}", "detection_steps": "", "sop": ""}
+    selected = set(args.only or ["startup", "chain", "parser", "pdf", "batch"])
+    results = []
+    if "startup" in selected:
+        results.append(measure("startup", bench_startup, args))
+    if "chain" in selected:
+        results.append(measure("chain", bench_chain, args, step_context))
+    if "parser" in selected:
+        results.append(measure("parser", bench_parser, args))
+    if "pdf" in selected:
+        results.append(measure("pdf", bench_pdf, args, workdir))
+    if "batch" in selected:
+        results.append(measure("batch", bench_batch, args, workdir))
+    server.shutdown()
+
+    mock = {"requests": config.requests, "errors": config.errors}
+    for result in results:
+        print(f"\n== {result['benchmark']} ({result['seconds']}s, peak {result['peak_mb']} MB)")
+        for key, value in result.items():
+            if key == "steps":
+                for step, stats in value.items():
+                    p95 = f"{stats['p95']:.3f}s" if stats["p95"] is not None else "-"
+                    p50 = f"{stats['p50']:.3f}s" if stats["p50"] is not None else "-"
+                    print(f"   {step:<30} calls={stats['calls']:<4} p50={p50} p95={p95}")
+            elif isinstance(value, dict) and "import_seconds" in value:
+                heaviest = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in value["heaviest"].items())
+                print(f"   {key:<30} import={value['import_seconds']:.3f}s process={value['process_seconds']:.3f}s  [{heaviest}]")
+            elif key not in ("benchmark", "seconds", "peak_mb") and value is not None:
+                print(f"   {key}: {value}")
+    print(f"\nMock server: {mock['requests']} requests, {mock['errors']} injected errors")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"settings": vars(args), "mock": mock, "results": results}, f, indent=2)
+    if args.history:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"timestamp": time.time(), "commit": commit, "settings": vars(args), "results": results}) + "\n")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
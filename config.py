@@ -1,3 +1,8 @@
+# Marks where the static part of a prompt (instructions, examples, SOP) ends
+# and the per-detection part begins. Everything before it is sent as a
+# cacheable prefix so providers with prompt caching only bill it once.
+PROMPT_CACHE_BREAK = "\n<<CACHE_BREAK>>\n"
+
 # Prompts for each step of the process
 prompts = [
     # Prompt 1: Analyze threat intelligence
@@ -17,17 +22,20 @@ For each potential detection:
 3. List the specific log data or events that would be used in the detection
 4. Include any relevant context or prerequisites for the detection
 
-Format your analysis as a numbered list:
+Format your analysis as a JSON array with one object per detection, and output nothing but the array:
 
-1. Detection Name: [Concise name]
-   Threat Behavior: [Detailed description]
-   Log Evidence: [Specific log data or events]
-   Context: [Any relevant prerequisites or environmental factors]
+[
+  {{
+    "name": "[Concise name]",
+    "behavior": "[Detailed description]",
+    "log_evidence": "[Specific log data or events]",
+    "context": "[Any relevant prerequisites or environmental factors]"
+  }}
+]
 
-If no detections are found for the specified data sources, clearly state this.""",
+If no detections are found for the specified data sources, output an empty array: []""",
     # Prompt 2: Create detection rule
-    """As a detection engineer specializing in {detection_language}, create a robust detection rule based on the following analysis:
-{previous_analysis}
+    """As a detection engineer specializing in {detection_language}, create a robust detection rule based on the analysis given at the end.
 
 Additional context:
 - Example detections: {current_detections}
@@ -44,12 +52,14 @@ If a complete detection cannot be written, explain why and specify any missing i
 Present the final detection rule in a code block, followed by:
 - Explanation of the rule's logic
 - Any limitations or edge cases
-- Estimated false positive rate and rationale""",
+- Estimated false positive rate and rationale""" + PROMPT_CACHE_BREAK + """Closest Examples From the Detection Library (if any):
+{library_examples}
 
-    # Prompt 3: Develop investigation guide
-    """As an experienced SOC analyst, create a detailed investigation guide for the following detection rule:
+Analysis:
+{previous_analysis}""",
 
-{previous_detection_rule}
+    # Prompt 3: Develop investigation guide
+    """As an experienced SOC analyst, create a detailed investigation guide for the detection rule given at the end.
 
 Use Palantir's alert and detection strategy framework and incorporate elements from this standard operating procedure (if provided): {sop}
 
@@ -60,16 +70,11 @@ Your investigation guide should include:
 4. Potential related TTPs or lateral movement to look for
 5. Recommended containment or mitigation actions
 
-Format the guide as a numbered list with clear, concise, and actionable steps. Include any caveats, limitations, or decision points an analyst might encounter.""",
+Format the guide as a numbered list with clear, concise, and actionable steps. Include any caveats, limitations, or decision points an analyst might encounter.""" + PROMPT_CACHE_BREAK + """Detection Rule:
+{previous_detection_rule}""",
 
     # Prompt 4: Quality assurance review
-    """As a QA specialist in cyber threat detection with extensive experience in {detection_language}, conduct a thorough and comprehensive review of the following detection rule:
-
-Detection Rule:
-{previous_detection_rule}
-
-Analysis from Threat Intelligence:
-{previous_analysis}
+    """As a QA specialist in cyber threat detection with extensive experience in {detection_language}, conduct a thorough and comprehensive review of the detection rule given at the end, against the threat intelligence analysis it was written from.
 
 Assess the following aspects in detail, providing a score out of 10 for each:
 
@@ -77,6 +82,7 @@ Assess the following aspects in detail, providing a score out of 10 for each:
    - Is the rule syntactically correct in {detection_language}?
    - Are there any syntax errors or potential runtime issues?
    - Does it follow best practices and conventions for {detection_language}?
+   - Take the local syntax check result given at the end into account: if the rule already passed it, do not re-derive its syntax and spend the review on the other aspects.
 
 2. Logical Accuracy (10 points):
    - Does the rule accurately capture all aspects of the threat behavior described in the analysis?
@@ -91,11 +97,13 @@ Assess the following aspects in detail, providing a score out of 10 for each:
    - Is the detection optimized for performance in the target environment?
    - Are there any potential bottlenecks or resource-intensive operations?
    - Could the rule be optimized without sacrificing accuracy?
+   - If replay results are given at the end, weigh the event volume the rule had to scan and whether replay hit its limits
 
 5. False Positive/Negative Analysis (10 points):
    - Provide a realistic estimate of both false positive and false negative rates
    - Justify your estimates with specific scenarios or data points
    - Suggest ways to minimize false positives without increasing false negatives
+   - If replay results are given at the end, base the false positive estimate on the measured hit count and sample hits rather than on assumptions
 
 6. Robustness and Evasion Resistance (10 points):
    - How easily could an attacker evade this detection?
@@ -127,7 +135,17 @@ For each aspect, provide:
 
 Present your QA findings as a structured report with clear recommendations for each aspect. Include code snippets or pseudo-code where applicable to illustrate suggested improvements.
 
-Conclude with an overall assessment of the detection rule's quality and readiness for production deployment, including the total score out of 100 and a brief explanation of the score.""",
+Conclude with an overall assessment of the detection rule's quality and readiness for production deployment, including the total score out of 100 and a brief explanation of the score.""" + PROMPT_CACHE_BREAK + """Local Syntax Check:
+{syntax_check}
+
+Replay Against Sample Logs:
+{replay_results}
+
+Detection Rule:
+{previous_detection_rule}
+
+Analysis from Threat Intelligence:
+{previous_analysis}""",
 
     # Prompt 5: Final summary
     """As a senior threat analyst, compile a comprehensive detection package using the following components:
@@ -166,4 +184,28 @@ Performance Considerations
 
 Ensure the final output is well-structured, comprehensive, and ready for review and implementation by the security operations team."""
 
-]
\ No newline at end of file
+]
+
+# Targeted fix for a step 2 rule that failed local syntax validation
+# (see validators.py). It is not part of the step graph: the pipeline sends it
+# right after step 2 and keeps the repaired rule only if it validates better.
+repair_prompt = """A local validator found syntax errors in the detection rule given at the end.
+
+Fix only what is needed to resolve the reported errors, keeping the detection logic unchanged. Reply in the same format as the original response: the corrected detection rule in a code block, followed by the original explanation, limitations and false positive notes.""" + PROMPT_CACHE_BREAK + """Detection Language: {detection_language}
+
+Validator Errors:
+{validation_errors}
+
+Original Response:
+{previous_detection_rule}"""
+
+# Each template consumes earlier outputs through these fields. The pipeline
+# reads the fields a template references to build the dependency graph, so
+# steps whose inputs are ready (e.g. the investigation guide and QA review,
+# which both only need the detection rule) run at the same time.
+step_outputs = {
+    "previous_analysis": 1,
+    "previous_detection_rule": 2,
+    "previous_investigation_steps": 3,
+    "previous_qa_findings": 4,
+}
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from cache import CACHE_DIR
+from library import tokenize
+
+# Detections accepted for steps 2-5 are remembered as MinHash signatures in
+# an LSH table, so a new candidate is compared only against the few detections
+# that share a band with it instead of against everything processed before.
+NUM_PERM = 128
+BANDS = 32  # 4 rows per band: candidates from roughly 0.4 Jaccard similarity up
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.6))
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1)
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+def detection_text(detection):
+    return " ".join((detection["name"], detection["behavior"], detection["log_evidence"]))
+
+def shingles(text, size=2):
+    tokens = tokenize(text)
+    if len(tokens) < size:
+        return set(tokens)
+    return {" ".join(tokens[i:i+size]) for i in range(len(tokens) - size + 1)}
+
+def minhash(text):
+    values = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big") for s in shingles(text)]
+    if not values:
+        return None
+    return [min((a * v + b) % _PRIME for v in values) for a, b in _PERMUTATIONS]
+
+def similarity(signature, other):
+    # Share of matching MinHash slots estimates the Jaccard similarity of the shingle sets
+    return sum(x == y for x, y in zip(signature, other)) / NUM_PERM
+
+def _buckets(signature):
+    rows = NUM_PERM // BANDS
+    for band in range(BANDS):
+        chunk = signature[band * rows:(band + 1) * rows]
+        yield band, hashlib.sha1(json.dumps(chunk).encode("utf-8")).hexdigest()[:16]
+
+class DetectionIndex:
+    """Persistent MinHash/LSH index of detections already processed."""
+
+    def __init__(self, name="detection_index", threshold=DEDUP_THRESHOLD):
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS detections ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL, source TEXT, signature TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (band INTEGER NOT NULL, bucket TEXT NOT NULL, detection_id INTEGER NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket)")
+            conn.execute("CREATE INDEX IF NOT EXISTS detections_entry ON detections (source, name)")
+            self._initialized = True
+        return conn
+
+    def _closest(self, conn, signature, exclude_source=None):
+        candidates = set()
+        for band, bucket in _buckets(signature):
+            candidates.update(row[0] for row in conn.execute(
+                "SELECT detection_id FROM buckets WHERE band = ? AND bucket = ?", (band, bucket)))
+        best = None
+        for candidate in candidates:
+            name, source, stored = conn.execute(
+                "SELECT name, source, signature FROM detections WHERE id = ?", (candidate,)).fetchone()
+            if exclude_source is not None and source == exclude_source:
+                continue
+            score = similarity(signature, json.loads(stored))
+            if score >= self.threshold and (best is None or score > best["similarity"]):
+                best = {"name": name, "source": source, "similarity": score}
+        return best
+
+    def _insert(self, conn, name, source, signature):
+        # Idempotent, so re-checking or re-adding a detection leaves one entry
+        stored = json.dumps(signature)
+        if conn.execute("SELECT 1 FROM detections WHERE name = ? AND source IS ? AND signature = ?", (name, source, stored)).fetchone():
+            return
+        cursor = conn.execute(
+            "INSERT INTO detections (name, source, signature, created_at) VALUES (?, ?, ?, ?)",
+            (name, source, stored, time.time())
+        )
+        conn.executemany(
+            "INSERT INTO buckets (band, bucket, detection_id) VALUES (?, ?, ?)",
+            [(band, bucket, cursor.lastrowid) for band, bucket in _buckets(signature)]
+        )
+
+    def find(self, detection, exclude_source=None):
+        # Returns {"name", "source", "similarity"} for the closest processed
+        # detection at or above the threshold, or None
+        signature = minhash(detection_text(detection))
+        if signature is None:
+            return None
+        with self._connect() as conn:
+            return self._closest(conn, signature, exclude_source)
+
+    def check(self, detections, source=None, record=False):
+        # Match each detection against the index (ignoring `source`'s own
+        # entries) and against the detections before it in the list. With
+        # record=True the ones without a match are added in the same
+        # transaction, so reports processed at the same time by other threads
+        # or worker processes see them before their steps 2-5 have finished.
+        matches, accepted = [], []
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for detection in detections:
+                signature = minhash(detection_text(detection))
+                match = None
+                if signature is not None:
+                    match = self._closest(conn, signature, source)
+                    for name, other in accepted:
+                        score = similarity(signature, other)
+                        if score >= self.threshold and (match is None or score > match["similarity"]):
+                            match = {"name": name, "source": source, "similarity": score}
+                    if match is None:
+                        accepted.append((detection["name"], signature))
+                        if record:
+                            self._insert(conn, detection["name"], source, signature)
+                matches.append(match)
+        return matches
+
+    def add(self, detection, source=None):
+        signature = minhash(detection_text(detection))
+        if signature is None:
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._insert(conn, detection["name"], source, signature)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            with self._connect() as conn:
+                conn.execute("DELETE FROM buckets")
+                conn.execute("DELETE FROM detections")
+
+detection_index = DetectionIndex()
@@ -1,7 +1,10 @@
 # firecrawl_integration.py
 import os
-from firecrawl import FirecrawlApp
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from cache import DiskCache
 
 # Load environment variables from .env file
 load_dotenv()
@@ -9,10 +12,49 @@ load_dotenv()
 # Get the Firecrawl API key from the .env file
 API_KEY = os.getenv('FIRECRAWL_API_KEY')
 
-def scrape_url(url):
-    app = FirecrawlApp(api_key=API_KEY)
-    response = app.scrape_url(url=url)
-    print(response)  # Debugging output to check the response structure
+# Scraped pages younger than SCRAPE_CACHE_TTL are served from the cache as-is.
+# Older ones are revalidated with the site's ETag/Last-Modified before paying
+# for another Firecrawl scrape; entries are dropped entirely after 30 days.
+SCRAPE_CACHE_TTL = int(os.getenv("SCRAPE_CACHE_TTL", 24 * 3600))
+scrape_cache = DiskCache("scraped_pages", ttl=30 * 24 * 3600, max_bytes=200 * 1024 * 1024)
+
+_app = None
+_app_lock = threading.Lock()
+
+def get_app():
+    # One Firecrawl client per process, shared by every scrape. The SDK is
+    # imported here so app startup does not pay for it until a URL is scraped.
+    global _app
+    with _app_lock:
+        if _app is None:
+            from firecrawl import FirecrawlApp
+            _app = FirecrawlApp(api_key=API_KEY)
+        return _app
+
+def _validators(url):
+    import requests
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=10)
+        return {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+    except requests.RequestException:
+        return {}
+
+def _not_modified(url, entry):
+    import requests
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    if not headers:
+        return False
+    try:
+        return requests.head(url, headers=headers, allow_redirects=True, timeout=10).status_code == 304
+    except requests.RequestException:
+        return False
+
+def _scrape(url):
+    response = get_app().scrape_url(url=url)
     if isinstance(response, dict) and 'success' in response and response['success']:
         return response['data']['markdown']
     elif isinstance(response, dict) and 'content' in response:
@@ -20,4 +62,28 @@ def scrape_url(url):
     else:
         raise Exception(f"Error scraping URL: {response}")
 
+def scrape_url(url, use_cache=True):
+    key = scrape_cache.key(url)
+    entry = scrape_cache.get(key) if use_cache else None
+    if entry is not None:
+        if time.time() - entry["fetched_at"] < SCRAPE_CACHE_TTL:
+            return entry["markdown"]
+        if _not_modified(url, entry):
+            entry["fetched_at"] = time.time()
+            scrape_cache.put(key, entry)
+            return entry["markdown"]
+
+    markdown = _scrape(url)
+    scrape_cache.put(key, dict(_validators(url), markdown=markdown, fetched_at=time.time()))
+    return markdown
+
+def scrape_urls(urls, max_concurrency=5, use_cache=True):
+    # Scrape several URLs at once; returns (url, markdown, error) in input order
+    def scrape_one(url):
+        try:
+            return url, scrape_url(url, use_cache), None
+        except Exception as e:
+            return url, "", str(e)
 
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(urls)))) as executor:
+        return list(executor.map(scrape_one, urls))
@@ -0,0 +1,397 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from cache import CACHE_DIR
+
+# LLM work submitted by Streamlit sessions is queued in SQLite and executed by
+# a pool of worker processes (python jobs.py --workers N), so closing a tab or
+# a rerun no longer kills in-flight steps, and several analysts sharing one
+# deployment are served fairly: the next job goes to the analyst with the
+# fewest jobs running, oldest first, and JOB_MAX_RUNNING caps the whole queue.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", 0))  # 0: limited by the number of workers only
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 120   # running jobs whose worker stopped heartbeating go back to the queue
+WORKER_SEEN_SECONDS = 30
+MAX_EVENTS = 1000     # events kept per job
+FINAL_STATUSES = ("complete", "failed", "cancelled")
+
+class JobCancelled(Exception):
+    pass
+
+class JobQueue:
+    """SQLite-backed queue of jobs with progress events, shared by processes."""
+
+    def __init__(self, name="jobs"):
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self._initialized = False
+
+    def _connect(self):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, kind TEXT NOT NULL, owner TEXT NOT NULL, status TEXT NOT NULL, "
+                "payload TEXT NOT NULL, result TEXT, error TEXT, worker TEXT, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL, heartbeat_at REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, job_id TEXT NOT NULL, time REAL NOT NULL, "
+                "kind TEXT NOT NULL, agent TEXT NOT NULL, detail TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job_id, id)")
+            conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+            self._initialized = True
+        return conn
+
+    def submit(self, kind, payload, owner):
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, owner, status, payload, created_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, owner, json.dumps(payload), time.time())
+            )
+        return job_id
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def position(self, job_id):
+        # Number of queued jobs ahead of this one
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT count(*) FROM jobs WHERE status = 'queued' AND created_at < (SELECT created_at FROM jobs WHERE id = ?)", (job_id,)
+            ).fetchone()[0]
+
+    def claim(self, worker):
+        # Atomically take the next job: analysts with fewer running jobs first,
+        # then oldest first
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if JOB_MAX_RUNNING and conn.execute("SELECT count(*) FROM jobs WHERE status = 'running'").fetchone()[0] >= JOB_MAX_RUNNING:
+                return None
+            row = conn.execute(
+                "SELECT * FROM jobs AS j WHERE status = 'queued' "
+                "ORDER BY (SELECT count(*) FROM jobs AS r WHERE r.owner = j.owner AND r.status = 'running'), created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                (worker, now, now, row["id"])
+            )
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    def finish(self, job_id, result=None, error=None):
+        # A job cancelled while it ran keeps its cancelled status
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ? AND status = 'running'",
+                ("failed" if error else "complete", json.dumps(result) if result is not None else None, error, time.time(), job_id)
+            )
+
+    def cancel(self, job_id):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('queued', 'running')",
+                (time.time(), job_id)
+            )
+
+    def heartbeat(self, worker, job_id=None):
+        # Record that the worker is alive; returns False if its job was cancelled
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (id, seen_at) VALUES (?, ?)", (worker, now))
+            if job_id is None:
+                return True
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (now, job_id))
+            return conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0] == "running"
+
+    def requeue_stale(self):
+        # Jobs of workers that died are picked up again by the others
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', worker = NULL WHERE status = 'running' AND heartbeat_at < ?",
+                (time.time() - STALE_SECONDS,)
+            )
+
+    def active_workers(self):
+        if not os.path.exists(self.path):
+            return 0
+        with self._connect() as conn:
+            return conn.execute("SELECT count(*) FROM workers WHERE seen_at > ?", (time.time() - WORKER_SEEN_SECONDS,)).fetchone()[0]
+
+    def add_event(self, job_id, kind, agent, detail):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO events (job_id, time, kind, agent, detail) VALUES (?, ?, ?, ?, ?)",
+                (job_id, time.time(), kind, agent, detail)
+            )
+            conn.execute("DELETE FROM events WHERE job_id = ? AND id <= ?", (job_id, cursor.lastrowid - MAX_EVENTS))
+
+    def events(self, job_id, last=None, after=0):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM (SELECT * FROM events WHERE job_id = ? AND id > ? ORDER BY id DESC LIMIT ?) ORDER BY id",
+                (job_id, after, last or -1)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def event_count(self, job_id):
+        with self._connect() as conn:
+            return conn.execute("SELECT count(*) FROM events WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+job_queue = JobQueue()
+
+class _Done:
+    # Polled stand-in for threading.Event, so a queued job can be shown by the
+    # same code as a research job running in this process
+    def __init__(self, job):
+        self.job = job
+
+    def is_set(self):
+        return self.job.status in FINAL_STATUSES
+
+    def wait(self, timeout=None):
+        if not self.is_set() and timeout:
+            time.sleep(timeout)
+        return self.is_set()
+
+class QueuedJob:
+    """Client-side handle on a job in the queue, with the ResearchJob interface."""
+
+    def __init__(self, job_id, queue=job_queue):
+        self.job_id = job_id
+        self.queue = queue
+        self.done = _Done(self)
+
+    def _row(self):
+        return self.queue.get(self.job_id) or {}
+
+    @property
+    def status(self):
+        return self._row().get("status", "missing")
+
+    @property
+    def result(self):
+        return self._row().get("result")
+
+    @property
+    def error(self):
+        row = self._row()
+        return row.get("error") or (f"job was {row['status']}" if row.get("status") == "cancelled" else None)
+
+    @property
+    def event_count(self):
+        return self.queue.event_count(self.job_id)
+
+    def events(self, last=None):
+        return self.queue.events(self.job_id, last)
+
+    def cancel(self):
+        self.queue.cancel(self.job_id)
+
+def submit_research_job(query, model, use_cache=True, owner="anonymous"):
+    return QueuedJob(job_queue.submit("research", {"query": query, "model": model, "use_cache": use_cache}, owner))
+
+def submit_detections_job(prompts, detections, context, model, max_tokens, temperature, max_concurrency, use_cache=True,
+                          select_examples=None, router=None, owner="anonymous"):
+    # Library examples are chosen here, where the index is loaded, and shipped
+    # with the job so workers do not need the selector
+    payload = {
+        "prompts": prompts, "detections": detections, "context": context, "model": model,
+        "max_tokens": max_tokens, "temperature": temperature, "max_concurrency": max_concurrency, "use_cache": use_cache,
+        "examples": [select_examples(d) for d in detections] if select_examples else None,
+        "router": {"routes": router.routes, "fallbacks": router.fallbacks, "prefer_fast": router.prefer_fast, "timeout": router.timeout} if router else None,
+    }
+    return job_queue.submit("detections", payload, owner)
+
+def wait_for_detections(job_id, on_progress=None, poll_interval=0.5, on_queued=None):
+    # Replay the worker's progress events through on_progress(index, step, status)
+    # until the job finishes; returns (outcomes, usage). on_queued(position)
+    # gets the number of jobs ahead while it waits for a worker, then None. Only
+    # workers requeue stale jobs, so with none seen for STALE_SECONDS the job
+    # is cancelled rather than waited on forever.
+    last_event = 0
+    workers_seen = time.time()
+    while True:
+        job = job_queue.get(job_id)
+        for event in job_queue.events(job_id, after=last_event):
+            last_event = event["id"]
+            if event["kind"] == "progress" and on_progress:
+                on_progress(*json.loads(event["detail"]))
+        if job is None or job["status"] in FINAL_STATUSES:
+            break
+        if job_queue.active_workers():
+            workers_seen = time.time()
+        elif time.time() - workers_seen > STALE_SECONDS:
+            job_queue.cancel(job_id)
+            raise RuntimeError(f"No background worker has been running for {STALE_SECONDS}s; the job was cancelled")
+        if on_queued:
+            on_queued(job_queue.position(job_id) if job["status"] == "queued" else None)
+        time.sleep(poll_interval)
+    if job is None:
+        raise RuntimeError("Background job not found")
+    if job["status"] != "complete":
+        raise RuntimeError(job["error"] or f"Background job {job['status']}")
+    outcomes = job["result"]["outcomes"]
+    for outcome in outcomes:
+        outcome["results"] = {int(step): text for step, text in outcome["results"].items()}
+    return outcomes, job["result"]["usage"]
+
+# Job handlers run in the worker processes; each gets the job id, its payload
+# and a callable that reports whether the job is still wanted
+
+HANDLERS = {}
+
+def handler(kind):
+    def decorator(func):
+        HANDLERS[kind] = func
+        return func
+    return decorator
+
+class _Events:
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def add_event(self, kind, agent, detail):
+        job_queue.add_event(self.job_id, kind, agent, detail)
+
+@handler("research")
+def run_research(job_id, payload, still_wanted):
+    from threat_research import perform_threat_research
+    from research_runner import record_step, record_task
+    events = _Events(job_id)
+
+    def check_wanted():
+        # Called between the crew's steps, so a cancelled job stops calling the model
+        if not still_wanted():
+            raise JobCancelled("job was cancelled")
+
+    def on_step(agent, step):
+        record_step(events, agent, step)
+        check_wanted()
+
+    def on_task(task_output):
+        record_task(events, task_output)
+        check_wanted()
+
+    events.add_event("started", "", f"Researching: {payload['query']}")
+    result = str(perform_threat_research(
+        payload["query"], payload["model"],
+        step_callback=on_step,
+        task_callback=on_task,
+        use_cache=payload["use_cache"]
+    ))
+    events.add_event("finished", "", "Research completed")
+    return result
+
+@handler("detections")
+def run_detections(job_id, payload, still_wanted):
+    from pipeline import run_all_detections
+    from routing import Router
+
+    router = Router(**payload["router"]) if payload["router"] else Router()
+    examples = payload["examples"]
+    select_examples = (lambda d: examples[payload["detections"].index(d)]) if examples else None
+    usage = {}
+
+    async def llm(prompt, step):
+        if not still_wanted():
+            raise JobCancelled("job was cancelled")
+        return await router.acomplete(prompt, payload["model"], payload["max_tokens"], payload["temperature"], payload["use_cache"], usage, step)
+
+    def on_progress(index, step, status):
+        job_queue.add_event(job_id, "progress", "", json.dumps([index, step, status]))
+
+    outcomes = asyncio.run(run_all_detections(
+        payload["prompts"], payload["detections"], payload["context"], llm, payload["max_concurrency"], on_progress, select_examples=select_examples
+    ))
+    return {"outcomes": outcomes, "usage": usage}
+
+def run_job(worker, job):
+    wanted = threading.Event()
+    wanted.set()
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            if not job_queue.heartbeat(worker, job["id"]):
+                wanted.clear()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        result = HANDLERS[job["kind"]](job["id"], job["payload"], wanted.is_set)
+    except Exception as e:
+        job_queue.add_event(job["id"], "failed", "", str(e))
+        job_queue.finish(job["id"], error=f"{type(e).__name__}: {e}")
+    else:
+        job_queue.finish(job["id"], result)
+    finally:
+        stop.set()
+        thread.join()
+
+def work(worker, poll_interval=1.0):
+    # Worker process main loop
+    from dotenv import load_dotenv
+    load_dotenv()
+    print(f"Worker {worker} started")
+    while True:
+        job_queue.requeue_stale()
+        job_queue.heartbeat(worker)
+        job = job_queue.claim(worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        print(f"Worker {worker} running {job['kind']} job {job['id']} for {job['owner']}")
+        run_job(worker, job)
+
+def run_workers(count):
+    # Keep `count` worker processes alive until interrupted
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    try:
+        while True:
+            for i in range(count):
+                if i not in processes or not processes[i].is_alive():
+                    worker = f"{socket.gethostname()}-{os.getpid()}-{i}"
+                    processes[i] = context.Process(target=work, args=(worker,), daemon=True)
+                    processes[i].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        for process in processes.values():
+            process.terminate()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run DIANA background workers for jobs submitted from the app.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="Number of worker processes, i.e. jobs run at the same time")
+    args = parser.parse_args(argv)
+    run_workers(args.workers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
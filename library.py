@@ -0,0 +1,180 @@
+import os
+import re
+import sys
+import json
+import math
+import heapq
+import hashlib
+from collections import Counter, defaultdict
+from cache import CACHE_DIR
+
+# Local library of production detections and log samples. Files are organized
+# by what they cover, and folder names are matched against the selected
+# detection language and log types:
+#
+#   library/detections/<detection language>/<log type>/<rule file>
+#   library/logs/<log type>/<sample file>
+#
+# .jsonl and .log samples are indexed one line per example; every other file is
+# one example. Examples are ranked with BM25 against each detection's name,
+# behavior and log evidence, so only the most relevant ones reach the prompts.
+LIBRARY_DIR = os.getenv("DIANA_LIBRARY_DIR", "library")
+INDEX_FILE = os.path.join(CACHE_DIR, "library_index.json")
+KINDS = ("detections", "logs")
+LINE_EXTENSIONS = (".jsonl", ".log")
+MAX_EXAMPLE_CHARS = 4000
+
+# Words in log type and language names that say nothing about the source
+GENERIC_WORDS = {"logs", "log", "audit", "plane", "rules", "query", "language"}
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+def tokenize(text):
+    # Split camelCase event names too, so "CreateAccessKey" matches "create access key"
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def _name_tokens(name):
+    return set(re.findall(r"[a-z0-9]+", name.lower())) - GENERIC_WORDS
+
+def _matches(folders, names):
+    # A document matches when one of its folders names one of the wanted sources
+    wanted = [_name_tokens(name) for name in names]
+    for folder in folders:
+        tokens = _name_tokens(folder)
+        if tokens and any(w and (tokens <= w or w <= tokens) for w in wanted):
+            return True
+    return False
+
+def _library_files(directory):
+    for kind in KINDS:
+        root = os.path.join(directory, kind)
+        for dirpath, _, filenames in os.walk(root):
+            for filename in sorted(filenames):
+                if not filename.startswith("."):
+                    yield kind, os.path.join(dirpath, filename)
+
+def library_signature(directory):
+    entries = []
+    for _, path in _library_files(directory):
+        stat = os.stat(path)
+        entries.append((os.path.relpath(path, directory), stat.st_size, stat.st_mtime))
+    return hashlib.sha256(json.dumps(sorted(entries)).encode("utf-8")).hexdigest()
+
+def _read_documents(directory):
+    for kind, path in _library_files(directory):
+        relpath = os.path.relpath(path, directory)
+        folders = relpath.split(os.sep)[1:-1]
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                text = f.read()
+        except OSError:
+            continue
+        if path.endswith(LINE_EXTENSIONS):
+            for number, line in enumerate(text.splitlines(), 1):
+                if line.strip():
+                    yield {"kind": kind, "path": f"{relpath}:{number}", "folders": folders, "text": line.strip()}
+        elif text.strip():
+            yield {"kind": kind, "path": relpath, "folders": folders, "text": text.strip()}
+
+class LibraryIndex:
+    """BM25 index over the example library, filterable by source."""
+
+    def __init__(self, documents, signature=None):
+        self.documents = documents
+        self.signature = signature
+        self.postings = defaultdict(list)
+        for doc_id, document in enumerate(documents):
+            for term, count in document["terms"].items():
+                self.postings[term].append((doc_id, count))
+        self.average_length = sum(d["length"] for d in documents) / len(documents) if documents else 0
+
+    @classmethod
+    def build(cls, directory):
+        documents = []
+        for document in _read_documents(directory):
+            tokens = tokenize(document["text"])
+            document["terms"] = dict(Counter(tokens))
+            document["length"] = len(tokens)
+            document["text"] = document["text"][:MAX_EXAMPLE_CHARS]
+            documents.append(document)
+        return cls(documents, library_signature(directory))
+
+    def save(self, path=INDEX_FILE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"signature": self.signature, "documents": self.documents}, f)
+        os.replace(tmp_path, path)
+
+    def count(self, kind):
+        return sum(1 for d in self.documents if d["kind"] == kind)
+
+    def search(self, query, kind, data_types=(), language=None, k=3):
+        candidates = {
+            doc_id for doc_id, d in enumerate(self.documents)
+            if d["kind"] == kind
+            and (not data_types or _matches(d["folders"], data_types))
+            and (not language or _matches(d["folders"], [language]))
+        }
+        if not candidates:
+            return []
+        scores = defaultdict(float)
+        total = len(self.documents)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, ())
+            idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings:
+                if doc_id in candidates:
+                    length = self.documents[doc_id]["length"]
+                    scores[doc_id] += idf * count * (BM25_K1 + 1) / (
+                        count + BM25_K1 * (1 - BM25_B + BM25_B * length / self.average_length))
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [self.documents[doc_id] for doc_id, _ in best]
+
+_loaded = {}
+
+def load_index(directory=LIBRARY_DIR, path=INDEX_FILE):
+    # Reuse the index built offline while the library is unchanged; rebuild it otherwise
+    if not os.path.isdir(directory):
+        return None
+    signature = library_signature(directory)
+    if directory in _loaded and _loaded[directory].signature == signature:
+        return _loaded[directory]
+    index = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("signature") == signature:
+            index = LibraryIndex(data["documents"], signature)
+    if index is None:
+        index = LibraryIndex.build(directory)
+        index.save(path)
+    _loaded[directory] = index
+    return index
+
+def format_examples(documents):
+    return "\n\n".join(f"# {d['path']}\n{d['text']}" for d in documents)
+
+def example_selector(index, data_types, language, k=3):
+    # Returns select(detection), which picks the top-k library rules and log
+    # samples for one detection. They go in {library_examples}, after the
+    # prompt's cache break, so the shared examples stay a cacheable prefix.
+    def select(detection):
+        query = " ".join((detection["name"], detection["behavior"], detection["log_evidence"]))
+        sections = (
+            ("Detections", format_examples(index.search(query, "detections", data_types, language, k))),
+            ("Log samples", format_examples(index.search(query, "logs", data_types, None, k))),
+        )
+        return {"library_examples": "\n\n".join(f"{title}:\n{text}" for title, text in sections if text)}
+    return select
+
+if __name__ == "__main__":
+    # Build the index offline: python library.py [library directory]
+    directory = sys.argv[1] if len(sys.argv) > 1 else LIBRARY_DIR
+    if not os.path.isdir(directory):
+        sys.exit(f"Library directory not found: {directory}")
+    index = LibraryIndex.build(directory)
+    index.save()
+    print(f"Indexed {index.count('detections')} detections and {index.count('logs')} log samples from {directory} into {INDEX_FILE}")
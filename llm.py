@@ -0,0 +1,220 @@
+import os
+import time
+from dotenv import load_dotenv
+from cache import DiskCache
+from config import PROMPT_CACHE_BREAK
+from metrics import metrics
+from scheduler import scheduled, ascheduled, limiter, is_rate_limited, retry_after
+
+# Load environment variables
+load_dotenv()
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# On-disk response cache keyed on model, rendered prompt, temperature and max_tokens
+llm_cache = DiskCache(
+    "llm_responses",
+    ttl=int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+    max_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", 200 * 1024 * 1024)),
+    enabled=os.getenv("LLM_CACHE_DISABLED", "").lower() not in ("1", "true", "yes")
+)
+
+# The functions below never touch Streamlit so they can be shared by the UI,
+# the concurrent fan-out and the batch CLI. Callers that care about spend pass
+# a `usage` dict which is filled with the call's cost, token counts, cache
+# savings and a per-call telemetry record under "calls". `step` labels each
+# call with the pipeline step it belongs to, and `timeout` (seconds) bounds the
+# provider request. Timed-out requests are retried unless `retry_timeouts` is
+# False, which the router passes when it has another model to fall back to.
+#
+# litellm takes around a second to import, so it is imported inside the
+# functions that need it rather than when the app or CLI starts.
+
+def supports_cache_control(model):
+    # Anthropic needs explicit cache_control breakpoints; OpenAI caches any
+    # repeated prefix automatically, so it only needs the static part first
+    return model.startswith(("claude", "anthropic/"))
+
+def build_messages(prompt, model):
+    if PROMPT_CACHE_BREAK not in prompt:
+        user_content = prompt
+    else:
+        prefix, suffix = prompt.split(PROMPT_CACHE_BREAK, 1)
+        if supports_cache_control(model):
+            user_content = [
+                {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": suffix}
+            ]
+        else:
+            user_content = prefix + "\n\n" + suffix
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
+def cached_prompt_tokens(response_usage):
+    # OpenAI reports prompt_tokens_details.cached_tokens, Anthropic cache_read_input_tokens
+    details = getattr(response_usage, "prompt_tokens_details", None)
+    return (getattr(details, "cached_tokens", None) or getattr(response_usage, "cache_read_input_tokens", None) or 0)
+
+def count_tokens(text, model):
+    try:
+        import litellm
+        return litellm.token_counter(model=model, text=text)
+    except Exception:
+        return len(text) // 4
+
+def _reserved_tokens(prompt, model, max_tokens):
+    # Providers count max_tokens against TPM quotas up front; unused tokens are
+    # handed back to the scheduler's bucket once the real usage is known
+    return count_tokens(prompt, model) + max_tokens
+
+def estimate_cost(prompt, model, max_tokens):
+    # Most a call can cost: the whole prompt plus max_tokens of output
+    try:
+        import litellm
+        prompt_cost, completion_cost = litellm.cost_per_token(model=model, prompt_tokens=count_tokens(prompt, model), completion_tokens=max_tokens)
+        return prompt_cost + completion_cost
+    except Exception:
+        return 0.0
+
+def _used_tokens(response):
+    return getattr(getattr(response, "usage", None), "total_tokens", None)
+
+def response_cost(response):
+    try:
+        import litellm
+        return litellm.completion_cost(completion_response=response)
+    except Exception:
+        return 0.0
+
+def _record_usage(usage, model, step, started, cost=0.0, saved=0.0, response=None, ttft=None):
+    # Build the per-call telemetry record, send it to the shared metrics sink
+    # and fold it into the caller's usage dict
+    response_usage = getattr(response, "usage", None)
+    call = metrics.record({
+        "step": step or "unknown",
+        "model": model,
+        "cache_hit": response is None,
+        "prompt_tokens": (getattr(response_usage, "prompt_tokens", 0) or 0) if response_usage else 0,
+        "completion_tokens": (getattr(response_usage, "completion_tokens", 0) or 0) if response_usage else 0,
+        "cached_tokens": cached_prompt_tokens(response_usage) if response_usage else 0,
+        "ttft": ttft,
+        "latency": time.perf_counter() - started,
+        "cost": cost,
+        "saved": saved,
+    })
+    if not call["cache_hit"]:
+        print(f"{step} [{model}]: {call['prompt_tokens']} prompt tokens ({call['cached_tokens']} from provider prompt cache), "
+              f"{call['completion_tokens']} completion tokens, {call['latency']:.2f}s, cost ${cost:.6f}")
+    if usage is not None:
+        usage["cost"] = usage.get("cost", 0.0) + cost
+        usage["saved"] = usage.get("saved", 0.0) + saved
+        usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + call["prompt_tokens"]
+        usage["cached_tokens"] = usage.get("cached_tokens", 0) + call["cached_tokens"]
+        usage.setdefault("calls", []).append(call)
+
+def get_cached_response(prompt, model, max_tokens, temperature, usage=None, step=None):
+    started = time.perf_counter()
+    entry = llm_cache.get(llm_cache.key(model, prompt, temperature, max_tokens))
+    if entry is None:
+        return None
+    _record_usage(usage, model, step, started, saved=entry["cost"])
+    return entry["response"]
+
+def store_cached_response(prompt, model, max_tokens, temperature, response, cost):
+    llm_cache.put(llm_cache.key(model, prompt, temperature, max_tokens), {"response": response, "cost": cost})
+
+def complete(prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None, timeout=None, retry_timeouts=True):
+    cached = get_cached_response(prompt, model, max_tokens, temperature, usage, step) if use_cache else None
+    if cached is not None:
+        return cached
+    import litellm
+    started = time.perf_counter()
+
+    def call():
+        response = litellm.completion(
+            model=model,
+            messages=build_messages(prompt, model),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout
+        )
+        return response, _used_tokens(response)
+
+    response = scheduled(model, _reserved_tokens(prompt, model, max_tokens), call, retry_timeouts)
+    result = response.choices[0].message.content.strip()
+    cost = response_cost(response)
+    _record_usage(usage, model, step, started, cost, response=response)
+    store_cached_response(prompt, model, max_tokens, temperature, result, cost)
+    return result
+
+async def acomplete(prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None, timeout=None, retry_timeouts=True):
+    cached = get_cached_response(prompt, model, max_tokens, temperature, usage, step) if use_cache else None
+    if cached is not None:
+        return cached
+    import litellm
+    started = time.perf_counter()
+
+    async def call():
+        response = await litellm.acompletion(
+            model=model,
+            messages=build_messages(prompt, model),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout
+        )
+        return response, _used_tokens(response)
+
+    response = await ascheduled(model, _reserved_tokens(prompt, model, max_tokens), call, retry_timeouts)
+    result = response.choices[0].message.content.strip()
+    cost = response_cost(response)
+    _record_usage(usage, model, step, started, cost, response=response)
+    store_cached_response(prompt, model, max_tokens, temperature, result, cost)
+    return result
+
+def stream_tokens(prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None, timeout=None, retry_timeouts=True):
+    # Yield text deltas as they arrive; a cache hit is yielded in one piece
+    cached = get_cached_response(prompt, model, max_tokens, temperature, usage, step) if use_cache else None
+    if cached is not None:
+        yield cached
+        return
+    import litellm
+    started = time.perf_counter()
+    ttft = None
+    messages = build_messages(prompt, model)
+    # Opening the stream can be retried; once tokens have been shown a failure
+    # is final. The slot is held until the stream ends and then released with
+    # the real usage, so concurrency and TPM limits cover the whole call.
+    reserved = _reserved_tokens(prompt, model, max_tokens)
+    response = scheduled(model, reserved, lambda: (litellm.completion(
+        model=model,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        timeout=timeout,
+        stream=True
+    ), None), retry_timeouts, hold=True)
+    slot = limiter(model)
+    try:
+        chunks = []
+        for chunk in response:
+            chunks.append(chunk)
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                yield delta
+        # stream_chunk_builder fills in usage, so cost can be computed like a normal call
+        full_response = litellm.stream_chunk_builder(chunks, messages=messages)
+    except Exception as e:
+        slot.release(reserved, None, is_rate_limited(e), retry_after(e))
+        raise
+    except BaseException:
+        # The reader stopped early (GeneratorExit) or was interrupted
+        slot.release(reserved, cancelled=True)
+        raise
+    slot.release(reserved, _used_tokens(full_response))
+    cost = response_cost(full_response)
+    _record_usage(usage, model, step, started, cost, response=full_response, ttft=ttft)
+    store_cached_response(prompt, model, max_tokens, temperature, full_response.choices[0].message.content.strip(), cost)
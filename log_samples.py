@@ -0,0 +1,266 @@
+import io
+import os
+import re
+import gzip
+import json
+from collections import Counter
+from cache import DiskCache
+from pdf_extraction import file_digest
+
+# Large log samples are streamed one event at a time and reduced to a field
+# schema (types, how often each field is present, common values) plus a few
+# minified exemplar events, which is what goes into {example_logs} instead of
+# raw JSON with every key and long value repeated.
+LINE_SUFFIXES = (".jsonl", ".ndjson", ".log")
+JSON_SUFFIXES = (".json",)
+PARQUET_SUFFIXES = (".parquet",)
+LOG_SUFFIXES = LINE_SUFFIXES + JSON_SUFFIXES + PARQUET_SUFFIXES
+
+MAX_EVENTS = int(os.getenv("LOG_SAMPLE_MAX_EVENTS", 500_000))
+MAX_FIELDS = 500         # fields tracked per file; further new fields are only counted
+MAX_SCHEMA_FIELDS = 60   # fields listed in the prompt, most frequent first
+VALUE_SLOTS = 16         # space-saving counter size for common values
+EXEMPLARS = 3
+MAX_VALUE_CHARS = 80
+MAX_RECORD_BYTES = 16 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+summary_cache = DiskCache("log_summaries", ttl=30 * 24 * 3600, max_bytes=50 * 1024 * 1024)
+
+def base_name(name):
+    return name[:-3] if name.endswith(".gz") else name
+
+def open_text(source):
+    # Text stream over a path or binary file object (e.g. a Streamlit upload),
+    # gunzipped on the fly when the name ends in .gz
+    name = source if isinstance(source, str) else getattr(source, "name", "")
+    if isinstance(source, str):
+        raw = open(source, "rb")
+    else:
+        raw = source
+        raw.seek(0)
+    if name.endswith(".gz"):
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding="utf-8", errors="replace")
+
+def _array_records(f, buffer):
+    # Yield the objects of a JSON array one at a time, keeping at most one
+    # record plus a read buffer in memory
+    decoder = json.JSONDecoder()
+    position, eof = 0, False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if position < len(buffer) and buffer[position] == "]":
+            return
+        if position >= len(buffer) and eof:
+            return
+        try:
+            record, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise ValueError("Truncated or malformed JSON record in log file")
+            if len(buffer) - position > MAX_RECORD_BYTES:
+                raise ValueError("Log record larger than the maximum record size")
+            data = f.read(READ_SIZE)
+            eof = not data
+            buffer, position = buffer[position:] + data, 0
+            continue
+        if isinstance(record, dict):
+            yield record
+
+def iter_records(source):
+    # Events from one JSON lines file, JSON array, or CloudTrail-style
+    # {"Records": [...]} file, sniffed from the first bytes of the content
+    f = open_text(source)
+    try:
+        head = f.read(READ_SIZE)
+        stripped = head.lstrip()
+        wrapper = re.match(r'\{\s*"Records"\s*:\s*\[', stripped)
+        if stripped.startswith("["):
+            yield from _array_records(f, stripped[1:])
+        elif wrapper:
+            yield from _array_records(f, stripped[wrapper.end():])
+        else:
+            # One object per line; lines that are not JSON objects are skipped
+            lines = io.StringIO(head)
+            partial = ""
+            for line in lines:
+                if not line.endswith("\n"):
+                    partial = line
+                    break
+                yield from _json_line(line)
+            for line in f:
+                yield from _json_line(partial + line)
+                partial = ""
+            if partial:
+                yield from _json_line(partial)
+    finally:
+        # Uploaded file objects stay open for Streamlit's later reruns
+        if isinstance(source, str):
+            f.close()
+        else:
+            f.detach()
+
+def _json_line(line):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return
+    if isinstance(record, dict):
+        yield record
+
+def read_events(path):
+    if base_name(path).endswith(PARQUET_SUFFIXES):
+        import duckdb
+        result = duckdb.connect().execute("SELECT * FROM read_parquet(?)", [path])
+        columns = [c[0] for c in result.description]
+        while rows := result.fetchmany(10000):
+            for row in rows:
+                yield dict(zip(columns, row))
+    else:
+        yield from iter_records(path)
+
+def _type_name(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return "list" if isinstance(value, list) else "object"
+
+def flatten(event, prefix=""):
+    # (dotted path, value) pairs; list elements share the path with a [] suffix
+    for key, value in event.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and value:
+            yield from flatten(value, path + ".")
+        elif isinstance(value, list) and value:
+            for item in value:
+                if isinstance(item, dict):
+                    yield from flatten(item, path + "[].")
+                else:
+                    yield path + "[]", item
+        else:
+            yield path, value
+
+def minify(value, max_chars=MAX_VALUE_CHARS):
+    # Exemplar copy of an event with long strings and lists cut short
+    if isinstance(value, dict):
+        return {k: minify(v, max_chars) for k, v in value.items()}
+    if isinstance(value, list):
+        return [minify(v, max_chars) for v in value[:5]] + (["..."] if len(value) > 5 else [])
+    if isinstance(value, str) and len(value) > max_chars:
+        return value[:max_chars] + "..."
+    return value
+
+class SchemaSummary:
+    """Field schema of a stream of events, built in bounded memory."""
+
+    def __init__(self, max_fields=MAX_FIELDS, exemplars=EXEMPLARS):
+        self.events = 0
+        self.fields = {}
+        self.untracked_fields = set()
+        self.max_fields = max_fields
+        self.max_exemplars = exemplars
+        self.exemplars = []
+        self._covered = set()
+
+    def _stats(self, path):
+        stats = self.fields.get(path)
+        if stats is None:
+            if len(self.fields) >= self.max_fields:
+                if len(self.untracked_fields) < self.max_fields:
+                    self.untracked_fields.add(path)
+                return None
+            stats = self.fields[path] = {"count": 0, "types": Counter(), "values": {}, "evicted": False, "unique": False, "min": None, "max": None}
+        return stats
+
+    def add(self, event):
+        self.events += 1
+        seen = set()
+        for path, value in flatten(event):
+            stats = self._stats(path)
+            if stats is None:
+                continue
+            if path not in seen:
+                stats["count"] += 1
+                seen.add(path)
+            stats["types"][_type_name(value)] += 1
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats["min"] = value if stats["min"] is None else min(stats["min"], value)
+                stats["max"] = value if stats["max"] is None else max(stats["max"], value)
+            elif value is not None and not isinstance(value, (dict, list)) and not stats["unique"]:
+                self._count_value(stats, str(value)[:MAX_VALUE_CHARS])
+        # Keep events that show fields none of the earlier exemplars had
+        if len(self.exemplars) < self.max_exemplars and not seen <= self._covered:
+            self.exemplars.append(minify(event))
+            self._covered |= seen
+
+    def _count_value(self, stats, value):
+        # Space-saving top-k: a new value takes over the least frequent slot
+        values = stats["values"]
+        if value in values:
+            values[value] += 1
+        elif len(values) < VALUE_SLOTS:
+            values[value] = 1
+        else:
+            smallest = min(values, key=values.get)
+            values[value] = values.pop(smallest) + 1
+            stats["evicted"] = True
+            # IDs, timestamps and addresses have no common values worth tracking
+            if stats["count"] >= 1000 and max(values.values()) < stats["count"] / 100:
+                stats["unique"] = True
+
+    def format(self, max_fields=MAX_SCHEMA_FIELDS, values_per_field=3):
+        fields = sorted(self.fields.items(), key=lambda item: (-item[1]["count"], item[0]))
+        lines = [f"Schema of {self.events:,} events (field: type, share of events with it, common values):"]
+        for path, stats in fields[:max_fields]:
+            types = "/".join(t for t, _ in stats["types"].most_common())
+            line = f"{path}: {types}, {stats['count'] / max(self.events, 1):.0%}"
+            if stats["min"] is not None:
+                line += f", range {stats['min']}..{stats['max']}"
+            top = sorted(stats["values"].items(), key=lambda item: -item[1])[:values_per_field]
+            if top and stats["evicted"]:
+                line += ", many distinct values, e.g. " + ", ".join(json.dumps(v) for v, _ in top)
+            elif top:
+                total = sum(stats["values"].values())
+                line += ", " + ", ".join(f"{json.dumps(v)} ({c / total:.0%})" for v, c in top)
+            lines.append(line)
+        omitted = len(fields) - max_fields + len(self.untracked_fields)
+        if omitted > 0:
+            lines.append(f"... and {omitted} rarer fields")
+        if self.exemplars:
+            lines.append("Example events (minified):")
+            lines.extend(json.dumps(e, separators=(",", ":"), default=str) for e in self.exemplars)
+        return "\n".join(lines)
+
+def summarize_events(events, max_events=MAX_EVENTS):
+    summary = SchemaSummary()
+    for event in events:
+        if summary.events >= max_events:
+            break
+        summary.add(event)
+    return summary
+
+def summarize_log_file(source, max_events=MAX_EVENTS):
+    # Prompt-ready schema summary for a path or binary file object, cached by
+    # content hash so Streamlit reruns and repeat batch runs reuse it
+    name = source if isinstance(source, str) else getattr(source, "name", "upload")
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            digest = file_digest(f)
+    else:
+        digest = file_digest(source)
+    key = summary_cache.key(digest, base_name(name).rsplit(".", 1)[-1], max_events)
+    cached = summary_cache.get(key)
+    if cached is not None:
+        return cached
+
+    events = read_events(source) if isinstance(source, str) else iter_records(source)
+    text = f"Log sample {os.path.basename(name)}\n" + summarize_events(events, max_events).format()
+    summary_cache.put(key, text)
+    return text
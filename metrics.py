@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import threading
+from collections import deque, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cache import CACHE_DIR
+
+# Every LLM call is appended here as one JSON line
+METRICS_FILE = os.getenv("DIANA_METRICS_FILE", os.path.join(CACHE_DIR, "llm_calls.jsonl"))
+# Loopback only by default: the metrics include per-model spend and usage
+METRICS_HOST = os.getenv("DIANA_METRICS_HOST", "127.0.0.1")
+
+# Recent calls kept in memory for the Prometheus endpoint's latency quantiles
+MAX_RECENT_CALLS = 10000
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def summarize(calls):
+    # Aggregate call records per (step, model) for the UI and CLI summaries
+    groups = defaultdict(list)
+    for call in calls:
+        groups[(call["step"], call["model"])].append(call)
+    rows = []
+    for (step, model), group in groups.items():
+        latencies = [c["latency"] for c in group if not c["cache_hit"]]
+        ttfts = [c["ttft"] for c in group if c["ttft"] is not None and not c["cache_hit"]]
+        rows.append({
+            "step": step,
+            "model": model,
+            "calls": len(group),
+            "cache_hits": sum(c["cache_hit"] for c in group),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in group),
+            "completion_tokens": sum(c["completion_tokens"] for c in group),
+            "cached_tokens": sum(c["cached_tokens"] for c in group),
+            "cost": sum(c["cost"] for c in group),
+            "p50_latency": percentile(latencies, 0.5),
+            "p95_latency": percentile(latencies, 0.95),
+            "p50_ttft": percentile(ttfts, 0.5),
+        })
+    return sorted(rows, key=lambda row: row["cost"], reverse=True)
+
+class MetricsRecorder:
+    """Thread-safe sink for per-call LLM telemetry.
+
+    Calls are appended to a JSONL file, kept in a bounded in-memory window and
+    folded into running totals exposed in Prometheus text format.
+    """
+
+    def __init__(self, path=METRICS_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=MAX_RECENT_CALLS)
+        self._totals = defaultdict(lambda: defaultdict(float))
+
+    def record(self, call):
+        call = dict(call, timestamp=time.time())
+        line = json.dumps(call)
+        with self._lock:
+            self._recent.append(call)
+            totals = self._totals[(call["step"], call["model"], "hit" if call["cache_hit"] else "miss")]
+            totals["calls"] += 1
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "cost", "latency"):
+                totals[field] += call[field] or 0
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        return call
+
+    def recent(self):
+        with self._lock:
+            return list(self._recent)
+
+    def prometheus_text(self):
+        with self._lock:
+            totals = {key: dict(values) for key, values in self._totals.items()}
+            recent = list(self._recent)
+        lines = []
+        counters = [
+            ("diana_llm_calls_total", "calls", "LLM calls"),
+            ("diana_llm_prompt_tokens_total", "prompt_tokens", "Prompt tokens sent"),
+            ("diana_llm_completion_tokens_total", "completion_tokens", "Completion tokens received"),
+            ("diana_llm_cached_tokens_total", "cached_tokens", "Prompt tokens served from provider prompt caches"),
+            ("diana_llm_cost_usd_total", "cost", "LLM spend in USD"),
+            ("diana_llm_latency_seconds_sum", "latency", "Total LLM call latency"),
+        ]
+        for name, field, help_text in counters:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (step, model, cache), values in sorted(totals.items()):
+                lines.append(f'{name}{{step="{step}",model="{model}",cache="{cache}"}} {values.get(field, 0)}')
+
+        lines.append("# HELP diana_llm_latency_seconds LLM call latency over recent provider calls")
+        lines.append("# TYPE diana_llm_latency_seconds summary")
+        for row in summarize(recent):
+            for quantile, value in (("0.5", row["p50_latency"]), ("0.95", row["p95_latency"])):
+                if value is not None:
+                    lines.append(f'diana_llm_latency_seconds{{step="{row["step"]}",model="{row["model"]}",quantile="{quantile}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRecorder()
+
+_server = None
+
+def start_metrics_server(port, host=METRICS_HOST):
+    # Serve metrics.prometheus_text() on http://<host>:<port>/metrics once per process
+    global _server
+    if _server is not None:
+        return _server
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, daemon=True, name="metrics-server").start()
+    return _server
@@ -0,0 +1,129 @@
+import io
+import os
+import sys
+import json
+import builtins
+
+# Child process that evaluates a generated Panther rule for replay.py. It is
+# started with `python -I -S` and an empty environment, reads the rule and then
+# one JSON event per line from stdin, and writes a single JSON result to
+# stdout. Before the rule is compiled it drops root, forbids new files,
+# processes and file descriptors, and runs the rule with builtins that cannot
+# open files or import anything outside ALLOWED_MODULES.
+import re
+import math
+import time
+import string
+import fnmatch
+import datetime
+import functools
+import ipaddress
+import itertools
+import collections
+
+ALLOWED_MODULES = {"re", "json", "math", "time", "string", "fnmatch", "datetime", "functools", "ipaddress", "itertools", "collections"}
+# Panther's helper modules are not installed; rules importing them get deep_get
+HELPER_MODULES = ("panther_base_helpers", "panther_detection_helpers", "global_helpers")
+BLOCKED_BUILTINS = {"open", "exec", "eval", "compile", "input", "breakpoint", "exit", "quit", "help", "globals", "vars", "memoryview"}
+SAMPLE_HITS = 3
+MEMORY_BYTES = 1024 * 1024 * 1024
+
+def deep_get(obj, *keys, default=None):
+    for key in keys:
+        if not isinstance(obj, dict):
+            return default
+        obj = obj.get(key)
+        if obj is None:
+            return default
+    return obj
+
+class PantherEvent(dict):
+    # The subset of Panther's event interface generated rules tend to use
+    def deep_get(self, *keys, default=None):
+        return deep_get(self, *keys, default=default)
+
+    def udm(self, *keys, default=None):
+        return deep_get(self, *keys, default=default)
+
+class _Helpers:
+    deep_get = staticmethod(deep_get)
+
+def _import(name, globals=None, locals=None, fromlist=(), level=0):
+    if name.startswith(HELPER_MODULES):
+        return _Helpers
+    if name.split(".")[0] not in ALLOWED_MODULES or level:
+        raise ImportError(f"import of {name} is not allowed in replay")
+    return sys.modules[name.split(".")[0]]
+
+def _confine(cpu_seconds):
+    try:
+        import resource
+    except ImportError:
+        return
+    if hasattr(os, "getuid") and os.getuid() == 0:
+        os.setgroups([])
+        os.setgid(65534)
+        os.setuid(65534)
+    limits = [
+        (resource.RLIMIT_CPU, cpu_seconds),
+        (resource.RLIMIT_AS, MEMORY_BYTES),
+        (resource.RLIMIT_FSIZE, 0),
+        (resource.RLIMIT_NOFILE, 0),
+        (resource.RLIMIT_NPROC, 0),
+    ]
+    for limit, value in limits:
+        try:
+            resource.setrlimit(limit, (value, value))
+        except (ValueError, OSError):
+            pass
+
+def main():
+    cpu_seconds = int(float(sys.argv[1])) + 1 if len(sys.argv) > 1 else 61
+    stdin = sys.stdin
+    # The result goes to a copy of stdout taken before the limits apply;
+    # anything the rule prints is discarded
+    result_out = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout = sys.stderr = io.StringIO()
+    _confine(cpu_seconds)
+
+    rule = json.loads(stdin.readline())
+    safe_builtins = {k: v for k, v in vars(builtins).items() if k not in BLOCKED_BUILTINS}
+    safe_builtins["__import__"] = _import
+    namespace = {"__builtins__": safe_builtins, "__name__": "panther_rule"}
+    result = {"events": 0, "hits": 0, "sample_hits": []}
+    try:
+        exec(compile(rule, "<rule>", "exec"), namespace)
+        if not callable(namespace.get("rule")):
+            raise NameError("the rule does not define rule(event)")
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        result_out.write(json.dumps(result))
+        return
+
+    errors, first_error = 0, None
+    started = time.perf_counter()
+    for line in stdin:
+        event = json.loads(line)
+        result["events"] += 1
+        try:
+            matched = namespace["rule"](PantherEvent(event))
+        except Exception as e:
+            errors += 1
+            first_error = first_error or f"{type(e).__name__}: {e}"
+            continue
+        if matched:
+            result["hits"] += 1
+            if len(result["sample_hits"]) < SAMPLE_HITS:
+                result["sample_hits"].append(event)
+        # Whatever the rule prints is thrown away; keep the buffer small
+        if sys.stdout.tell() > 1024 * 1024:
+            sys.stdout.seek(0)
+            sys.stdout.truncate()
+    result["seconds"] = time.perf_counter() - started
+    if errors:
+        result["rule_errors"] = errors
+        result["first_error"] = first_error
+    result_out.write(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
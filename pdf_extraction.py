@@ -0,0 +1,93 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from cache import DiskCache
+
+# Extracted text keyed by file hash and page selection, so Streamlit reruns and
+# repeat batch runs never parse the same PDF twice
+pdf_cache = DiskCache("pdf_text", ttl=30 * 24 * 3600, max_bytes=500 * 1024 * 1024)
+
+# Smallest page range handed to a worker process; below this the cost of
+# starting a process outweighs the parallelism
+PAGES_PER_TASK = 16
+
+CHUNK_SIZE = 1024 * 1024
+
+def file_digest(fileobj):
+    # Hash a binary file object in fixed-size blocks without loading it whole
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for block in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+        digest.update(block)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def spool_to_temp_file(fileobj):
+    # Copy an upload to disk in blocks so fitz can open it by path instead of
+    # from another full in-memory copy of the bytes
+    fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        shutil.copyfileobj(fileobj, tmp, CHUNK_SIZE)
+    fileobj.seek(0)
+    return tmp.name
+
+def parse_page_range(page_range, page_count):
+    # "1-5, 8, 10-" -> zero-based page numbers; an empty selection means all pages
+    if not page_range or not page_range.strip():
+        return list(range(page_count))
+    pages = set()
+    for part in page_range.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        try:
+            first = int(start) if start.strip() else 1
+            last = (int(end) if end.strip() else page_count) if "-" in part else first
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part!r}")
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page range: {part!r}")
+        pages.update(range(first - 1, min(last, page_count)))
+    return sorted(pages)
+
+def _extract_pages(path, pages):
+    import fitz
+    with fitz.open(path) as pdf_document:
+        return "".join(pdf_document.load_page(page_num).get_text() for page_num in pages)
+
+def extract_pdf_text(path, pages):
+    # Split the selected pages into contiguous batches and extract them across
+    # a process pool; results are joined once in page order. Workers are
+    # spawned rather than forked, since the Streamlit server and the batch CLI
+    # call this from multi-threaded processes
+    tasks = [pages[i:i + PAGES_PER_TASK] for i in range(0, len(pages), PAGES_PER_TASK)]
+    if len(tasks) <= 1:
+        return _extract_pages(path, pages)
+    with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1), mp_context=multiprocessing.get_context("spawn")) as executor:
+        return "".join(executor.map(_extract_pages, [path] * len(tasks), tasks))
+
+def get_page_count(path):
+    import fitz
+    with fitz.open(path) as pdf_document:
+        return pdf_document.page_count
+
+def extract_pdf(fileobj, page_range=""):
+    # Return (text, page_count) for a binary PDF file object, using the cache
+    # when this file and page selection have been extracted before
+    key = pdf_cache.key(file_digest(fileobj), "".join((page_range or "").split()))
+    cached = pdf_cache.get(key)
+    if cached is not None:
+        return cached["text"], cached["page_count"]
+
+    path = spool_to_temp_file(fileobj)
+    try:
+        page_count = get_page_count(path)
+        text = extract_pdf_text(path, parse_page_range(page_range, page_count))
+    finally:
+        os.remove(path)
+    pdf_cache.put(key, {"text": text, "page_count": page_count})
+    return text, page_count
@@ -0,0 +1,355 @@
+import re
+import json
+import asyncio
+from string import Formatter
+from config import step_outputs, repair_prompt
+from validators import validate_rule, syntax_check_summary
+from replay import replay_rule, replay_summary
+
+ANALYSIS_STEP_NAME = "Analyze Threat Intel"
+
+# Names of the per-detection steps that follow the step 1 analysis
+STEP_NAMES = {
+    2: "Create Detection Rule",
+    3: "Develop Investigation Guide",
+    4: "Quality Assurance Review",
+    5: "Final Summary",
+}
+RULE_STEP = 2
+QA_STEP = 4
+REPAIR_STEP_NAME = "Repair Detection Rule"
+
+DETECTION_FIELDS = ("name", "behavior", "log_evidence", "context")
+
+class DetectionStreamParser:
+    """Incremental parser for the JSON array the step 1 prompt asks for.
+
+    Text is fed in as it streams; each top-level object is decoded as soon as
+    its closing brace arrives, so detections are available before the whole
+    analysis has finished.
+    """
+
+    def __init__(self):
+        self.detections = []
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        # Returns the detections completed by this piece of text
+        found = []
+        for char in text:
+            if self._depth:
+                self._buffer.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._depth:
+                self._in_string = True
+            elif char == "{":
+                if not self._depth:
+                    self._buffer = [char]
+                self._depth += 1
+            elif char == "}" and self._depth:
+                self._depth -= 1
+                if not self._depth:
+                    detection = _to_detection("".join(self._buffer))
+                    if detection:
+                        found.append(detection)
+        self.detections.extend(found)
+        return found
+
+def _to_detection(text):
+    try:
+        obj = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(obj, dict) or not obj.get("name"):
+        return None
+    return {field: obj.get(field, "") if isinstance(obj.get(field, ""), str) else json.dumps(obj[field])
+            for field in DETECTION_FIELDS}
+
+def _parse_numbered_detections(analysis):
+    # Fallback for analyses in the older "1. Detection Name: ..." text format
+    labels = {"Threat Behavior:": "behavior", "Log Evidence:": "log_evidence", "Context:": "context"}
+    start = re.compile(r"^(\d+\.\s*)?Detection Name:" if "Detection Name:" in analysis else r"^\d+\.\s")
+    detections, current, field = [], None, None
+    for line in analysis.split("\n"):
+        stripped_line = line.strip()
+        if start.match(stripped_line):
+            current = {"name": start.sub("", stripped_line).strip(), "behavior": "", "log_evidence": "", "context": ""}
+            detections.append(current)
+            field = None
+        elif current is not None:
+            label = next((label for label in labels if stripped_line.startswith(label)), None)
+            if label:
+                field = labels[label]
+                current[field] = stripped_line[len(label):].strip()
+            elif field and stripped_line:
+                current[field] += " " + stripped_line
+    return [d for d in detections if d["name"]]
+
+def parse_detections(analysis):
+    # Parse the step 1 output into detection dicts
+    parser = DetectionStreamParser()
+    parser.feed(analysis)
+    return parser.detections or _parse_numbered_detections(analysis)
+
+def no_detections(analysis):
+    # True when step 1 returned the empty JSON array its prompt asks for when
+    # the intel has nothing to detect, so steps 2-5 are not run on it
+    text = re.sub(r"^```[a-z]*\s*|\s*```$", "", analysis.strip())
+    try:
+        return json.loads(text) == []
+    except ValueError:
+        return False
+
+def detections_from_analysis(analysis):
+    # Detections to run steps 2-5 for: the parsed ones, none for an empty
+    # array, or the whole analysis as one detection when nothing parses
+    if no_detections(analysis):
+        return []
+    return parse_detections(analysis) or [entire_analysis_detection(analysis)]
+
+def entire_analysis_detection(analysis):
+    # Fallback used when no individual detections could be parsed
+    return {"name": "Entire Analysis", "behavior": analysis, "log_evidence": "", "context": ""}
+
+def format_detections(detections):
+    # Render detections as the JSON array the step 1 prompt asks for
+    return json.dumps(detections, indent=2)
+
+def _name_tokens(name):
+    return set(re.findall(r"[a-z0-9]+", name.lower()))
+
+def merge_detections(detection_lists, similarity=0.8):
+    # De-duplicate detections found in several chunks by name overlap, keeping
+    # the most detailed description of each
+    merged = []
+    for detections in detection_lists:
+        for detection in detections:
+            tokens = _name_tokens(detection["name"])
+            for i, existing in enumerate(merged):
+                existing_tokens = _name_tokens(existing["name"])
+                union = tokens | existing_tokens
+                if union and len(tokens & existing_tokens) / len(union) >= similarity:
+                    if len(detection["behavior"]) + len(detection["log_evidence"]) > len(existing["behavior"]) + len(existing["log_evidence"]):
+                        merged[i] = detection
+                    break
+            else:
+                merged.append(detection)
+    return merged
+
+def split_into_chunks(text, chunk_tokens, count_tokens):
+    # Pack paragraphs into chunks of at most chunk_tokens; paragraphs that are
+    # too large on their own are cut into proportionally sized pieces
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in text.split("\n\n"):
+        tokens = count_tokens(paragraph)
+        pieces = [(paragraph, tokens)]
+        if tokens > chunk_tokens:
+            size = max(1, len(paragraph) * chunk_tokens // tokens)
+            pieces = [(paragraph[i:i+size], count_tokens(paragraph[i:i+size])) for i in range(0, len(paragraph), size)]
+        for piece, piece_tokens in pieces:
+            if current and current_tokens + piece_tokens > chunk_tokens:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+async def analyze_intel(prompts, intel_context, llm, chunk_tokens=None, count_tokens=None, max_concurrency=4, on_progress=None):
+    # Step 1. Documents larger than chunk_tokens are split and analyzed in
+    # parallel (map), then the extracted detections are merged (reduce), so
+    # latency tracks the largest chunk rather than the whole document.
+    document = "\n\n".join(part for part in (intel_context["file_content"], intel_context["scraped_content"]) if part)
+    if not chunk_tokens or not document or count_tokens(document) <= chunk_tokens:
+        return await llm(prompts[0].format(**intel_context), ANALYSIS_STEP_NAME)
+
+    chunks = split_into_chunks(document, chunk_tokens, count_tokens)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def analyze_chunk(index, chunk):
+        async with semaphore:
+            if on_progress:
+                on_progress(index, len(chunks), "running")
+            result = await llm(prompts[0].format(**dict(intel_context, file_content=chunk, scraped_content="")), ANALYSIS_STEP_NAME)
+            if on_progress:
+                on_progress(index, len(chunks), "complete")
+            return result
+
+    analyses = await asyncio.gather(*(analyze_chunk(i, chunk) for i, chunk in enumerate(chunks)))
+    detections = merge_detections(parse_detections(analysis) for analysis in analyses)
+    if not detections:
+        return "[]" if all(no_detections(analysis) for analysis in analyses) else "\n\n".join(analyses)
+    return format_detections(detections)
+
+def template_fields(prompt):
+    return {field for _, field, _, _ in Formatter().parse(prompt) if field}
+
+def step_dependencies(prompts):
+    # Map each step number to the earlier steps whose outputs its template uses
+    return {
+        i: sorted(step_outputs[field] for field in template_fields(prompt) if field in step_outputs)
+        for i, prompt in enumerate(prompts, 1)
+    }
+
+def build_step_context(base_context, detection, results, examples=None, fields=None):
+    # Merge the shared inputs with the outputs of the steps completed so far.
+    # `examples` holds the per-detection fields (retrieved library examples).
+    # Checks on the rule are only run when `fields` (if given) asks for them.
+    context = dict(base_context, library_examples="")
+    context.update(examples or {})
+    context.update({
+        "previous_analysis": detection,
+        "previous_detection_rule": results.get(2, ""),
+        "previous_investigation_steps": results.get(3, ""),
+        "previous_qa_findings": results.get(4, "")
+    })
+    language = context.get("detection_language")
+    if RULE_STEP in results and (fields is None or "syntax_check" in fields):
+        context["syntax_check"] = syntax_check_summary(results[RULE_STEP], language)
+    if RULE_STEP in results and (fields is None or "replay_results" in fields):
+        # Replay results are memoized, so only the first step to ask pays for the run
+        context["replay_results"] = replay_summary(results[RULE_STEP], language, context.get("replay_logs"))
+    return context
+
+def repair_request(rule_output, language, errors):
+    # Prompt asking for a targeted fix of the errors the local validator found
+    return repair_prompt.format(
+        detection_language=language,
+        validation_errors="\n".join(f"- {error}" for error in errors),
+        previous_detection_rule=rule_output
+    )
+
+def pick_repair(rule_output, errors, repaired_output, language):
+    # Keep the repaired rule only if it validates with fewer errors
+    repaired_errors = validate_rule(repaired_output, language) if repaired_output else None
+    if repaired_errors is not None and len(repaired_errors) < len(errors):
+        return repaired_output
+    return rule_output
+
+def skipped_qa_report(rule_output, language):
+    # Stands in for the QA review when the rule does not even parse, so no
+    # tokens are spent reviewing logic that cannot run. None when it parses.
+    errors = validate_rule(rule_output, language)
+    if not errors:
+        return None
+    findings = "\n".join(f"- {error}" for error in errors)
+    return (f"## QA Review Skipped\n\nThe detection rule failed local {language} syntax validation, even after a repair attempt:\n\n"
+            f"{findings}\n\nSyntactic Correctness: 0/10. Total score: 0/100. "
+            "The rule is not ready for deployment; fix the errors above and run the QA review again.")
+
+async def run_detection_steps(prompts, detection, base_context, llm, results=None, on_progress=None, select_examples=None):
+    # Run steps 2-5 for a single detection as a dependency graph: each step
+    # waits only for the steps its template consumes, and gets only the fields
+    # it references. Step 1 is the detection itself, so it is always satisfied.
+    results = {} if results is None else results
+    dependencies = step_dependencies(prompts)
+    examples = select_examples(detection) if select_examples else None
+    tasks = {}
+
+    async def run_step(i):
+        await asyncio.gather(*(tasks[d] for d in dependencies[i] if d in tasks))
+        if i in results:
+            return
+        language = base_context.get("detection_language")
+        fields = template_fields(prompts[i-1])
+        if "replay_results" in fields and base_context.get("replay_logs"):
+            # Replaying can take seconds, so run it off the event loop
+            await asyncio.to_thread(replay_rule, results.get(RULE_STEP), language, base_context["replay_logs"])
+        context = {k: v for k, v in build_step_context(base_context, detection, results, examples, fields).items() if k in fields}
+        if on_progress:
+            on_progress(i, "running")
+        report = skipped_qa_report(results.get(RULE_STEP), language) if i == QA_STEP else None
+        if report:
+            results[i] = report
+        else:
+            result = await llm(prompts[i-1].format(**context), STEP_NAMES[i])
+            errors = validate_rule(result, language) if i == RULE_STEP else None
+            if errors:
+                result = pick_repair(result, errors, await llm(repair_request(result, language, errors), REPAIR_STEP_NAME), language)
+            results[i] = result
+        if on_progress:
+            on_progress(i, "complete")
+
+    # Steps are created in order so every dependency's task already exists
+    for i in STEP_NAMES:
+        tasks[i] = asyncio.ensure_future(run_step(i))
+    try:
+        await asyncio.gather(*tasks.values())
+    except Exception:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return results
+
+async def run_all_detections(prompts, detections, base_context, llm, max_concurrency=4, on_progress=None, results=None, select_examples=None):
+    # Fan out every detection at once; the semaphore caps in-flight LLM calls.
+    # `results` optionally holds one dict per detection with steps already done.
+    results = [{} for _ in detections] if results is None else results
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def limited_llm(prompt, step):
+        async with semaphore:
+            return await llm(prompt, step)
+
+    async def run_one(index, detection):
+        progress = (lambda step, status: on_progress(index, step, status)) if on_progress else None
+        try:
+            await run_detection_steps(prompts, detection, base_context, limited_llm, results[index], progress, select_examples)
+            return {"detection": detection, "results": results[index], "error": None}
+        except Exception as e:
+            if on_progress:
+                on_progress(index, None, "failed")
+            return {"detection": detection, "results": results[index], "error": str(e)}
+
+    return await asyncio.gather(*(run_one(i, d) for i, d in enumerate(detections)))
+
+async def process_threat_intel(prompts, intel_context, step_context, llm, max_concurrency=4, state=None, on_checkpoint=None, chunk_tokens=None, count_tokens=None,
+                               select_examples=None, dedup=None, source=None, skip_duplicates=True):
+    # Run the full five-prompt chain for one piece of intel. `state` holds the
+    # work finished so far and on_checkpoint is called after every step, so an
+    # interrupted run can resume without repeating completed LLM calls.
+    # With a `dedup` index, near-duplicates of detections processed before or
+    # earlier in the same analysis are recorded in state["duplicates"] (and
+    # skipped unless skip_duplicates is False); the others are added to the
+    # index under `source` as soon as they are accepted.
+    state = {} if state is None else state
+    checkpoint = on_checkpoint or (lambda state: None)
+
+    if "analysis" not in state:
+        state["analysis"] = await analyze_intel(prompts, intel_context, llm, chunk_tokens, count_tokens, max_concurrency)
+        checkpoint(state)
+
+    if "detections" not in state:
+        detections = detections_from_analysis(state["analysis"])
+        state["duplicates"] = []
+        if dedup:
+            # Accepted detections are indexed right away, so other reports
+            # running at the same time skip their near-duplicates too. One
+            # that fails stays indexed, since re-running the item resumes it.
+            matches = dedup.check(detections, source, record=True)
+            for detection, match in zip(detections, matches):
+                if match:
+                    state["duplicates"].append({"detection": detection, "duplicate_of": match})
+            if skip_duplicates:
+                duplicates = [d["detection"] for d in state["duplicates"]]
+                detections = [d for d in detections if d not in duplicates]
+        state["detections"] = detections
+        state["results"] = [{} for _ in state["detections"]]
+        checkpoint(state)
+
+    def on_progress(index, step, status):
+        if status == "complete":
+            checkpoint(state)
+
+    outcomes = await run_all_detections(prompts, state["detections"], step_context, llm, max_concurrency, on_progress, state["results"], select_examples)
+    return outcomes
@@ -0,0 +1,377 @@
+import os
+import re
+import sys
+import json
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+from cache import DiskCache
+from validators import extract_rule, SQL_DIALECTS
+from log_samples import LINE_SUFFIXES, PARQUET_SUFFIXES, LOG_SUFFIXES, base_name, read_events
+
+# Runs the rule written in step 2 against sample logs, so the QA review can use
+# measured hit counts instead of guessing. SQL rules are executed by DuckDB over
+# the log files directly; Sigma rules are compiled into Python predicates once
+# and evaluated while the logs are streamed.
+#
+# Panther rules are generated Python, so they are only replayed when
+# DIANA_REPLAY_PANTHER=1, and then in a confined child process (see
+# panther_sandbox.py) that is killed if it outlives the time limit.
+REPLAY_TIMEOUT = float(os.getenv("REPLAY_TIMEOUT", 60))
+REPLAY_MAX_EVENTS = int(os.getenv("REPLAY_MAX_EVENTS", 10_000_000))
+PANTHER_REPLAY = os.getenv("DIANA_REPLAY_PANTHER") == "1"
+SANDBOX_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "panther_sandbox.py")
+SANDBOX_GRACE = 5  # seconds a sandbox gets to report after its input ends
+SAMPLE_HITS = 3
+# Part of the cache key; bump when a change to the engines changes results
+ENGINE_VERSION = 2
+
+# Results are stored on disk, so the QA prompt built from them is the same
+# after a restart and in every job worker, and the LLM response cache and
+# run state keep matching it
+replay_cache = DiskCache("replay_results", ttl=30 * 24 * 3600, max_bytes=50 * 1024 * 1024)
+
+ENGINES = {}
+
+def engine(*languages):
+    def decorator(func):
+        for language in languages:
+            ENGINES[language] = func
+        return func
+    return decorator
+
+def log_files(path):
+    # Log files under a file or directory path, in a stable order
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for root, _, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names if base_name(name).endswith(LOG_SUFFIXES))
+    return sorted(files)
+
+def _signature(files):
+    return [(f, os.path.getmtime(f), os.path.getsize(f)) for f in files]
+
+def iter_events(files):
+    # Stream events from every file in constant memory (see log_samples.py)
+    for path in files:
+        yield from read_events(path)
+
+def field_value(event, name):
+    # Sigma and Panther address nested fields with dotted paths
+    if name in event:
+        return event[name]
+    value = event
+    for part in name.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+def _evaluate(files, predicate):
+    # Batched evaluation of a compiled predicate over the streamed events
+    started = time.perf_counter()
+    deadline = started + REPLAY_TIMEOUT
+    events = hits = errors = 0
+    samples, first_error, stopped = [], None, None
+    for event in iter_events(files):
+        if events >= REPLAY_MAX_EVENTS:
+            stopped = f"event limit of {REPLAY_MAX_EVENTS}"
+            break
+        if events % 10000 == 0 and time.perf_counter() > deadline:
+            stopped = f"time limit of {REPLAY_TIMEOUT:g}s"
+            break
+        events += 1
+        try:
+            matched = predicate(event)
+        except Exception as e:
+            errors += 1
+            first_error = first_error or f"{type(e).__name__}: {e}"
+            continue
+        if matched:
+            hits += 1
+            if len(samples) < SAMPLE_HITS:
+                samples.append(event)
+    result = {"events": events, "hits": hits, "seconds": time.perf_counter() - started, "sample_hits": samples}
+    if errors:
+        result["rule_errors"] = errors
+        result["first_error"] = first_error
+    if stopped:
+        result["stopped"] = stopped
+    return result
+
+def _sql_replay(dialect):
+    def replay(rule, files):
+        import duckdb
+        import sqlglot
+        from sqlglot import exp
+
+        statement = [s for s in sqlglot.parse(rule, read=dialect) if s is not None][-1]
+        # Every table the rule reads (other than its own CTEs) becomes the log
+        # view, aliased to the name the rule uses for it so qualified columns
+        # (ct.eventName, cloudtrail_logs.eventName) still resolve
+        ctes = {cte.alias_or_name for cte in statement.find_all(exp.CTE)}
+
+        def to_logs(node):
+            if isinstance(node, exp.Table) and node.name not in ctes:
+                return exp.to_table("logs").as_(node.alias_or_name)
+            if isinstance(node, exp.Column) and node.table:
+                # db.table.column keeps only the table part
+                node = node.copy()
+                node.set("db", None)
+                node.set("catalog", None)
+            return node
+        statement = statement.transform(to_logs)
+        query = statement.sql(dialect="duckdb")
+
+        conn = duckdb.connect()
+        sources = []
+        for path in files:
+            name = base_name(path)
+            quoted = path.replace("'", "''")
+            if name.endswith(PARQUET_SUFFIXES):
+                source = f"SELECT * FROM read_parquet('{quoted}')"
+            else:
+                fmt = "newline_delimited" if name.endswith(LINE_SUFFIXES) else "auto"
+                source = f"SELECT * FROM read_json_auto('{quoted}', format='{fmt}', ignore_errors=true)"
+                if [c[0] for c in conn.execute(f"DESCRIBE {source}").fetchall()] == ["Records"]:
+                    source = f"SELECT r.* FROM (SELECT unnest(Records) AS r FROM ({source}))"
+            sources.append(source)
+        conn.execute("CREATE VIEW logs AS " + " UNION ALL BY NAME ".join(sources))
+
+        # DuckDB queries can be interrupted from another thread
+        timer = threading.Timer(REPLAY_TIMEOUT, conn.interrupt)
+        timer.start()
+        started = time.perf_counter()
+        try:
+            events = conn.execute("SELECT count(*) FROM logs").fetchone()[0]
+            hits = conn.execute(f"SELECT count(*) FROM ({query})").fetchone()[0]
+            result = conn.execute(f"SELECT * FROM ({query}) LIMIT {SAMPLE_HITS}")
+            columns = [c[0] for c in result.description]
+            samples = [dict(zip(columns, row)) for row in result.fetchall()]
+        finally:
+            timer.cancel()
+        return {"events": events, "hits": hits, "seconds": time.perf_counter() - started, "sample_hits": samples}
+    return replay
+
+for language, dialect in SQL_DIALECTS.items():
+    engine(language)(_sql_replay(dialect))
+
+def _sigma_pattern(value, modifiers):
+    if "re" in modifiers:
+        return re.compile(str(value))
+    # Sigma values are case-insensitive, with * and ? wildcards
+    body = "".join(".*" if c == "*" else "." if c == "?" else re.escape(c) for c in str(value))
+    if "contains" in modifiers:
+        pattern = body
+    elif "startswith" in modifiers:
+        pattern = "^" + body
+    elif "endswith" in modifiers:
+        pattern = body + "$"
+    else:
+        pattern = "^" + body + "$"
+    return re.compile(pattern, re.IGNORECASE | re.DOTALL)
+
+def _sigma_field(key, values):
+    name, *modifiers = key.split("|")
+    unsupported = set(modifiers) - {"contains", "startswith", "endswith", "all", "re", "exists"}
+    if unsupported:
+        raise ValueError(f"Sigma modifier(s) {', '.join(sorted(unsupported))} are not supported by replay")
+    values = values if isinstance(values, list) else [values]
+    if "exists" in modifiers:
+        return lambda event: (field_value(event, name) is not None) == bool(values[0])
+    patterns = [None if v is None else _sigma_pattern(v, modifiers) for v in values]
+    combine = all if "all" in modifiers else any
+
+    def matches(event):
+        value = field_value(event, name)
+        candidates = value if isinstance(value, list) else [value]
+        return combine(
+            any(c is None for c in candidates) if p is None else any(c is not None and p.search(str(c)) for c in candidates)
+            for p in patterns
+        )
+    return matches
+
+def _sigma_selection(selection):
+    if isinstance(selection, dict):
+        fields = [_sigma_field(k, v) for k, v in selection.items()]
+        return lambda event: all(f(event) for f in fields)
+    if isinstance(selection, list) and all(isinstance(s, dict) for s in selection):
+        alternatives = [_sigma_selection(s) for s in selection]
+        return lambda event: any(a(event) for a in alternatives)
+    # Keyword lists match anywhere in the event
+    keywords = [_sigma_pattern(k, {"contains"}) for k in (selection if isinstance(selection, list) else [selection])]
+    return lambda event: any(k.search(json.dumps(event, default=str)) for k in keywords)
+
+def _sigma_condition(condition, selections):
+    tokens = re.findall(r"\(|\)|[^\s()]+", condition)
+    position = 0
+
+    def peek():
+        return tokens[position].lower() if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+
+    def matching(pattern):
+        names = [n for n in selections if re.match("^" + re.escape(pattern).replace(r"\*", ".*") + "$", n)] \
+            if pattern != "them" else list(selections)
+        if not names:
+            raise ValueError(f"Condition references '{pattern}', which is not defined under 'detection'")
+        return [selections[n] for n in names]
+
+    def factor():
+        token = take()
+        lowered = token.lower()
+        if lowered == "not":
+            inner = factor()
+            return lambda event: not inner(event)
+        if token == "(":
+            inner = expression()
+            take()
+            return inner
+        if lowered in ("1", "any", "all") and peek() == "of":
+            take()
+            group = matching(take())
+            combine = all if lowered == "all" else any
+            return lambda event: combine(s(event) for s in group)
+        group = matching(token)
+        return group[0] if len(group) == 1 else (lambda event: any(s(event) for s in group))
+
+    def term():
+        left = factor()
+        while peek() == "and":
+            take()
+            left = (lambda a, b: lambda event: a(event) and b(event))(left, factor())
+        return left
+
+    def expression():
+        left = term()
+        while peek() == "or":
+            take()
+            left = (lambda a, b: lambda event: a(event) or b(event))(left, term())
+        return left
+
+    return expression()
+
+@engine("Sigma Rules")
+def replay_sigma(rule, files):
+    import yaml
+    document = next(iter(yaml.safe_load_all(rule)))
+    detection = dict(document["detection"])
+    condition = detection.pop("condition")
+    selections = {name: _sigma_selection(selection) for name, selection in detection.items()}
+    conditions = [_sigma_condition(str(c).split("|")[0], selections) for c in (condition if isinstance(condition, list) else [condition])]
+    result = _evaluate(files, lambda event: any(c(event) for c in conditions))
+    if any("|" in str(c) for c in (condition if isinstance(condition, list) else [condition])):
+        result["note"] = "Aggregations after '|' in the condition were not applied; hits are events matching the base condition."
+    return result
+
+@engine("Panther (Python)")
+def replay_panther(rule, files):
+    # Events are fed to the sandbox over stdin, so it never opens the log
+    # files itself; it starts with no environment (no API keys) in an empty
+    # working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(
+            [sys.executable, "-I", "-S", SANDBOX_SCRIPT, str(REPLAY_TIMEOUT)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env={}, cwd=workdir, text=True, encoding="utf-8"
+        )
+        killer = threading.Timer(REPLAY_TIMEOUT + SANDBOX_GRACE, process.kill)
+        killer.start()
+        deadline = time.perf_counter() + REPLAY_TIMEOUT
+        events, stopped = 0, None
+        try:
+            process.stdin.write(json.dumps(rule) + "\n")
+            for event in iter_events(files):
+                if events >= REPLAY_MAX_EVENTS:
+                    stopped = f"event limit of {REPLAY_MAX_EVENTS}"
+                    break
+                if events % 10000 == 0 and time.perf_counter() > deadline:
+                    stopped = f"time limit of {REPLAY_TIMEOUT:g}s"
+                    break
+                process.stdin.write(json.dumps(event, default=str, separators=(",", ":")) + "\n")
+                events += 1
+            process.stdin.close()
+        except OSError:
+            # The sandbox exited early (the rule failed to load) or was killed
+            pass
+        try:
+            output = process.stdout.read()
+            process.wait()
+        finally:
+            killer.cancel()
+            process.stdout.close()
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    if process.returncode in (-signal.SIGKILL, -getattr(signal, "SIGXCPU", signal.SIGKILL)):
+        return {"error": f"the rule did not finish within the {REPLAY_TIMEOUT:g}s replay time limit"}
+    if process.returncode != 0 or not output:
+        return {"error": f"the replay sandbox exited with status {process.returncode}"}
+    result = json.loads(output)
+    if stopped and "error" not in result:
+        result["stopped"] = stopped
+    return result
+
+def replay_engine(language):
+    # Engine for a detection language, or None when it cannot be replayed here
+    if language == "Panther (Python)" and not PANTHER_REPLAY:
+        return None
+    return ENGINES.get(language)
+
+def replay_rule(rule_output, language, path):
+    # Result dict for the rule in a step 2 output, or None when there is
+    # nothing to replay. Results are cached on the rule and the log files.
+    replay = replay_engine(language)
+    rule = extract_rule(rule_output or "")
+    if replay is None or rule is None or not path or not os.path.exists(path):
+        return None
+    files = log_files(path)
+    if not files:
+        return None
+    key = replay_cache.key(ENGINE_VERSION, language, rule, _signature(files))
+    result = replay_cache.get(key)
+    if result is not None:
+        return result
+    try:
+        result = replay(rule, files)
+    except ImportError as e:
+        # Not cached, so installing the engine takes effect right away
+        return {"error": f"replay engine not installed ({e.name})", "files": len(files)}
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    result["files"] = len(files)
+    # Round-trip through JSON so fresh and cached results format identically
+    result = json.loads(json.dumps(result, default=str))
+    replay_cache.put(key, result)
+    return result
+
+def replay_summary(rule_output, language, path):
+    # Text for the QA prompt describing the replay outcome. Only counts and
+    # sample hits go in; timing varies between runs and is shown in the UI.
+    if not path:
+        return "No sample logs were provided for replay; estimate false positive rates and performance from the rule itself."
+    result = replay_rule(rule_output, language, path)
+    if result is None:
+        return f"The rule could not be replayed locally ({language} rules are not replayed here, or no log files were found)."
+    if "error" in result:
+        return f"Replaying the rule against the sample logs failed: {result['error']}"
+    rate = result["hits"] / result["events"] if result["events"] else 0.0
+    lines = [f"Replayed against {result['events']:,} events from {result['files']} log file(s): "
+             f"{result['hits']:,} hits ({rate:.4%} of events)."]
+    if result.get("stopped"):
+        lines.append(f"Replay stopped early at the {result['stopped']}.")
+    if result.get("rule_errors"):
+        lines.append(f"The rule raised an error on {result['rule_errors']:,} events, first: {result['first_error']}")
+    if result.get("note"):
+        lines.append(result["note"])
+    for sample in result["sample_hits"]:
+        lines.append("Sample hit: " + json.dumps(sample, default=str, separators=(",", ":"))[:500])
+    return "\n".join(lines)
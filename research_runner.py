@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Only the most recent progress events are kept per job, so long research runs
+# stay cheap to hold in memory and to render
+MAX_EVENTS = 200
+
+# Research crews run in long-lived threads inside the app process, so crewai and
+# langchain are imported once, on first use, instead of once per query
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RESEARCH_WORKERS", 2)), thread_name_prefix="research")
+
+class ResearchJob:
+    """A research query running in the background worker pool.
+
+    Progress is recorded as structured events in a bounded buffer that the UI
+    can poll without blocking the crew.
+    """
+
+    def __init__(self, query, model, use_cache=True):
+        self.query = query
+        self.model = model
+        self.use_cache = use_cache
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.event_count = 0
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self._events = deque(maxlen=MAX_EVENTS)
+        self._lock = threading.Lock()
+
+    def add_event(self, kind, agent, detail):
+        with self._lock:
+            self.event_count += 1
+            self._events.append({"time": time.time(), "kind": kind, "agent": agent, "detail": detail})
+
+    def events(self, last=None):
+        with self._lock:
+            events = list(self._events)
+        return events[-last:] if last else events
+
+def _truncate(text, limit=300):
+    text = " ".join(str(text).split())
+    return text if len(text) <= limit else text[:limit] + "..."
+
+def record_step(job, agent, step):
+    # crewai hands step callbacks either a single action/finish object or a
+    # list of (action, observation) pairs depending on the version
+    steps = step if isinstance(step, list) else [step]
+    for item in steps:
+        action = item[0] if isinstance(item, tuple) else item
+        tool = getattr(action, "tool", None)
+        if tool:
+            job.add_event("tool_call", agent, f"{tool}: {_truncate(getattr(action, 'tool_input', ''))}")
+        else:
+            output = getattr(action, "output", None) or getattr(action, "return_values", None) or getattr(action, "log", "")
+            job.add_event("iteration", agent, _truncate(output))
+
+def record_task(job, task_output):
+    agent = getattr(task_output, "agent", "") or ""
+    job.add_event("task_complete", agent, _truncate(getattr(task_output, "description", "") or task_output, 120))
+
+def _run(job):
+    from threat_research import perform_threat_research
+    job.status = "running"
+    job.started_at = time.time()
+    job.add_event("started", "", f"Researching: {job.query}")
+    try:
+        job.result = str(perform_threat_research(
+            job.query, job.model,
+            step_callback=lambda agent, step: record_step(job, agent, step),
+            task_callback=lambda task_output: record_task(job, task_output),
+            use_cache=job.use_cache
+        ))
+        job.status = "complete"
+        job.add_event("finished", "", "Research completed")
+    except Exception as e:
+        job.error = str(e)
+        job.status = "failed"
+        job.add_event("failed", "", job.error)
+    finally:
+        job.finished_at = time.time()
+        job.done.set()
+
+_warmed_up = False
+
+def _preload():
+    from threat_research import preload
+    preload()
+
+def warm_up():
+    # Import the crew stack in a worker thread ahead of the first query. The app
+    # calls this once a research topic is entered rather than at startup, so
+    # the import does not compete with the first page render.
+    global _warmed_up
+    if not _warmed_up:
+        _warmed_up = True
+        _executor.submit(_preload)
+
+def submit_research(query, model, use_cache=True):
+    job = ResearchJob(query, model, use_cache)
+    _executor.submit(_run, job)
+    return job
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from llm import complete, acomplete, stream_tokens
+from metrics import metrics
+
+# Per-step model routes, e.g. DIANA_ROUTES='{"Final Summary": "gpt-4o-mini"}'.
+# Steps without a route use the model picked in the UI or on the command line.
+DEFAULT_ROUTES = json.loads(os.getenv("DIANA_ROUTES", "{}"))
+
+# A model whose calls fail this many times in a row is skipped for the cooldown.
+# After that it is tried again; one more failure reopens the breaker at once.
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30
+LATENCY_WINDOW = 20
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            return self.opened_at is None or time.time() - self.opened_at >= self.cooldown
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self.opened_at = time.time()
+
+# Breakers are shared by every router in the process, so the UI, the fan-out
+# and batch workers all stop sending to a provider that is down
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def breaker(model):
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker()
+        return _breakers[model]
+
+def recent_latency(step, model):
+    # Median latency of the model's last provider calls for this step
+    latencies = [c["latency"] for c in metrics.recent() if c["step"] == step and c["model"] == model and not c["cache_hit"]]
+    latencies = sorted(latencies[-LATENCY_WINDOW:])
+    return latencies[len(latencies) // 2] if latencies else None
+
+class Router:
+    """Chooses the model for each step and falls back to other models on errors.
+
+    Exposes complete/acomplete/stream_tokens with the same signatures as llm.py,
+    where `model` is the default for steps without a route.
+    """
+
+    def __init__(self, routes=None, fallbacks=(), prefer_fast=False, timeout=None):
+        self.routes = dict(DEFAULT_ROUTES, **(routes or {}))
+        self.fallbacks = list(fallbacks)
+        self.prefer_fast = prefer_fast
+        self.timeout = timeout
+
+    def route(self, step, model):
+        return self.routes.get(step) or model
+
+    def candidates(self, step, model):
+        models = list(dict.fromkeys([self.route(step, model)] + self.fallbacks))
+        if self.prefer_fast:
+            # Models with no recent calls keep their place after the measured ones
+            latencies = {m: recent_latency(step, m) for m in models}
+            models.sort(key=lambda m: (latencies[m] is None, latencies[m] or 0))
+        allowed = [m for m in models if breaker(m).allow()]
+        # With every breaker open, try the preferred model anyway rather than fail outright
+        return allowed or models[:1]
+
+    def _failed(self, model, step, error, remaining):
+        breaker(model).record(False)
+        if not remaining:
+            raise error
+        print(f"{step} [{model}] failed ({type(error).__name__}: {error}), falling back to {remaining[0]}")
+
+    def complete(self, prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None):
+        models = self.candidates(step, model)
+        for i, candidate in enumerate(models):
+            try:
+                result = complete(prompt, candidate, max_tokens, temperature, use_cache, usage, step, self.timeout, not models[i+1:])
+            except Exception as e:
+                self._failed(candidate, step, e, models[i+1:])
+                continue
+            breaker(candidate).record(True)
+            return result
+
+    async def acomplete(self, prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None):
+        models = self.candidates(step, model)
+        for i, candidate in enumerate(models):
+            try:
+                result = await acomplete(prompt, candidate, max_tokens, temperature, use_cache, usage, step, self.timeout, not models[i+1:])
+            except Exception as e:
+                self._failed(candidate, step, e, models[i+1:])
+                continue
+            breaker(candidate).record(True)
+            return result
+
+    def stream_tokens(self, prompt, model, max_tokens, temperature, use_cache=True, usage=None, step=None):
+        # Falling back is only possible until the first token has been shown
+        models = self.candidates(step, model)
+        for i, candidate in enumerate(models):
+            started = False
+            try:
+                for token in stream_tokens(prompt, candidate, max_tokens, temperature, use_cache, usage, step, self.timeout, not models[i+1:]):
+                    started = True
+                    yield token
+            except Exception as e:
+                if started:
+                    breaker(candidate).record(False)
+                    raise
+                self._failed(candidate, step, e, models[i+1:])
+                continue
+            breaker(candidate).record(True)
+            return
@@ -0,0 +1,67 @@
+import os
+import re
+import json
+import uuid
+import threading
+from cache import CACHE_DIR, DiskCache
+
+# Interactive runs are stored one JSON file per run. Step outputs are keyed by a
+# hash of everything that went into the step (the formatted prompt and the model
+# settings), so reruns and browser reconnects reuse finished steps, and editing
+# one input only recomputes the steps whose prompts actually change.
+RUNS_DIR = os.path.join(CACHE_DIR, "runs")
+
+def load_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_json(path, data):
+    # Write to a temp file first so a crash never leaves a truncated file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+class RunState:
+    """Step outputs and UI state of one interactive run, persisted on disk."""
+
+    def __init__(self, run_id, directory=RUNS_DIR):
+        self.run_id = run_id
+        self.path = os.path.join(directory, f"{run_id}.json")
+        data = load_json(self.path)
+        self.outputs = data.get("outputs", {})
+        self.session = data.get("session", {})
+        # JSON object keys are strings; step numbers are ints everywhere else
+        for outcome in self.session.get("all_detection_results") or []:
+            outcome["results"] = {int(step): text for step, text in outcome["results"].items()}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*inputs):
+        return DiskCache.key(*inputs)
+
+    def get(self, key):
+        return self.outputs.get(key)
+
+    def put(self, key, output):
+        with self._lock:
+            self.outputs[key] = output
+            self._save()
+
+    def remember(self, **fields):
+        # Session values to restore when the run is reopened
+        with self._lock:
+            self.session.update(fields)
+            self._save()
+
+    def _save(self):
+        save_json(self.path, {"outputs": self.outputs, "session": self.session})
+
+def open_run(run_id=None):
+    # Run ids come from the page URL, so anything that is not one of ours starts a new run
+    if not run_id or not re.fullmatch(r"[0-9a-f]{32}", run_id):
+        run_id = uuid.uuid4().hex
+    return RunState(run_id)
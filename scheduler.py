@@ -0,0 +1,207 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+
+# Provider quotas, keyed by model name or provider prefix, e.g.
+# DIANA_RATE_LIMITS='{"anthropic": {"rpm": 50, "tpm": 40000}, "gpt-4o-mini": {"rpm": 500, "tpm": 200000}}'
+RATE_LIMITS = json.loads(os.getenv("DIANA_RATE_LIMITS", "{}"))
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))
+# Upper bound on in-flight calls per model; AIMD moves the actual limit below it
+MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 16))
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def provider(model):
+    if "/" in model:
+        return model.split("/", 1)[0]
+    if model.startswith("claude"):
+        return "anthropic"
+    return "openai"
+
+class TokenBucket:
+    # Refills continuously up to one minute's allowance
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        # Requests larger than the whole bucket go through once it is full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.available >= amount else (amount - self.available) * 60 / self.capacity
+
+    def take(self, amount):
+        self.available -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.available = min(self.capacity, self.available + amount)
+
+class ModelLimiter:
+    """RPM/TPM token buckets plus an AIMD concurrency limit for one model.
+
+    Shared by every thread and event loop in the process: state changes happen
+    under a lock and waiting is done by sleeping, never by blocking the lock.
+    """
+
+    def __init__(self, rpm=None, tpm=None, max_in_flight=MAX_IN_FLIGHT):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_in_flight = max_in_flight
+        self.limit = float(max_in_flight)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _try_acquire(self, tokens):
+        # Returns 0 when a slot was taken, otherwise how long to wait before retrying
+        with self._lock:
+            wait = self.paused_until - time.monotonic()
+            if self.in_flight >= int(self.limit):
+                wait = max(wait, 0.05)
+            if self.requests:
+                wait = max(wait, self.requests.wait_time(1))
+            if self.tokens:
+                wait = max(wait, self.tokens.wait_time(tokens))
+            if wait > 0:
+                return wait
+            self.in_flight += 1
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(tokens)
+            return 0.0
+
+    async def acquire(self, tokens):
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens):
+        while True:
+            wait = self._try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def release(self, reserved_tokens=0, used_tokens=None, rate_limited=False, retry_after=None, cancelled=False):
+        with self._lock:
+            self.in_flight -= 1
+            if self.tokens and used_tokens is not None and used_tokens < reserved_tokens:
+                self.tokens.give_back(reserved_tokens - used_tokens)
+            if cancelled:
+                # Says nothing about the provider, so the limit stays where it is
+                return
+            if rate_limited:
+                # Multiplicative decrease, and hold every caller back for Retry-After
+                self.limit = max(1.0, self.limit / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                # Additive increase of about one slot per window of successful calls
+                self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def limiter(model):
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = RATE_LIMITS.get(model) or RATE_LIMITS.get(provider(model)) or {}
+            _limiters[model] = ModelLimiter(limits.get("rpm"), limits.get("tpm"))
+        return _limiters[model]
+
+def status_code(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+def is_rate_limited(error):
+    return status_code(error) == 429 or "RateLimit" in type(error).__name__
+
+def is_timeout(error):
+    return status_code(error) == 408 or "Timeout" in type(error).__name__
+
+def is_retryable(error):
+    name = type(error).__name__
+    return (status_code(error) in RETRYABLE_STATUS or is_rate_limited(error)
+            or any(kind in name for kind in ("Timeout", "APIConnectionError", "ServiceUnavailable", "InternalServerError")))
+
+def retry_after(error):
+    # Seconds from a Retry-After header (delta-seconds or HTTP date), if present
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def backoff(attempt, error):
+    # Full jitter, but never sooner than the provider asked for
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    return max(delay, retry_after(error) or 0.0)
+
+def _give_up(error, attempt, retry_timeouts):
+    return attempt >= MAX_RETRIES or not is_retryable(error) or (is_timeout(error) and not retry_timeouts)
+
+async def ascheduled(model, tokens, call, retry_timeouts=True):
+    # Run `await call()` within the model's limits, retrying transient failures.
+    # call() returns (result, used_tokens). Callers with another model to fall
+    # back to pass retry_timeouts=False, so a timed-out call moves on at once.
+    slot = limiter(model)
+    for attempt in range(MAX_RETRIES + 1):
+        await slot.acquire(tokens)
+        try:
+            result, used = await call()
+        except Exception as e:
+            slot.release(tokens, None, is_rate_limited(e), retry_after(e))
+            if _give_up(e, attempt, retry_timeouts):
+                raise
+            delay = backoff(attempt, e)
+            print(f"[{model}] {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES})")
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # Cancelled, e.g. because a sibling step failed; the slot must
+            # still be freed or the model's limit shrinks for good
+            slot.release(tokens, cancelled=True)
+            raise
+        slot.release(tokens, used)
+        return result
+
+def scheduled(model, tokens, call, retry_timeouts=True, hold=False):
+    # Synchronous counterpart of ascheduled. With hold=True the slot stays
+    # taken once call() succeeds, e.g. while a stream it opened is read; the
+    # caller then releases it with limiter(model).release(tokens, used)
+    slot = limiter(model)
+    for attempt in range(MAX_RETRIES + 1):
+        slot.acquire_sync(tokens)
+        try:
+            result, used = call()
+        except Exception as e:
+            slot.release(tokens, None, is_rate_limited(e), retry_after(e))
+            if _give_up(e, attempt, retry_timeouts):
+                raise
+            delay = backoff(attempt, e)
+            print(f"[{model}] {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES})")
+            time.sleep(delay)
+            continue
+        except BaseException:
+            slot.release(tokens, cancelled=True)
+            raise
+        if not hold:
+            slot.release(tokens, used)
+        return result
@@ -0,0 +1,148 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import RULE_STEP, STEP_NAMES, REPAIR_STEP_NAME, build_step_context, repair_request
+from validators import validate_rule
+from llm import estimate_cost
+
+# While the analyst reads the step 1 detections, step 2 is written in the
+# background for the ones they are most likely to pick. Outputs are stored in
+# the run state under the same keys process_with_llm looks up, so choosing one
+# of those detections shows its rule without waiting for the model.
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SPECULATION_WORKERS", 2)), thread_name_prefix="speculation")
+
+class Speculation:
+    """Background step 2 generation for a ranked list of detections.
+
+    Each call reserves its worst-case cost against `budget` before it starts,
+    so concurrent workers cannot overshoot it. Can be cancelled; calls already
+    in flight finish and are kept in the run state. What the calls spent
+    accumulates until the UI collects it with drain_usage().
+    """
+
+    def __init__(self, key, prompt, step_context, run, router, model, max_tokens, temperature, use_cache=True, budget=None, select_examples=None):
+        self.key = key
+        self.prompt = prompt
+        self.step_context = step_context
+        self.run = run
+        self.router = router
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.use_cache = use_cache
+        self.budget = budget
+        self.select_examples = select_examples
+        self.cost = 0.0
+        self.reserved = 0.0
+        self.usage = {}
+        self.status = {}
+        self._futures = {}
+        self._cancelled = threading.Event()
+        self._keep = None
+        self._lock = threading.Lock()
+
+    def _over_budget(self):
+        with self._lock:
+            return self.budget is not None and self.cost + self.reserved >= self.budget
+
+    def _reserve(self, estimate):
+        with self._lock:
+            if self.budget is not None and self.cost + self.reserved + estimate > self.budget:
+                return False
+            self.reserved += estimate
+            return True
+
+    def _settle(self, estimate, usage):
+        with self._lock:
+            self.reserved -= estimate
+            self.cost += usage.get("cost", 0.0)
+            for field in ("cost", "saved", "prompt_tokens", "cached_tokens"):
+                self.usage[field] = self.usage.get(field, 0) + usage.get(field, 0)
+            self.usage.setdefault("calls", []).extend(usage.get("calls", []))
+
+    def _complete(self, prompt, step):
+        # Returns None without calling the model when the budget cannot cover it
+        model = self.router.route(step, self.model)
+        key = self.run.key(prompt, model, self.max_tokens, self.temperature)
+        output = self.run.get(key)
+        if output is None:
+            estimate = estimate_cost(prompt, model, self.max_tokens)
+            if not self._reserve(estimate):
+                return None
+            usage = {}
+            try:
+                output = self.router.complete(prompt, self.model, self.max_tokens, self.temperature, self.use_cache, usage, step)
+            finally:
+                self._settle(estimate, usage)
+            self.run.put(key, output)
+        return output
+
+    def _wanted(self, name):
+        # False once cancelled, or once the analyst picked another detection
+        return not self._cancelled.is_set() and self._keep in (None, name)
+
+    def _generate(self, detection):
+        name = detection["name"]
+        if not self._wanted(name) or self._over_budget():
+            self.status[name] = "skipped"
+            return
+        self.status[name] = "running"
+        try:
+            # Built exactly like the interactive step 2 so the run state keys match
+            examples = self.select_examples(detection) if self.select_examples else None
+            context = build_step_context(self.step_context, detection, {}, examples)
+            rule = self._complete(self.prompt.format(**context), STEP_NAMES[RULE_STEP])
+            if rule is None:
+                self.status[name] = "skipped"
+                return
+            language = self.step_context.get("detection_language")
+            errors = validate_rule(rule, language)
+            if errors and self._wanted(name) and not self._over_budget():
+                self._complete(repair_request(rule, language, errors), REPAIR_STEP_NAME)
+        except Exception as e:
+            self.status[name] = "failed"
+            print(f"Speculative step 2 for {name} failed: {type(e).__name__}: {e}")
+            return
+        self.status[name] = "ready"
+
+    def start(self, detections):
+        for detection in detections:
+            self.status[detection["name"]] = "queued"
+            self._futures[detection["name"]] = _executor.submit(self._generate, detection)
+        return self
+
+    def wait(self, name):
+        # Block until a started speculation for this detection is done, so the
+        # interactive step reuses it instead of paying for the same call twice
+        future = self._futures.get(name)
+        if future is not None and not future.cancelled():
+            future.exception()
+
+    def cancel(self, keep=None):
+        # Drop queued work and stop starting new calls, except for `keep`
+        if keep is None:
+            self._cancelled.set()
+        else:
+            self._keep = keep
+        for name, future in self._futures.items():
+            if name != keep and future.cancel():
+                self.status[name] = "cancelled"
+
+    def done(self):
+        return all(future.done() for future in self._futures.values())
+
+    def drain_usage(self):
+        # Usage of the calls finished since the last drain, in llm.py's format
+        with self._lock:
+            usage, self.usage = self.usage, {}
+        return usage
+
+    def summary(self):
+        counts = {}
+        for status in self.status.values():
+            counts[status] = counts.get(status, 0) + 1
+        parts = ", ".join(f"{count} {status}" for status, count in counts.items())
+        return f"Pre-generating detection rules: {parts} (${self.cost:.4f} spent)"
+
+def start_speculation(key, prompt, detections, step_context, run, router, model, max_tokens, temperature, use_cache=True, budget=None, select_examples=None):
+    return Speculation(key, prompt, step_context, run, router, model, max_tokens, temperature, use_cache, budget, select_examples).start(detections)
@@ -0,0 +1,36 @@
+import json
+import pytest
+from replay import ENGINES
+
+pytest.importorskip("duckdb")
+pytest.importorskip("sqlglot")
+
+EVENTS = [
+    {"eventName": "ConsoleLogin", "sourceIPAddress": "1.2.3.4"},
+    {"eventName": "ConsoleLogin", "sourceIPAddress": "5.6.7.8"},
+    {"eventName": "GetObject", "sourceIPAddress": "1.2.3.4"},
+]
+
+@pytest.fixture
+def logs(tmp_path):
+    path = tmp_path / "cloudtrail.jsonl"
+    path.write_text("\n".join(json.dumps(event) for event in EVENTS))
+    return [str(path)]
+
+@pytest.mark.parametrize("rule", [
+    "SELECT * FROM cloudtrail_logs WHERE eventName = 'ConsoleLogin'",
+    "SELECT * FROM cloudtrail_logs AS ct WHERE ct.eventName = 'ConsoleLogin'",
+    "SELECT c.sourceIPAddress FROM cloudtrail_logs c WHERE c.eventName = 'ConsoleLogin'",
+    "SELECT * FROM cloudtrail_logs WHERE cloudtrail_logs.eventName = 'ConsoleLogin'",
+    "SELECT * FROM security.cloudtrail_logs WHERE security.cloudtrail_logs.eventName = 'ConsoleLogin'",
+    "WITH logins AS (SELECT * FROM cloudtrail_logs ct WHERE ct.eventName = 'ConsoleLogin') SELECT l.* FROM logins l",
+])
+def test_sql_replay_keeps_aliases_and_qualifiers(rule, logs):
+    result = ENGINES["AWS Athena"](rule, logs)
+    assert result["events"] == 3
+    assert result["hits"] == 2
+
+def test_sql_replay_self_join_keeps_both_aliases(logs):
+    rule = ("SELECT a.sourceIPAddress FROM cloudtrail_logs a JOIN cloudtrail_logs b "
+            "ON a.sourceIPAddress = b.sourceIPAddress WHERE a.eventName = 'ConsoleLogin' AND b.eventName = 'GetObject'")
+    assert ENGINES["AWS Athena"](rule, logs)["hits"] == 1
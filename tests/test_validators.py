@@ -0,0 +1,45 @@
+import pytest
+from validators import validate_rule, syntax_check_summary
+
+def block(rule, fence=""):
+    return f"```{fence}\n{rule}\n```\nExplanation of the rule."
+
+def test_unterminated_sql_string_is_a_validation_error():
+    pytest.importorskip("sqlglot")
+    errors = validate_rule(block("SELECT * FROM cloudtrail_logs WHERE eventname = 'ConsoleLogin", "sql"), "AWS Athena")
+    assert errors and isinstance(errors[0], str)
+
+def test_unterminated_sql_identifier_is_a_validation_error():
+    pytest.importorskip("sqlglot")
+    errors = validate_rule(block('SELECT "eventname FROM cloudtrail_logs', "sql"), "Hunters (Snowflake SQL)")
+    assert errors
+
+def test_sql_parse_error_is_reported():
+    pytest.importorskip("sqlglot")
+    assert validate_rule(block("SELECT FROM WHERE (", "sql"), "AWS Athena")
+
+def test_valid_sql_passes():
+    pytest.importorskip("sqlglot")
+    assert validate_rule(block("SELECT * FROM cloudtrail_logs WHERE eventname = 'ConsoleLogin'", "sql"), "AWS Athena") == []
+
+def test_sigma_level_list_is_a_validation_error():
+    pytest.importorskip("yaml")
+    rule = "title: t\nlevel: [high, low]\nlogsource:\n  product: aws\ndetection:\n  sel:\n    a: b\n  condition: sel"
+    errors = validate_rule(block(rule, "yaml"), "Sigma Rules")
+    assert any("'level'" in error for error in errors)
+
+def test_sigma_non_string_identifier_does_not_raise():
+    pytest.importorskip("yaml")
+    rule = "title: t\nlogsource:\n  product: aws\ndetection:\n  1: {a: b}\n  condition: sel"
+    assert validate_rule(block(rule, "yaml"), "Sigma Rules")
+
+def test_malformed_python_rule():
+    assert validate_rule(block("def rule(event)\n    return True", "python"), "Panther (Python)")
+
+def test_unterminated_sql_reaches_the_qa_summary():
+    pytest.importorskip("sqlglot")
+    summary = syntax_check_summary(block("SELECT * FROM t WHERE a = 'x", "sql"), "AWS Athena")
+    assert summary.startswith("Failed local AWS Athena syntax validation")
+
+def test_rule_without_code_block_is_not_checked():
+    assert validate_rule("no code here", "AWS Athena") is None
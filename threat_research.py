@@ -1,19 +1,90 @@
 import os
+import re
 import sys
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI
-from crewai import Agent, Task, Crew, Process
-from crewai_tools import SerperDevTool, EXASearchTool, ScrapeWebsiteTool
+from cache import DiskCache
 
 # Load environment variables
 load_dotenv()
 
-def perform_threat_research(query):
+# Search results and scraped pages are shared by both agents and across
+# queries, so overlapping topics reuse each other's tool calls. Final crew
+# reports are cached per query and model.
+tool_cache = DiskCache("research_tools", ttl=3 * 24 * 3600, max_bytes=200 * 1024 * 1024)
+report_cache = DiskCache("research_reports", ttl=7 * 24 * 3600, max_bytes=50 * 1024 * 1024)
 
-    openai_model = os.getenv("OPENAI_MODEL_NAME", "gpt-4")
-    # Initialize tools
-    exa_search_tool = EXASearchTool()
-    scrape_website_tool = ScrapeWebsiteTool()
+def _normalize(value):
+    return " ".join(value.lower().split()) if isinstance(value, str) else value
+
+# Exa and the scraper report quota, network and HTTP failures as text rather
+# than raising, so results like these are returned to the agent but not cached
+FAILED_TOOL_OUTPUT = re.compile(
+    r"^\s*(error|exception|failed|traceback)\b|rate limit|quota exceeded|too many requests|"
+    r"\b(401|403|404|429|500|502|503|504)\b[^\n]{0,40}\b(unauthorized|forbidden|not found|too many|error|unavailable|timeout)",
+    re.IGNORECASE
+)
+
+def _tool_failed(result):
+    # Only the start of long pages is checked, so articles that mention rate
+    # limits further down are still cached
+    return not result.strip() or bool(FAILED_TOOL_OUTPUT.search(result[:500]))
+
+def _cached_tool_run(tool, run, args, kwargs):
+    key = tool_cache.key(tool.name, [_normalize(a) for a in args], {k: _normalize(v) for k, v in kwargs.items()})
+    cached = tool_cache.get(key)
+    if cached is not None:
+        return cached
+    result = str(run(*args, **kwargs))
+    if not _tool_failed(result):
+        tool_cache.put(key, result)
+    return result
+
+# crewai, crewai_tools and langchain_openai take seconds to import, so they are
+# loaded on first use. Tools and chat models are then built once per process
+# and reused by every crew.
+_tools = None
+_llms = {}
+
+def preload():
+    # Import the crew stack without building anything that needs API keys
+    import crewai
+    import crewai_tools
+    import langchain_openai
+
+def get_tools():
+    global _tools
+    if _tools is None:
+        from crewai_tools import EXASearchTool, ScrapeWebsiteTool
+
+        class CachedEXASearchTool(EXASearchTool):
+            def _run(self, *args, **kwargs):
+                return _cached_tool_run(self, super()._run, args, kwargs)
+
+        class CachedScrapeWebsiteTool(ScrapeWebsiteTool):
+            def _run(self, *args, **kwargs):
+                return _cached_tool_run(self, super()._run, args, kwargs)
+
+        _tools = (CachedEXASearchTool(), CachedScrapeWebsiteTool())
+    return _tools
+
+def get_llm(model):
+    if model not in _llms:
+        from langchain_openai import ChatOpenAI
+        _llms[model] = ChatOpenAI(model_name=model)
+    return _llms[model]
+
+def perform_threat_research(query, model=None, step_callback=None, task_callback=None, use_cache=True):
+    # step_callback(agent_role, step) is called for every agent iteration and
+    # task_callback(task_output) when a task finishes, so callers can stream progress
+    from crewai import Agent, Task, Crew, Process
+    openai_model = model or os.getenv("OPENAI_MODEL_NAME", "gpt-4")
+    report_key = report_cache.key(_normalize(query), openai_model)
+    if use_cache:
+        cached_report = report_cache.get(report_key)
+        if cached_report is not None:
+            return cached_report
+
+    exa_search_tool, scrape_website_tool = get_tools()
 
     # Define agents
     researcher = Agent(
@@ -22,9 +93,10 @@ def perform_threat_research(query):
         backstory="As a seasoned cyber threat researcher, you're at the forefront of identifying and analyzing emerging threats. Your expertise helps security teams write the best detection logic to catch threats. You focus on gathering actionable threat intel that includes clear log evidence for detection.",
         verbose=True,
         allow_delegation=False,
-        llm=ChatOpenAI(model_name=openai_model),
+        llm=get_llm(openai_model),
         max_iter=5,
-        tools=[exa_search_tool, scrape_website_tool]
+        tools=[exa_search_tool, scrape_website_tool],
+        step_callback=(lambda step: step_callback('Cyber Threat Intelligence Researcher', step)) if step_callback else None
     )
 
     analyst = Agent(
@@ -33,9 +105,10 @@ def perform_threat_research(query):
         backstory="With a keen eye for detail and a deep understanding of cyber threats, you excel at interpreting raw data and translating it into actionable detections for security operations teams. You prioritize threat intel that includes detailed log source evidence, ensuring the detection logic is robust and effective.",
         verbose=True,
         allow_delegation=True,
-        llm=ChatOpenAI(model_name=openai_model),
+        llm=get_llm(openai_model),
         max_iter=5,
-        tools=[exa_search_tool, scrape_website_tool]
+        tools=[exa_search_tool, scrape_website_tool],
+        step_callback=(lambda step: step_callback('Detection Engineer', step)) if step_callback else None
     )
 
     # Define tasks
@@ -78,11 +151,13 @@ def perform_threat_research(query):
         agents=[researcher, analyst],
         tasks=[research_task, analysis_task],
         process=Process.sequential,
-        verbose=2  # Increased verbosity for more detailed output
+        verbose=2,  # Increased verbosity for more detailed output
+        task_callback=task_callback
     )
 
     # Kick off the research process
-    result = crew.kickoff(inputs={'query': query})
+    result = str(crew.kickoff(inputs={'query': query}))
+    report_cache.put(report_key, result)
     return result
 
 # Modified main block for subprocess compatibility
@@ -1,16 +1,69 @@
-import subprocess
-import sys
 import streamlit as st
 from dotenv import load_dotenv
 import os
-import fitz
-from threat_research import perform_threat_research
-from firecrawl_integration import scrape_url
+import uuid
+from research_runner import submit_research, warm_up
+from firecrawl_integration import scrape_urls
+from pdf_extraction import extract_pdf
+from log_samples import summarize_log_file
+from pipeline import (STEP_NAMES, ANALYSIS_STEP_NAME, RULE_STEP, QA_STEP, REPAIR_STEP_NAME, DetectionStreamParser,
+                      detections_from_analysis, build_step_context, repair_request, pick_repair, skipped_qa_report)
+from validators import validate_rule, VALIDATORS
+from replay import replay_rule, replay_summary, replay_engine
+from metrics import summarize
+from run_state import open_run
+from library import load_index, example_selector
+from dedup import detection_index
+from routing import Router
+from speculation import start_speculation
+from jobs import job_queue, submit_research_job, QueuedJob
 
 # Load environment variables
 load_dotenv()
 
-def render_ui(prompts, process_with_llm):
+PROVIDER_MODELS = {
+    "OpenAI": ["gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"],
+    "Anthropic": ["claude-3-5-sonnet-20240620", "claude-3-opus-20240229", "claude-3-haiku-20240307"],
+    "Amazon Bedrock": [
+        "bedrock/anthropic.claude-3-sonnet-20240229-v1:0",
+        "bedrock/anthropic.claude-3-haiku-20240307-v1:0",
+        "bedrock/meta.llama3-8b-instruct-v1:0",
+        "bedrock/meta.llama3-70b-instruct-v1:0"
+    ],
+    "Groq": [
+        "groq/llama-3.1-70b-versatile",
+        "groq/llama-3.1-8b-instant",
+        "groq/llama3-8b-8192",
+    ],
+}
+ALL_MODELS = [model for models in PROVIDER_MODELS.values() for model in models]
+
+# Session state saved with each run (widget keys starting with one of these),
+# so a reconnect rebuilds the prompts the finished steps were made from
+SAVED_INPUT_KEYS = (
+    "llm_provider", "openai_model", "anthropic_model", "bedrock_model", "groq_model", "security_data_type",
+    "detection_language_select", "temperature_slider", "max_tokens_slider", "stream_responses_checkbox",
+    "use_cache_checkbox", "chunk_tokens_slider", "max_concurrency_slider", "speculate_", "use_workers_checkbox",
+    "analyst_name_input", "route_", "fallback_models", "prefer_fast_checkbox", "request_timeout",
+    "url_input", "description_input", "page_range_input", "detection_steps_input", "sop_input",
+    "num_detections_input", "example_detection_", "num_logs_input", "example_log_", "log_summaries",
+    "use_library_checkbox", "library_k_slider", "replay_logs_input",
+)
+
+def unless_restored(key, **default):
+    # Widget defaults, left out for widgets restored from a saved run: their
+    # value is already in session_state and Streamlit warns if both are given
+    return {} if key in st.session_state.get("restored_inputs", ()) else default
+
+# Languages with an entry in validators.VALIDATORS get a local syntax check
+# after step 2; the others rely on the QA review alone
+DETECTION_LANGUAGES = [
+    "AWS Athena", "StreamAlert", "Splunk SPL", "Falcon LogScale", "Elastic Query DSL",
+    "Kusto Query Language (KQL)",
+    "Sigma Rules", "Panther (Python)", "Hunters (Snowflake SQL)"
+]
+
+def render_ui(prompts, process_with_llm, process_all_detections, process_chunked_analysis, resume_detections=None):
     # Streamlit UI
     st.set_page_config(page_title="D.I.A.N.A.", page_icon="🛡️", layout="wide")
 
@@ -119,6 +172,34 @@ def render_ui(prompts, process_with_llm):
     </script>
     """, unsafe_allow_html=True)
 
+    # Each run is tied to the page URL, so a refresh or reconnect restores its
+    # state, inputs and finished steps instead of starting over. This happens
+    # before any widget is drawn, so the widgets come back with the saved values.
+    if "run" not in st.session_state:
+        st.session_state.run = open_run(st.query_params.get("run"))
+        st.query_params["run"] = st.session_state.run.run_id
+        session = dict(st.session_state.run.session)
+        inputs = session.pop("inputs", {})
+        st.session_state.update(inputs)
+        st.session_state.restored_inputs = set(inputs)
+        st.session_state.update(session)
+    run = st.session_state.run
+    run_source = f"run {run.run_id[:8]}"
+
+    # Pre-generation bills from worker threads; fold what it spent since the
+    # last rerun into the session totals, including replaced speculations
+    # whose in-flight calls are still finishing
+    speculations = []
+    for speculation in st.session_state.get("speculations", []):
+        finished = speculation.done()
+        usage = speculation.drain_usage()
+        st.session_state.total_cost += usage.get("cost", 0.0)
+        st.session_state.cache_savings += usage.get("saved", 0.0)
+        st.session_state.run_calls.extend(usage.get("calls", []))
+        if not finished:
+            speculations.append(speculation)
+    st.session_state.speculations = speculations
+
     # Add a sidebar
     sidebar = st.sidebar
 
@@ -173,7 +254,7 @@ def render_ui(prompts, process_with_llm):
         llm_provider = st.selectbox(
             "LLM Provider",
             ["OpenAI", "Anthropic", "Amazon Bedrock", "Groq"],
-            index=1,
+            **unless_restored("llm_provider", index=1),
             key="llm_provider",
             help="Choose the AI model provider for processing."
         )
@@ -185,38 +266,29 @@ def render_ui(prompts, process_with_llm):
         if llm_provider == "OpenAI":
             model = st.selectbox(
                 "Model Type",
-                ["gpt-4o-mini", "gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"],
+                PROVIDER_MODELS["OpenAI"],
                 key="openai_model",
                 help="Select the OpenAI model to use for processing."
             )
         elif llm_provider == "Anthropic":
             model = st.selectbox(
                 "Model Type",
-                ["claude-3-5-sonnet-20240620", "claude-3-opus-20240229", "claude-3-haiku-20240307"],
-                index=2, 
+                PROVIDER_MODELS["Anthropic"],
+                **unless_restored("anthropic_model", index=2), 
                 key="anthropic_model",
                 help="Select the Anthropic model to use for processing."
             )
         elif llm_provider == "Amazon Bedrock":
             model = st.selectbox(
                 "Model Type",
-                [
-                    "bedrock/anthropic.claude-3-sonnet-20240229-v1:0",
-                    "bedrock/anthropic.claude-3-haiku-20240307-v1:0",
-                    "bedrock/meta.llama3-8b-instruct-v1:0",
-                    "bedrock/meta.llama3-70b-instruct-v1:0"
-                ],
+                PROVIDER_MODELS["Amazon Bedrock"],
                 key="bedrock_model",
                 help="Select the Amazon Bedrock model to use for processing."
             )
         elif llm_provider == "Groq":
             model = st.selectbox(
                 "Model Type",
-        [
-            "groq/llama-3.1-70b-versatile",
-            "groq/llama-3.1-8b-instant",
-            "groq/llama3-8b-8192",
-        ],
+        PROVIDER_MODELS["Groq"],
         key="groq_model",
         help="Select the Groq model to use for processing."
     )
@@ -227,7 +299,7 @@ def render_ui(prompts, process_with_llm):
             [
                 "Okta Logs", "AWS CloudTrail Logs", "Kubernetes Audit Logs", "GitLab Audit Logs", "AWS EKS Plane logs", "Cisco Duo Logs"
             ],
-            default=["AWS CloudTrail Logs"],
+            **unless_restored("security_data_type", default=["AWS CloudTrail Logs"]),
             key="security_data_type",
             help="Select the relevant log types for your detection."
         )
@@ -235,14 +307,12 @@ def render_ui(prompts, process_with_llm):
         # Detection language selection with tooltip
         detection_language = st.selectbox(
             "Detection Language",
-            [
-                "AWS Athena", "StreamAlert", "Splunk SPL", "Falcon LogScale", "Elastic Query DSL",
-                "Kusto Query Language (KQL)",
-                "Sigma Rules","Panther (Python)", "Hunters (Snowflake SQL)"
-            ],
+            DETECTION_LANGUAGES,
             key="detection_language_select",
             help="Choose the query language for your detection rules."
         )
+        if detection_language in VALIDATORS:
+            st.caption("Rules in this language are syntax-checked locally before the QA review.")
 
         # Model parameters with explanations
         st.subheader("Model Parameters")
@@ -250,7 +320,7 @@ def render_ui(prompts, process_with_llm):
             "Temperature",
             min_value=0.0,
             max_value=1.0,
-            value=0.1,
+            **unless_restored("temperature_slider", value=0.1),
             step=0.1,
             key="temperature_slider",
             help="Controls output randomness. Lower values (e.g., 0.2) for more deterministic results, higher values (e.g., 0.8) for more creative outputs."
@@ -260,11 +330,101 @@ def render_ui(prompts, process_with_llm):
             "Max Tokens",
             min_value=100,
             max_value=4000,
-            value=4000,
+            **unless_restored("max_tokens_slider", value=4000),
             step=100,
             key="max_tokens_slider",
             help="Maximum number of tokens in the generated response. Higher values allow for longer outputs but may increase processing time."
         )
+
+        stream_responses = st.checkbox(
+            "Stream Responses",
+            **unless_restored("stream_responses_checkbox", value=True),
+            key="stream_responses_checkbox",
+            help="Render each step's output token by token as it is generated instead of waiting for the full response."
+        )
+
+        use_cache = st.checkbox(
+            "Use Response Cache",
+            **unless_restored("use_cache_checkbox", value=True),
+            key="use_cache_checkbox",
+            help="Reuse saved answers for identical prompts, model and parameters. Untick to bypass the cache and fetch fresh responses (they still refresh the cache)."
+        )
+
+        chunk_tokens = st.slider(
+            "Document Chunk Size (tokens)",
+            min_value=2000,
+            max_value=100000,
+            **unless_restored("chunk_tokens_slider", value=12000),
+            step=1000,
+            key="chunk_tokens_slider",
+            help="Reports and scraped pages longer than this are split into chunks that are analyzed in parallel, then merged into one list of detections."
+        )
+
+        max_concurrency = st.slider(
+            "Max Concurrent Requests",
+            min_value=1,
+            max_value=10,
+            **unless_restored("max_concurrency_slider", value=4),
+            step=1,
+            key="max_concurrency_slider",
+            help="Maximum number of LLM calls in flight when processing all detections at once. Lower this if your provider rate limits you."
+        )
+
+        speculate = st.checkbox(
+            "Pre-generate detection rules",
+            **unless_restored("speculate_checkbox", value=False),
+            key="speculate_checkbox",
+            help="While you review the detections found in step 1, write the step 2 rule for the first few in the background, so processing one of them starts from a finished rule."
+        )
+        speculate_count, speculate_budget = 3, None
+        if speculate:
+            speculate_count = st.slider("Detections to pre-generate", min_value=1, max_value=10, **unless_restored("speculate_count_slider", value=3), key="speculate_count_slider")
+            speculate_budget = st.number_input(
+                "Pre-generation budget ($)", min_value=0.0, **unless_restored("speculate_budget_input", value=0.10), step=0.05, key="speculate_budget_input",
+                help="No new pre-generation calls are started once this much has been spent on the current analysis."
+            )
+
+        # Shared worker pool (python jobs.py --workers N); only offered while workers are running
+        active_workers = job_queue.active_workers()
+        owner = None
+        if active_workers and st.checkbox(
+            f"Run in background workers ({active_workers} active)",
+            **unless_restored("use_workers_checkbox", value=True),
+            key="use_workers_checkbox",
+            help="Processing all detections and threat research run in the shared worker pool, so they keep going if this tab is closed or the page reruns. Reopen the run's URL to pick up the results."
+        ):
+            if "owner" not in st.session_state:
+                st.session_state.owner = uuid.uuid4().hex[:8]
+            analyst = st.text_input("Analyst name", key="analyst_name_input", help="Queued jobs are shared out fairly between analysts.")
+            owner = analyst.strip() or st.session_state.owner
+
+        # Per-step model routing: easy steps can use a cheaper, faster model, and
+        # failed or timed-out calls move on to the fallback models
+        with st.expander("Per-Step Model Routing", expanded=False):
+            routes = {}
+            for step_name in [ANALYSIS_STEP_NAME] + list(STEP_NAMES.values()) + [REPAIR_STEP_NAME]:
+                routed_model = st.selectbox(
+                    step_name, ["Same as Model Type"] + ALL_MODELS, key=f"route_{step_name}"
+                )
+                if routed_model != "Same as Model Type":
+                    routes[step_name] = routed_model
+            fallback_models = st.multiselect(
+                "Fallback Models",
+                ALL_MODELS,
+                key="fallback_models",
+                help="Tried in order when a call fails or times out. A model that keeps failing is skipped for 30 seconds."
+            )
+            prefer_fast = st.checkbox(
+                "Prefer Fastest Model",
+                **unless_restored("prefer_fast_checkbox", value=False),
+                key="prefer_fast_checkbox",
+                help="Try the step's model and its fallbacks in order of their recent latency for that step."
+            )
+            request_timeout = st.number_input(
+                "Request Timeout (seconds)", min_value=0, **unless_restored("request_timeout", value=0), step=10, key="request_timeout",
+                help="Give up on a call after this long and fall back. 0 uses the provider default."
+            )
+        router = Router(routes, fallback_models, prefer_fast, request_timeout or None)
     
     st.title("🛡️ D.I.A.N.A.")
     st.subheader("Detection and Intelligence Analysis for New Alerts")
@@ -273,6 +433,14 @@ def render_ui(prompts, process_with_llm):
     # Create tabs for main workflow and threat research
     tab1, tab2, tab3 = st.tabs(["Detection Engineering", "Threat Research Crew", "Bulk Detection Processing [Coming Soon]"])
 
+
+    def remember_processed(detection):
+        # Add a finished detection to the near-duplicate index once per run
+        indexed = run.session.get("indexed", [])
+        if detection["name"] not in indexed:
+            detection_index.add(detection, run_source)
+            run.remember(indexed=indexed + [detection["name"]])
+
     # Progress bar for multi-step process
     if 'step' not in st.session_state:
         st.session_state.step = 0
@@ -299,7 +467,13 @@ def render_ui(prompts, process_with_llm):
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Threat Intelligence Input")
-            url = st.text_input("Enter URL:")
+            url = st.text_area(
+                "Enter URL(s):",
+                height=68,
+                placeholder="One URL per line",
+                key="url_input",
+                help="Paste one or more report or blog URLs. Multiple URLs are scraped at the same time."
+            )
             
             # Initialize session state for scraped content if it doesn't exist
             if 'scraped_content' not in st.session_state:
@@ -307,14 +481,20 @@ def render_ui(prompts, process_with_llm):
 
             # Scrape URL button
             if st.button("🔍 Scrape URL", type="primary"):  
-                if url:
-                    try:
-                        with st.spinner("Scraping URL..."):
-                            st.session_state.scraped_content = scrape_url(url)
-                        st.success("URL scraped successfully!")
-                    except Exception as e:
-                        st.error(f"Error scraping URL: {e}")
-                        st.session_state.scraped_content = ""
+                urls = [line.strip() for line in url.splitlines() if line.strip()]
+                if urls:
+                    with st.spinner(f"Scraping {len(urls)} URL(s)..."):
+                        scraped = scrape_urls(urls)
+                    for failed_url, _, error in scraped:
+                        if error:
+                            st.error(f"Error scraping URL {failed_url}: {error}")
+                    pages = [(scraped_url, markdown) for scraped_url, markdown, error in scraped if not error]
+                    if len(pages) == 1:
+                        st.session_state.scraped_content = pages[0][1]
+                    else:
+                        st.session_state.scraped_content = "\n\n".join(f"Source: {scraped_url}\n\n{markdown}" for scraped_url, markdown in pages)
+                    if pages:
+                        st.success(f"Scraped {len(pages)} of {len(urls)} URL(s) successfully!")
                 else:
                     st.warning("Please enter a URL to scrape.")
 
@@ -327,6 +507,7 @@ def render_ui(prompts, process_with_llm):
                 "Enter threat intelligence description:",
                 height=100,
                 placeholder="Detect a user attempting to exfiltrate an Amazon EC2 AMI Snapshot. This rule lets you monitor the ModifyImageAttribute CloudTrail API calls to detect when an Amazon EC2 AMI snapshot is made public or shared with an AWS account. This rule also inspects: @requestParameters.launchPermission.add.items.group array to determine if the string all is contained. This is the indicator which means the RDS snapshot is made public. @requestParameters.launchPermission.add.items.userId array to determine if the string * is contained. This is the indicator which means the RDS snapshot was shared with a new or unknown AWS account.",
+                key="description_input",
                 help="Provide a detailed description of the threat intelligence you want to analyze."
             )
             uploaded_file = st.file_uploader(
@@ -339,11 +520,19 @@ def render_ui(prompts, process_with_llm):
 
             if uploaded_file is not None:
                 if uploaded_file.type == "application/pdf":
-                    # Process PDF file
-                    pdf_document = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-                    for page_num in range(pdf_document.page_count):
-                        page = pdf_document.load_page(page_num)
-                        file_content += page.get_text()
+                    # Process PDF file; extraction is cached by file hash so reruns are instant
+                    page_range = st.text_input(
+                        "Pages to analyze (optional):",
+                        placeholder="e.g. 1-5, 8, 12-",
+                        key="page_range_input",
+                        help="Limit extraction to specific pages of the PDF. Leave empty to use every page."
+                    )
+                    try:
+                        with st.spinner("Extracting text from PDF..."):
+                            file_content, page_count = extract_pdf(uploaded_file, page_range)
+                        st.caption(f"Extracted {len(file_content):,} characters from a {page_count}-page PDF.")
+                    except ValueError as e:
+                        st.error(str(e))
                 else:
                     # Process other text files
                     file_content = uploaded_file.getvalue().decode("utf-8")
@@ -354,6 +543,7 @@ def render_ui(prompts, process_with_llm):
                     "Enter detection writing steps:",
                     height=150,
                     placeholder="1. Identify the key indicators or behaviors from the threat intel\n2. Determine the relevant log sources and fields\n3. Write the query using the specified detection language\n4. Include appropriate filtering to reduce false positives\n5. Add comments to explain the logic of the detection",
+                    key="detection_steps_input",
                     help="Outline the steps you typically follow when writing detection rules."
                 )
 
@@ -362,55 +552,107 @@ def render_ui(prompts, process_with_llm):
                     "Enter standard operating procedures or investigation steps for your current detections and alerts:",
                     height=150,
                     placeholder="1. Validate the alert by reviewing the raw log data\n2. Check for any related alerts or suspicious activities from the same source\n3. Investigate the affected systems and user accounts\n4. Determine the potential impact and scope of the incident\n5. Escalate to the incident response team if a true positive is confirmed",
+                    key="sop_input",
                     help="Describe your standard operating procedures for triaging and investigating alerts."
                 )    
 
         with col2:
             st.subheader("Example Detections")
-            num_detections = st.number_input("Number of example detections", min_value=1, value=2, step=1)
+            num_detections = st.number_input("Number of example detections", min_value=1, **unless_restored("num_detections_input", value=2), step=1, key="num_detections_input")
             current_detections = [
                 st.text_area(
                     f"Example detection {i+1}",
                     height=100,
                     placeholder="SELECT sourceIPAddress, eventName, userAgent\nFROM cloudtrail_logs\nWHERE eventName = 'ConsoleLogin' AND errorMessage LIKE '%Failed authentication%'\nGROUP BY sourceIPAddress, eventName, userAgent\nHAVING COUNT(*) > 10",
+                    key=f"example_detection_{i}",
                     help="Provide an example of an existing detection query in your environment."
                 ) for i in range(num_detections)
             ]
             
             st.subheader("Example Logs")
-            num_logs = st.number_input("Number of example logs", min_value=1, value=2, step=1)
+            num_logs = st.number_input("Number of example logs", min_value=1, **unless_restored("num_logs_input", value=2), step=1, key="num_logs_input")
             example_logs = [
                 st.text_area(
                     f"Example log {i+1}",
                     height=100,
                     placeholder="paste examples of your actual logs here, you may have different field names or logging structure",
+                    key=f"example_log_{i}",
                     help="Provide examples of actual log entries from your environment."
                 ) for i in range(num_logs)
             ]
-
-        def run_threat_research(query, crewai_model):
-            # Create a placeholder in the Streamlit UI
+            log_uploads = st.file_uploader(
+                "Or upload log samples to summarize",
+                type=["json", "jsonl", "ndjson", "log", "gz"],
+                accept_multiple_files=True,
+                key="log_uploads",
+                # Summaries of the previous uploads are kept (and saved with the
+                # run) until the uploaded files change
+                on_change=lambda: st.session_state.pop("log_summaries", None),
+                help="JSON lines, JSON arrays, CloudTrail Records files or Okta System Log exports, optionally gzipped. "
+                     "Each file is streamed and reduced to a field schema with common values and a few minified example events."
+            )
+            if log_uploads:
+                log_summaries = []
+                for upload in log_uploads:
+                    try:
+                        with st.spinner(f"Summarizing {upload.name}..."):
+                            log_summaries.append([upload.name, summarize_log_file(upload)])
+                    except ValueError as e:
+                        st.error(f"{upload.name}: {e}")
+                st.session_state.log_summaries = log_summaries
+            for name, log_summary in st.session_state.get("log_summaries", []):
+                example_logs.append(log_summary)
+                with st.expander(f"Schema summary of {name}", expanded=False):
+                    st.code(log_summary, language=None)
+
+            # Production rules and log samples from the local library, picked per detection
+            library_index = load_index()
+            select_examples = None
+            if library_index and library_index.documents:
+                st.subheader("Example Library")
+                use_library = st.checkbox(
+                    f"Add relevant library examples ({library_index.count('detections')} detections, {library_index.count('logs')} log samples)",
+                    **unless_restored("use_library_checkbox", value=True),
+                    key="use_library_checkbox",
+                    help="For each detection, the closest matching rules and log samples for the selected log types and detection language are added to the examples above."
+                )
+                library_k = st.slider("Library examples per detection", min_value=1, max_value=10, **unless_restored("library_k_slider", value=3), key="library_k_slider")
+                if use_library:
+                    select_examples = example_selector(library_index, data_types, detection_language, library_k)
+
+            st.subheader("Detection Replay")
+            replay_logs = st.text_input(
+                "Sample log file or directory",
+                **unless_restored("replay_logs_input", value=os.getenv("DIANA_REPLAY_LOGS", "")),
+                key="replay_logs_input",
+                help="JSON lines, JSON (including CloudTrail's Records files), gzipped or Parquet logs. The generated rule is run against them "
+                     "and the hit count and sample hits are given to the QA review. Supported for SQL and Sigma rules, and for Panther rules when DIANA_REPLAY_PANTHER=1 is set."
+            )
+            if replay_logs and not os.path.exists(replay_logs):
+                st.warning(f"{replay_logs} does not exist; rules will not be replayed.")
+            elif replay_logs and detection_language == "Panther (Python)" and replay_engine(detection_language) is None:
+                st.caption("Panther rules are generated Python and are only replayed when the server is started with DIANA_REPLAY_PANTHER=1.")
+            elif replay_logs and replay_engine(detection_language) is None:
+                st.caption(f"{detection_language} rules cannot be replayed locally.")
+
+        # Save the inputs with the run whenever they change
+        inputs = {key: st.session_state[key] for key in st.session_state if key.startswith(SAVED_INPUT_KEYS)}
+        if inputs != run.session.get("inputs"):
+            run.remember(inputs=inputs)
+
+        def show_research_progress(job, last=30):
+            # Poll the background job and render only its most recent events,
+            # so the cost of each refresh does not grow with the research log
             output_placeholder = st.empty()
 
-            # Prepare the environment variables
-            env = os.environ.copy()
-            env["OPENAI_MODEL_NAME"] = crewai_model
-
-            # Run the threat_research.py script and capture its output
-            process = subprocess.Popen(['python', 'threat_research.py', query], 
-                                    stdout=subprocess.PIPE, 
-                                    stderr=subprocess.STDOUT,
-                                    universal_newlines=True,
-                                    env=env)
+            def render():
+                lines = [f"[{e['kind']}] {e['agent'] + ': ' if e['agent'] else ''}{e['detail']}" for e in job.events(last)]
+                header = f"Research progress ({job.status}, showing last {len(lines)} of {job.event_count} events)"
+                output_placeholder.code(header + "\n\n" + "\n".join(lines), language=None)
 
-            # Stream the output to the Streamlit UI
-            full_output = ""
-            for line in process.stdout:
-                full_output += line
-                output_placeholder.text_area("Research Progress:", full_output, height=400)
-
-            # Return the final result
-            return full_output
+            while not job.done.wait(0.5):
+                render()
+            render()
 
         # Process Threat Intel button
         if st.button("🚀 Process Threat Intel", type="primary") or st.session_state.step > 0:
@@ -418,7 +660,8 @@ def render_ui(prompts, process_with_llm):
                 st.error("Please provide either a threat intel description or upload a file.")
             else:
                 if st.session_state.step == 0:
-                    # Step 1: Analyze Threat Intel
+                    # Step 1: Analyze Threat Intel (a new run starts its metrics from scratch)
+                    st.session_state.run_calls = []
                     st.subheader("Step 1: Analyze Threat Intel")
                     details = st.expander("View Details", expanded=False)
 
@@ -435,8 +678,32 @@ def render_ui(prompts, process_with_llm):
                         st.text("Prompt:")
                         st.code(formatted_prompt, language="markdown")
 
-                    with st.spinner("Analyzing threat intelligence..."):
-                        result = process_with_llm(formatted_prompt, model, max_tokens, temperature)
+                    # Long documents are analyzed chunk by chunk (roughly 4 characters per token)
+                    document_length = len(file_content) + len(st.session_state.scraped_content)
+                    if document_length // 4 > chunk_tokens:
+                        chunk_progress = st.progress(0.0, text="Analyzing document chunks...")
+                        completed_chunks = []
+
+                        def on_chunk_progress(index, total, status):
+                            if status == "complete":
+                                completed_chunks.append(index)
+                                chunk_progress.progress(len(completed_chunks) / total, text=f"Analyzed {len(completed_chunks)}/{total} document chunks")
+
+                        with st.spinner("Analyzing threat intelligence in chunks..."):
+                            result = process_chunked_analysis(context, model, max_tokens, temperature, chunk_tokens, max_concurrency, on_chunk_progress, use_cache, run, router)
+                    else:
+                        # Detections are listed as soon as each one finishes streaming
+                        detection_parser = DetectionStreamParser()
+                        found_placeholder = st.empty()
+
+                        def on_text(text):
+                            if detection_parser.feed(text):
+                                found_placeholder.markdown("**Detections found so far:**\n" + "\n".join(
+                                    f"- {d['name']}" for d in detection_parser.detections
+                                ))
+
+                        with st.spinner("Analyzing threat intelligence..."):
+                            result = process_with_llm(formatted_prompt, model, max_tokens, temperature, stream=stream_responses, use_cache=use_cache, step=ANALYSIS_STEP_NAME, on_text=on_text, run=run, router=router)
 
                     if result is None:
                         st.error("An error occurred while analyzing the threat intelligence.")
@@ -450,56 +717,39 @@ def render_ui(prompts, process_with_llm):
 
                         st.success("Analysis complete!")
                         st.session_state.step = 1
+                        run.remember(step=1, result=result)
                         update_progress()
 
+                # Shared inputs of steps 2-5
+                step_context = {
+                    "detection_language": detection_language,
+                    "current_detections": "\n".join(current_detections),
+                    "example_logs": "\n".join(example_logs),
+                    "detection_steps": detection_steps,
+                    "sop": sop,
+                    "replay_logs": replay_logs,
+                }
+
                 if st.session_state.step >= 1:
-                    with st.spinner("Parsing detections..."):
-                        # Parse the result to extract detections
-                        detections = []
-                        current_detection = {"name": "", "behavior": "", "log_evidence": "", "context": ""}
-                        capturing_threat_behavior = False
-                        capturing_log_evidence = False
-                        capturing_context = False
-
-                        for line in st.session_state.result.split('\n'):
-                            stripped_line = line.strip()
-                            if stripped_line.startswith(("Detection Name:", "1.", "2.", "3.", "4.", "5.", "6.", "7.", "8.", "9.", "10.")):
-                                if current_detection["name"]:
-                                    detections.append(current_detection)
-                                    current_detection = {"name": "", "behavior": "", "log_evidence": "", "context": ""}
-                                name = stripped_line.split(":", 1)[-1].strip() if ":" in stripped_line else stripped_line.split(".", 1)[-1].strip()
-                                name = name.lstrip("0123456789. ")
-                                current_detection["name"] = name
-                            elif "Threat Behavior:" in stripped_line:
-                                capturing_threat_behavior = True
-                                capturing_log_evidence = False
-                                capturing_context = False
-                                current_detection["behavior"] = stripped_line.split("Threat Behavior:", 1)[-1].strip()
-                            elif "Log Evidence:" in stripped_line:
-                                capturing_threat_behavior = False
-                                capturing_log_evidence = True
-                                capturing_context = False
-                                current_detection["log_evidence"] = stripped_line.split("Log Evidence:", 1)[-1].strip()
-                            elif "Context:" in stripped_line:
-                                capturing_threat_behavior = False
-                                capturing_log_evidence = False
-                                capturing_context = True
-                                current_detection["context"] = stripped_line.split("Context:", 1)[-1].strip()
-                            elif capturing_threat_behavior:
-                                current_detection["behavior"] += " " + stripped_line
-                            elif capturing_log_evidence:
-                                current_detection["log_evidence"] += " " + stripped_line
-                            elif capturing_context:
-                                current_detection["context"] += " " + stripped_line
-
-                        if current_detection["name"]:
-                            detections.append(current_detection)
-
-                        if not detections:
-                            st.warning("No specific detections were identified. The entire analysis will be processed as a single detection.")
-                            detections = [{"name": "Entire Analysis", "behavior": st.session_state.result, "log_evidence": "", "context": ""}]
-
-                        st.session_state.detections = detections
+                    # Parse each analysis once; reruns reuse the cached detections
+                    if st.session_state.get("parsed_result") != st.session_state.result:
+                        detections = st.session_state.detections = detections_from_analysis(st.session_state.result)
+                        st.session_state.parsed_result = st.session_state.result
+                        # Flag detections close to ones processed in earlier runs or
+                        # to another detection of this analysis
+                        st.session_state.duplicates = {
+                            detection["name"]: match
+                            for detection, match in zip(detections, detection_index.check(detections, run_source)) if match
+                        }
+
+                if st.session_state.step >= 1 and not st.session_state.detections:
+                    st.info("The analysis found no detections in this intel, so there is nothing to process in steps 2-5.")
+                elif st.session_state.step >= 1:
+                    detections = st.session_state.detections
+                    duplicates = st.session_state.get("duplicates", {})
+
+                    if detections[0]["name"] == "Entire Analysis":
+                        st.warning("No specific detections were identified. The entire analysis will be processed as a single detection.")
 
                     # Display the number of detections found
                     st.info(f"Number of detections found: {len(detections)}")
@@ -512,17 +762,132 @@ def render_ui(prompts, process_with_llm):
                             st.write(f"**Threat Behavior:** {detection['behavior']}")
                             st.write(f"**Log Evidence:** {detection['log_evidence']}")
                             st.write(f"**Context:** {detection['context']}")
+                            if detection["name"] in duplicates:
+                                match = duplicates[detection["name"]]
+                                where = "found earlier in this analysis" if match["source"] == run_source else f"already processed in {match['source']}"
+                                st.warning(f"Near-duplicate (~{match['similarity']:.0%} similar) of **{match['name']}**, {where}.")
                             st.write("---")
 
+                    # Write step 2 for the likeliest picks while the analyst reads;
+                    # a new analysis or changed inputs replace the speculation
+                    speculation = st.session_state.get("speculation")
+                    if speculate and st.session_state.step == 1:
+                        ranked = [d for d in detections if d["name"] not in duplicates] + [d for d in detections if d["name"] in duplicates]
+                        speculation_key = run.key(run.run_id, st.session_state.result, step_context, router.route(STEP_NAMES[RULE_STEP], model),
+                                                  max_tokens, temperature, speculate_count, speculate_budget, select_examples is not None)
+                        if speculation is None or speculation.key != speculation_key:
+                            if speculation:
+                                speculation.cancel()
+                            speculation = st.session_state.speculation = start_speculation(
+                                speculation_key, prompts[RULE_STEP - 1], ranked[:speculate_count], step_context, run, router,
+                                model, max_tokens, temperature, use_cache, speculate_budget, select_examples
+                            )
+                            st.session_state.speculations.append(speculation)
+                    elif speculation and not speculate:
+                        speculation.cancel()
+                        speculation = st.session_state.speculation = None
+                    if speculation:
+                        st.caption(speculation.summary())
+
                     # Allow user to select a detection
                     selected_detection_name = st.selectbox("Select a detection to process:", [d["name"] for d in st.session_state.detections])
 
                     if st.button("Process Selected Detection", type="primary"):
                         selected_detection = next(d for d in st.session_state.detections if d["name"] == selected_detection_name)
+                        if speculation:
+                            speculation.cancel(keep=selected_detection_name)
                         st.session_state.selected_detection = selected_detection
                         st.session_state.step = 2
+                        run.remember(step=2, selected_detection=selected_detection)
                         update_progress()
 
+                    # Run steps 2-5 for every detection concurrently
+                    skip_duplicates = bool(duplicates) and st.checkbox(
+                        f"Skip {len(duplicates)} near-duplicate detection(s) when processing all", value=True,
+                        help="These detections closely match ones already processed in earlier runs or another detection of this analysis."
+                    )
+                    def track_progress(to_process):
+                        progress_bars = [
+                            st.progress(0.0, text=f"{d['name']}: queued") for d in to_process
+                        ]
+
+                        completed_steps = [0] * len(to_process)
+
+                        # Steps 3 and 4 run side by side, so progress counts completed steps
+                        def on_progress(index, step, status):
+                            name = to_process[index]["name"]
+                            if status == "failed":
+                                progress_bars[index].progress(1.0, text=f"{name}: failed")
+                            elif status == "running":
+                                progress_bars[index].progress(completed_steps[index] / len(STEP_NAMES), text=f"{name}: {STEP_NAMES[step]}...")
+                            else:
+                                completed_steps[index] += 1
+                                progress_bars[index].progress(completed_steps[index] / len(STEP_NAMES), text=f"{name}: {STEP_NAMES[step]} complete")
+                        return on_progress
+
+                    def finish_all_detections(outcomes):
+                        st.session_state.all_detection_results = outcomes
+                        st.session_state.detections_job = None
+                        run.remember(all_detection_results=outcomes, detections_job=None)
+                        for outcome in outcomes:
+                            if not outcome["error"]:
+                                remember_processed(outcome["detection"])
+
+                    def queue_status():
+                        # Clicking Cancel reruns the page, which stops the wait;
+                        # the rerun finds the button pressed and cancels the job
+                        cancel = st.button("Cancel background processing", key="cancel_detections_job")
+                        placeholder = st.empty()
+                        def on_queued(position):
+                            if position is None:
+                                placeholder.empty()
+                            else:
+                                placeholder.caption(f"Queued, {position} job(s) ahead in the background queue")
+                        return cancel, on_queued
+
+                    # A Process All queued for the background workers before this
+                    # page was (re)loaded is picked up where it is
+                    detections_job = st.session_state.get("detections_job")
+                    queue_controls = None
+                    if detections_job and resume_detections and not st.session_state.get("all_detection_results"):
+                        job = job_queue.get(detections_job)
+                        if job:
+                            queue_controls = cancel, on_queued = queue_status()
+                            if cancel:
+                                job_queue.cancel(detections_job)
+                                st.session_state.detections_job = None
+                                run.remember(detections_job=None)
+                                st.warning("Background processing cancelled.")
+                            else:
+                                on_progress = track_progress(job["payload"]["detections"])
+                                with st.spinner(f"Waiting for the background workers to process {len(job['payload']['detections'])} detections..."):
+                                    finish_all_detections(resume_detections(detections_job, on_progress, on_queued))
+
+                    if st.button("⚡ Process All Detections", type="primary"):
+                        to_process = [d for d in st.session_state.detections if not (skip_duplicates and d["name"] in duplicates)]
+                        # The Cancel button keeps its key, so it is drawn once per rerun
+                        if owner and queue_controls is None:
+                            queue_controls = queue_status()
+                        on_queued = queue_controls[1] if queue_controls else None
+                        on_progress = track_progress(to_process)
+                        with st.spinner(f"Processing {len(to_process)} detections{' in the background workers' if owner else ''}..."):
+                            finish_all_detections(process_all_detections(
+                                to_process, step_context, model, max_tokens, temperature, max_concurrency, on_progress, use_cache, run, select_examples, router, owner, on_queued
+                            ))
+
+                    if st.session_state.get("all_detection_results"):
+                        st.subheader("All Detections")
+                        for outcome in st.session_state.all_detection_results:
+                            with st.expander(outcome["detection"]["name"], expanded=False):
+                                if outcome["error"]:
+                                    st.error(f"An error occurred while processing this detection: {outcome['error']}")
+                                for i, step_name in STEP_NAMES.items():
+                                    if i in outcome["results"] and i < 5:
+                                        st.text(f"Step {i}: {step_name}")
+                                        st.code(outcome["results"][i], language="markdown")
+                                if 5 in outcome["results"]:
+                                    st.markdown(outcome["results"][5])
+
                 if st.session_state.step >= 2:
                     # Process the remaining steps for the selected detection
                     selected_detection = st.session_state.selected_detection
@@ -533,30 +898,20 @@ def render_ui(prompts, process_with_llm):
                     st.write(f"**Log Evidence:** {selected_detection['log_evidence']}")
                     st.write(f"**Context:** {selected_detection['context']}")
 
-                    # Further processing steps...
+                    # Every rerun walks all steps so later prompts see earlier
+                    # outputs; steps whose inputs are unchanged come back from
+                    # the run state without another LLM call
                     results = {}
                     results[1] = st.session_state.result  # Store the first result
+                    examples = select_examples(selected_detection) if select_examples else None
 
                     for i in range(2, 6):
-                        if st.session_state.step > i:
-                            continue
-
-                        step_name = ['Create Detection Rule', 'Develop Investigation Guide', 'Quality Assurance Review', 'Final Summary'][i-2]
+                        step_name = STEP_NAMES[i]
                         
                         st.subheader(f"Step {i}: {step_name}")
                         details = st.expander("View Details", expanded=False)
 
-                        context = {
-                            "detection_language": detection_language,
-                            "current_detections": "\n".join(current_detections),
-                            "example_logs": "\n".join(example_logs),
-                            "detection_steps": detection_steps,
-                            "sop": sop,
-                            "previous_analysis": selected_detection,
-                            "previous_detection_rule": results.get(2, ""),
-                            "previous_investigation_steps": results.get(3, ""),
-                            "previous_qa_findings": results.get(4, "")
-                        }
+                        context = build_step_context(step_context, selected_detection, results, examples)
 
                         formatted_prompt = prompts[i-1].format(**context)
 
@@ -564,13 +919,40 @@ def render_ui(prompts, process_with_llm):
                             st.text("Prompt:")
                             st.code(formatted_prompt, language="markdown")
 
-                        with st.spinner(f"Processing {step_name}..."):
-                            result = process_with_llm(formatted_prompt, model, max_tokens, temperature)
+                        report = skipped_qa_report(results.get(RULE_STEP), detection_language) if i == QA_STEP else None
+                        if report:
+                            st.warning("The detection rule does not parse, so the QA review was skipped.")
+                            result = report
+                        else:
+                            if i == RULE_STEP and speculation:
+                                with st.spinner(f"Finishing the pre-generated {step_name.lower()}..."):
+                                    speculation.wait(selected_detection["name"])
+                            with st.spinner(f"Processing {step_name}..."):
+                                result = process_with_llm(formatted_prompt, model, max_tokens, temperature, stream=stream_responses, use_cache=use_cache, step=step_name, run=run, router=router)
 
                         if result is None:
                             st.error(f"An error occurred while processing {step_name}.")
                             break
 
+                        errors = validate_rule(result, detection_language) if i == RULE_STEP else None
+                        if errors:
+                            with details:
+                                st.text("Syntax errors:")
+                                st.code("\n".join(errors), language="markdown")
+                            with st.spinner(f"Repairing {len(errors)} syntax error(s)..."):
+                                repaired = process_with_llm(repair_request(result, detection_language, errors), model, max_tokens, temperature, use_cache=use_cache, step=REPAIR_STEP_NAME, run=run, router=router)
+                            result = pick_repair(result, errors, repaired, detection_language)
+
+                        if i == RULE_STEP and replay_logs:
+                            with st.spinner("Replaying the rule against the sample logs..."):
+                                replay = replay_summary(result, detection_language, replay_logs)
+                            replayed = replay_rule(result, detection_language, replay_logs) or {}
+                            with details:
+                                st.text("Replay:")
+                                st.code(replay, language="markdown")
+                                if "seconds" in replayed:
+                                    st.caption(f"Replay took {replayed['seconds']:.2f}s (not included in the QA prompt).")
+
                         results[i] = result
 
                         with details:
@@ -578,10 +960,12 @@ def render_ui(prompts, process_with_llm):
                             st.code(result, language="markdown")
 
                         st.success(f"{step_name} complete!")
-                        st.session_state.step = i + 1
+                        st.session_state.step = max(st.session_state.step, i + 1)
+                        run.remember(step=st.session_state.step)
                         update_progress()
 
                     if len(results) == 5:
+                        remember_processed(selected_detection)
                         st.session_state.step = 6  # Indicate completion
                         update_progress()
                         st.success("Processing complete!")
@@ -589,12 +973,40 @@ def render_ui(prompts, process_with_llm):
 
                         # Add a button to restart the process
                         if st.button("Start Over"):
+                            # Drop the old run's background work along with it
+                            if st.session_state.get("detections_job"):
+                                job_queue.cancel(st.session_state.detections_job)
                             st.session_state.step = 0
+                            st.session_state.all_detection_results = None
+                            st.session_state.detections_job = None
+                            st.session_state.run = open_run()
+                            st.query_params["run"] = st.session_state.run.run_id
                             update_progress()
                             st.experimental_rerun()
                     else:
                         st.error("An error occurred while processing the threat intelligence.")
 
+        # Per-run latency, token and cost breakdown
+        if st.session_state.get("run_calls"):
+            with st.expander("Run Metrics", expanded=False):
+                rows = summarize(st.session_state.run_calls)
+                st.dataframe([
+                    {
+                        "Step": row["step"],
+                        "Model": row["model"],
+                        "Calls": row["calls"],
+                        "Cache Hits": row["cache_hits"],
+                        "Prompt Tokens": row["prompt_tokens"],
+                        "Cached Tokens": row["cached_tokens"],
+                        "Completion Tokens": row["completion_tokens"],
+                        "Cost ($)": round(row["cost"], 6),
+                        "p50 Latency (s)": round(row["p50_latency"], 2) if row["p50_latency"] is not None else None,
+                        "p95 Latency (s)": round(row["p95_latency"], 2) if row["p95_latency"] is not None else None,
+                        "p50 TTFT (s)": round(row["p50_ttft"], 2) if row["p50_ttft"] is not None else None,
+                    }
+                    for row in rows
+                ], use_container_width=True)
+
     with tab2:
         # Threat Research section
         st.subheader("Threat Research Crew")
@@ -628,16 +1040,44 @@ def render_ui(prompts, process_with_llm):
             help="Specify a topic for in-depth threat research to supplement your analysis."
         )
 
+        if research_query:
+            # Start importing the research stack while the user gets ready to submit
+            warm_up()
+
+        reuse_research = st.checkbox(
+            "Reuse cached research",
+            value=True,
+            key="reuse_research_checkbox",
+            help="Return the saved report when this topic was already researched with the same model. Search results and scraped pages are reused either way."
+        )
+
         if st.button("🔍 Perform Threat Research", type="primary", key="research_button"):
             if research_query:
+                # The crew keeps running in the background if the page reruns
+                if owner:
+                    st.session_state.research_job = submit_research_job(research_query, crewai_model, reuse_research, owner)
+                else:
+                    st.session_state.research_job = submit_research(research_query, crewai_model, reuse_research)
+            else:
+                st.warning("Please enter a research topic before performing threat research.")
+
+        research_job = st.session_state.get("research_job")
+        if research_job is not None:
+            # Only queued research can be stopped; the workers check between steps
+            if isinstance(research_job, QueuedJob) and not research_job.done.is_set():
+                if st.button("Cancel research", key="cancel_research_job"):
+                    research_job.cancel()
+            if not research_job.done.is_set():
                 with st.spinner("Performing threat research... This may take a few minutes."):
-                    research_result = run_threat_research(research_query, crewai_model)
-                
+                    show_research_progress(research_job)
+            else:
+                show_research_progress(research_job)
+
+            if research_job.status == "complete":
                 st.subheader("Threat Research Results")
-                st.markdown(research_result)
-                
+                st.markdown(research_job.result)
             else:
-                st.warning("Please enter a research topic before performing threat research.")
+                st.error(f"Threat research failed: {research_job.error}")
     with tab3:
         st.subheader("Open Source Detection Content")
         
@@ -0,0 +1,144 @@
+import re
+import ast
+import json
+
+# Local syntax checks for the rule written in step 2, keyed by the detection
+# languages offered in the UI. A validator takes the rule's source and returns
+# a list of error messages (empty when the rule is valid). Languages without a
+# validator, or whose parser is not installed, are left to the LLM QA review.
+VALIDATORS = {}
+
+def register(*languages):
+    def decorator(func):
+        for language in languages:
+            VALIDATORS[language] = func
+        return func
+    return decorator
+
+def extract_rule(output):
+    # The step 2 prompt asks for the rule in a code block followed by an explanation
+    match = re.search(r"```[^\n]*\n(.*?)```", output, re.DOTALL)
+    return match.group(1).strip() if match else None
+
+def validate_rule(output, language):
+    # Returns a list of errors, or None when the rule could not be checked locally
+    validator = VALIDATORS.get(language)
+    rule = extract_rule(output or "")
+    if validator is None or rule is None:
+        return None
+    try:
+        return validator(rule)
+    except ImportError:
+        return None
+    except Exception as e:
+        # A validator tripping over an unexpected rule shape is a finding about
+        # the rule, not a reason to fail the detection
+        return [f"Could not validate the rule: {type(e).__name__}: {e}"]
+
+def syntax_check_summary(output, language):
+    # One-line result of the local check for the QA prompt
+    errors = validate_rule(output, language)
+    if errors is None:
+        return f"Not checked locally; assess the {language} syntax yourself."
+    if not errors:
+        return f"Passed local {language} syntax validation. Score syntactic correctness on conventions only and focus the review on the other aspects."
+    return f"Failed local {language} syntax validation: " + "; ".join(errors)
+
+def sql_validator(dialect):
+    def validate(rule):
+        import sqlglot
+        from sqlglot.errors import ParseError, SqlglotError
+        try:
+            statements = [s for s in sqlglot.parse(rule, read=dialect) if s is not None]
+        except ParseError as e:
+            return [f"line {err.get('line')}, column {err.get('col')}: {err.get('description')}" for err in e.errors] or [str(e)]
+        except SqlglotError as e:
+            # e.g. TokenError for an unterminated string or quoted identifier
+            return [str(e)]
+        return [] if statements else ["The code block contains no SQL statement."]
+    return validate
+
+# sqlglot dialect for each SQL detection language
+SQL_DIALECTS = {"AWS Athena": "presto", "Hunters (Snowflake SQL)": "snowflake"}
+for language, dialect in SQL_DIALECTS.items():
+    register(language)(sql_validator(dialect))
+
+def _python_syntax(rule):
+    try:
+        return ast.parse(rule), []
+    except SyntaxError as e:
+        return None, [f"line {e.lineno}, column {e.offset}: {e.msg}"]
+
+@register("Panther (Python)")
+def validate_panther(rule):
+    tree, errors = _python_syntax(rule)
+    if errors:
+        return errors
+    functions = {node.name: node for node in tree.body if isinstance(node, ast.FunctionDef)}
+    if "rule" not in functions:
+        return ["Panther rules must define a top-level rule(event) function."]
+    for name, node in functions.items():
+        if name in ("rule", "title", "dedup", "severity", "alert_context", "description", "reference", "runbook", "destinations") \
+                and len(node.args.args) != 1:
+            errors.append(f"{name}() must take exactly one argument (the event), not {len(node.args.args)}.")
+    return errors
+
+@register("StreamAlert")
+def validate_streamalert(rule):
+    tree, errors = _python_syntax(rule)
+    if errors:
+        return errors
+    if not any(isinstance(node, ast.FunctionDef) for node in tree.body):
+        return ["StreamAlert rules must define a rule function decorated with @rule(...)."]
+    return []
+
+@register("Elastic Query DSL")
+def validate_elastic_dsl(rule):
+    try:
+        query = json.loads(rule)
+    except ValueError as e:
+        return [f"Invalid JSON: {e}"]
+    if not isinstance(query, dict):
+        return ["A Query DSL request must be a JSON object."]
+    return []
+
+SIGMA_LEVELS = {"informational", "low", "medium", "high", "critical"}
+SIGMA_STATUSES = {"stable", "test", "experimental", "deprecated", "unsupported"}
+SIGMA_CONDITION_WORDS = {"and", "or", "not", "of", "them", "all", "1", "any", "near", "by", "count", "min", "max", "avg", "sum"}
+
+@register("Sigma Rules")
+def validate_sigma(rule):
+    import yaml
+    try:
+        document = next(iter(yaml.safe_load_all(rule)), None)
+    except yaml.YAMLError as e:
+        return [f"Invalid YAML: {e}"]
+    if not isinstance(document, dict):
+        return ["A Sigma rule must be a YAML mapping."]
+
+    errors = []
+    if not isinstance(document.get("title"), str):
+        errors.append("Missing required string field 'title'.")
+    logsource = document.get("logsource")
+    if not isinstance(logsource, dict) or not any(logsource.get(k) for k in ("category", "product", "service")):
+        errors.append("'logsource' must be a mapping with at least one of category, product or service.")
+    if document.get("level") is not None and (not isinstance(document["level"], str) or document["level"] not in SIGMA_LEVELS):
+        errors.append(f"'level' must be one of {', '.join(sorted(SIGMA_LEVELS))}.")
+    if document.get("status") is not None and (not isinstance(document["status"], str) or document["status"] not in SIGMA_STATUSES):
+        errors.append(f"'status' must be one of {', '.join(sorted(SIGMA_STATUSES))}.")
+
+    detection = document.get("detection")
+    if not isinstance(detection, dict):
+        return errors + ["Missing required mapping 'detection'."]
+    condition = detection.get("condition")
+    if not condition:
+        return errors + ["'detection' must contain a 'condition'."]
+    identifiers = [k for k in detection if k != "condition"]
+    for text in (condition if isinstance(condition, list) else [condition]):
+        for word in re.findall(r"[A-Za-z0-9_*]+", str(text).split("|")[0]):
+            if word.lower() in SIGMA_CONDITION_WORDS or word.isdigit():
+                continue
+            pattern = re.compile("^" + re.escape(word).replace(r"\*", ".*") + "$")
+            if not any(pattern.match(identifier) for identifier in identifiers):
+                errors.append(f"Condition references '{word}', which is not defined under 'detection'.")
+    return errors